@@ -1,16 +1,186 @@
-from flask import Flask, request, jsonify, send_from_directory, render_template_string
+from flask import Flask, Response, request, jsonify, send_file, render_template_string, make_response, abort
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.security import safe_join
+from flask_mail import Mail, Message
+from jinja2 import Environment
+from dotenv import load_dotenv
+from functools import wraps
+import click
+import codecs
+import gc
+import hashlib
 import json
+import gzip
+import math
+import mimetypes
 import os
-from datetime import datetime
+import queue
+import random
+import re
+import requests
+import secrets
+import smtplib
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from datetime import date, datetime, timedelta
 from decimal import Decimal
+from urllib.parse import urljoin, urlsplit
 import base64
+import bisect
 
-app = Flask(__name__)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from storage import (FileLock, LocalStorage, NativeThreadPoolExecutor, RemoteStorage, StorageError,
+                     file_stamp, green, io_pool, journal_file)
+
+load_dotenv()
+
+app = Flask(__name__, static_folder=None)
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_BYTES', 20 * 1024 * 1024))
+
+# Outgoing mail; notifications are queued only when MAIL_SERVER is set
+app.config.update(
+    MAIL_SERVER=os.environ.get('MAIL_SERVER', ''),
+    MAIL_PORT=int(os.environ.get('MAIL_PORT', 25)),
+    MAIL_USE_TLS=os.environ.get('MAIL_USE_TLS') == '1',
+    MAIL_USE_SSL=os.environ.get('MAIL_USE_SSL') == '1',
+    MAIL_USERNAME=os.environ.get('MAIL_USERNAME'),
+    MAIL_PASSWORD=os.environ.get('MAIL_PASSWORD'),
+    MAIL_DEFAULT_SENDER=os.environ.get('MAIL_DEFAULT_SENDER', 'PipeDrill Pro <no-reply@localhost>'),
+)
+ADMIN_EMAIL = os.environ.get('ADMIN_EMAIL')
+mail = Mail(app)
+
+# Number of reverse proxies in front of the app whose X-Forwarded-For we trust
+PROXY_COUNT = int(os.environ.get('PROXY_COUNT', 0))
+if PROXY_COUNT:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_COUNT)
+
+# Startup progress, filled in by create_app and reported by /api/ready
+class Startup:
+    """Which of create_app's phases have run, and how long each took"""
+
+    def __init__(self):
+        self.running = False
+        self.ready = False
+        self.phase = None
+        self.completed = []
+        self.pid = None
+
+    @contextmanager
+    def step(self, name):
+        self.phase = name
+        start = time.perf_counter()
+        yield
+        self.completed.append({'phase': name, 'seconds': round(time.perf_counter() - start, 3)})
+        self.phase = None
+
+STARTUP = Startup()
+
+# Storage codecs
+class JSONCodec:
+    """Compact JSON, encoded with orjson when it is installed"""
+    name = 'json'
+    extension = '.json'
+
+    def dumps(self, data):
+        if orjson is not None:
+            return orjson.dumps(data)
+        return json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+    def loads(self, raw):
+        if orjson is not None:
+            return orjson.loads(raw)
+        return json.loads(raw)
+
+class MsgpackCodec:
+    """msgpack with a columnar layout for lists of records
+
+    Orders and service requests repeat the same keys in every record, so
+    each list of dicts is stored once as a column list plus value rows.
+    Keys absent from a record are written as an empty ext type so they
+    round-trip as missing rather than as None.
+    """
+    name = 'msgpack'
+    extension = '.msgpack'
+    MISSING_EXT = 0
+
+    def dumps(self, data):
+        if msgpack is None:
+            raise RuntimeError('msgpack is not installed')
+        return msgpack.packb(self._to_columnar(data), use_bin_type=True)
+
+    def loads(self, raw):
+        if msgpack is None:
+            raise RuntimeError('msgpack is not installed')
+        return self._from_columnar(msgpack.unpackb(raw, raw=False, strict_map_key=False))
+
+    def _to_columnar(self, data):
+        if isinstance(data, dict):
+            return {key: self._to_columnar(value) for key, value in data.items()}
+        if isinstance(data, list) and data and all(isinstance(r, dict) for r in data):
+            columns = list(dict.fromkeys(key for record in data for key in record))
+            missing = msgpack.ExtType(self.MISSING_EXT, b'')
+            rows = [[self._to_columnar(record.get(c, missing)) for c in columns] for record in data]
+            return {'__columns__': columns, '__rows__': rows}
+        return data
+
+    def _from_columnar(self, data):
+        if isinstance(data, dict):
+            if '__columns__' in data and '__rows__' in data:
+                columns, rows = data['__columns__'], data['__rows__']
+                if not (isinstance(columns, list) and isinstance(rows, list)
+                        and all(isinstance(row, list) for row in rows)):
+                    raise ValueError('column layout is not a column list with value rows')
+                return [{c: self._from_columnar(v) for c, v in zip(columns, row)
+                         if not isinstance(v, msgpack.ExtType)}
+                        for row in rows]
+            return {key: self._from_columnar(value) for key, value in data.items()}
+        return data
+
+CODECS = {codec.name: codec for codec in (JSONCodec(), MsgpackCodec())}
+DATA_CODEC = os.environ.get('DATA_CODEC', 'json')
+
+def codec_for(filename):
+    """Pick the codec that matches a data file's extension"""
+    for codec in CODECS.values():
+        if filename.endswith(codec.extension):
+            return codec
+    return CODECS['json']
+
+def data_file(name, codec=None):
+    """Path of a data file in the configured storage format"""
+    return os.path.join('data', name + CODECS[codec or DATA_CODEC].extension)
 
 # File paths
-REQUESTS_FILE = 'data/service_requests.json'
-PRODUCTS_FILE = 'data/products.json'
-ORDERS_FILE = 'data/orders.json'
+REQUESTS_FILE = data_file('service_requests')
+PRODUCTS_FILE = data_file('products')
+ORDERS_FILE = data_file('orders')
+SHARED_STATE_FILE = 'data/shared_state.sqlite3'
+STATUS_AUDIT_FILE = 'data/status_audit.log'
 UPLOAD_FOLDER = 'static/images'
 os.makedirs('data', exist_ok=True)
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
@@ -104,33 +274,2701 @@ def init_data():
         }
     ]
 
-    # Create files if they don't exist
-    if not os.path.exists(PRODUCTS_FILE):
-        with open(PRODUCTS_FILE, 'w') as f:
-            json.dump({"products": sample_products, "services": sample_services}, f, indent=2)
-    
-    if not os.path.exists(REQUESTS_FILE):
-        with open(REQUESTS_FILE, 'w') as f:
-            json.dump([], f)
-    
-    if not os.path.exists(ORDERS_FILE):
-        with open(ORDERS_FILE, 'w') as f:
-            json.dump([], f)
+    # Create files if they don't exist; workers starting together may race here
+    defaults = {PRODUCTS_FILE: {"products": sample_products, "services": sample_services},
+                REQUESTS_FILE: [], ORDERS_FILE: []}
+    for filename, data in defaults.items():
+        with data_lock(filename):
+            if STORAGE.stamp(filename) is None:
+                save_data(filename, data)
+
+# Storage backend: data files on local disk, or on a storage server shared by every node
+STORAGE_URL = os.environ.get('STORAGE_URL')
+STORAGE_SECRET = os.environ.get('STORAGE_SECRET', '')
+# No threads during startup: a gunicorn master is about to fork
+STORAGE = (RemoteStorage(STORAGE_URL, STORAGE_SECRET, may_start_threads=lambda: not STARTUP.running)
+           if STORAGE_URL else LocalStorage())
+
+def data_lock(filename):
+    """Exclusive lock on a data file, held across processes and nodes while writing"""
+    return STORAGE.lock(filename)
+
+@contextmanager
+def data_locks(*filenames):
+    """Locks on several data files, always taken in sorted order so holders never deadlock"""
+    with ExitStack() as stack:
+        for filename in sorted(set(filenames)):
+            stack.enter_context(data_lock(filename))
+        yield
+
+def require_local_storage():
+    """Refuse maintenance commands that work on data/ directly while it lives on a storage server"""
+    if not isinstance(STORAGE, LocalStorage):
+        raise click.ClickException(f'Data is kept by the storage server at {STORAGE_URL}; '
+                                   'run this command on that machine without STORAGE_URL set')
+
+class CorruptDataError(StorageError):
+    """A data file exists but does not decode to the records it should hold"""
+
+# What a codec or the journal raises on bytes that are not what was written; anything
+# else, such as a KeyError in apply_journal, is a bug and must not pass for corruption
+CORRUPTION_ERRORS = (ValueError,) + ((msgpack.UnpackException,) if msgpack else ())
 
 def load_data(filename):
-    """Load data from JSON file"""
+    """Load data from a data file using the codec for its extension
+
+    A missing file reads as {}. A file that exists but cannot be decoded
+    raises CorruptDataError instead, and pauses writes in this process,
+    so a save can never replace the history it still holds.
+    """
+    raw = STORAGE.read(filename)
+    if raw is None:
+        return {}
     try:
-        if os.path.exists(filename):
-            with open(filename, 'r') as f:
-                return json.load(f)
-    except:
-        pass
-    return {}
+        data = codec_for(filename).loads(raw)
+        if isinstance(data, list):
+            apply_journal(data, read_journal(filename)[0])
+    except CORRUPTION_ERRORS as e:
+        INTEGRITY.flag(filename, f'{filename} cannot be read: {e}')
+        raise CorruptDataError(f'{filename} is corrupt, run `flask check-data --repair`: {e}') from e
+    return data
 
 def save_data(filename, data):
-    """Save data to JSON file"""
-    with open(filename, 'w') as f:
-        json.dump(data, f, indent=2)
+    """Save data to a data file using the codec for its extension
+
+    The storage backend replaces the file atomically, so readers and
+    backups never see it half-written. The full rewrite already contains
+    every journalled change, so the file's journal is dropped afterwards.
+    """
+    STORAGE.write(filename, codec_for(filename).dumps(data))
+    STORAGE.remove(journal_file(filename))
+
+# Append-only journals for in-place record updates
+JOURNAL_COMPACT_BYTES = int(os.environ.get('JOURNAL_COMPACT_BYTES', 4 * 1024 * 1024))
+
+def read_journal(filename, offset=0):
+    """Journal entries from offset on, and the offset just past the last full line"""
+    raw = STORAGE.read_from(journal_file(filename), offset)
+    if raw is None:
+        return [], 0
+    end = raw.rfind(b'\n') + 1
+    entries = [parse_journal_entry(line) for line in raw[:end].splitlines() if line.strip()]
+    return entries, offset + end
+
+def parse_journal_entry(line):
+    """Decode one journal line, raising ValueError unless it is a field update"""
+    entry = json.loads(line)
+    if not isinstance(entry, dict) or not isinstance(entry.get('set'), dict) or 'id' not in entry:
+        raise ValueError('entry has no id or set')
+    return entry
+
+def append_journal(filename, entries):
+    """Append entries to a data file's journal with a single write"""
+    if not entries:
+        return
+    payload = b''.join(json.dumps(entry, separators=(',', ':')).encode('utf-8') + b'\n'
+                       for entry in entries)
+    STORAGE.append(journal_file(filename), payload)
+
+def apply_journal(records, entries, index=None):
+    """Apply journalled field updates to a list of records in place"""
+    if index is None:
+        index = {record.get('id'): position for position, record in enumerate(records)}
+    for entry in entries:
+        position = index.get(entry['id'])
+        if position is not None:
+            records[position].update(entry['set'])
+    return index
+
+class RecordTable:
+    """Cached records of a list data file with an id index
+
+    Only journal entries written since the last refresh are read, so a
+    refresh costs nothing unless another worker rewrote the whole file.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.stamp = None
+        self.journal_offset = 0
+        self.records = []
+        self.index = {}
+
+    def refresh(self):
+        stamp = STORAGE.stamp(self.filename)
+        if stamp != self.stamp:
+            self.stamp = stamp
+            self.records = load_data(self.filename) or []
+            self.index = {record.get('id'): position for position, record in enumerate(self.records)}
+            self.journal_offset = read_journal(self.filename)[1]
+            return
+        entries, self.journal_offset = read_journal(self.filename, self.journal_offset)
+        apply_journal(self.records, entries, self.index)
+
+    def get(self, record_id):
+        position = self.index.get(record_id)
+        return None if position is None else self.records[position]
+
+    def update(self, entries):
+        """Journal field updates and apply them, compacting a large journal"""
+        append_journal(self.filename, entries)
+        apply_journal(self.records, entries, self.index)
+        self.journal_offset = read_journal(self.filename, self.journal_offset)[1]
+        if self.journal_offset > JOURNAL_COMPACT_BYTES:
+            save_data(self.filename, self.records)
+            self.stamp = STORAGE.stamp(self.filename)
+            self.journal_offset = 0
+
+RECORD_TABLES = {}
+
+def record_table(filename):
+    if filename not in RECORD_TABLES:
+        RECORD_TABLES[filename] = RecordTable(filename)
+    return RECORD_TABLES[filename]
+
+# Thread pools for work kept off the request thread
+_executors = {}
+_executors_lock = threading.Lock()
+
+def executor(name, max_workers):
+    """Thread pool owned by the current process, recreated after a fork"""
+    key = (name, os.getpid())
+    with _executors_lock:
+        if key not in _executors:
+            # Under gevent, patched threads are greenlets; this work needs real ones
+            pool_class = NativeThreadPoolExecutor if green() else ThreadPoolExecutor
+            _executors[key] = pool_class(max_workers=max_workers, thread_name_prefix=name)
+        return _executors[key]
+
+# State shared by every worker process
+SHARED_STATE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    key TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    status_code INTEGER,
+    body BLOB,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idempotency_keys_created ON idempotency_keys (created_at);
+CREATE TABLE IF NOT EXISTS rate_buckets (
+    key TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    throttled INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS rate_limit_stats (
+    scope TEXT NOT NULL,
+    endpoint TEXT NOT NULL,
+    throttled INTEGER NOT NULL DEFAULT 0,
+    last_throttled_at REAL,
+    PRIMARY KEY (scope, endpoint)
+);
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    template TEXT NOT NULL,
+    recipient TEXT NOT NULL,
+    context TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    last_error TEXT,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at);
+CREATE TABLE IF NOT EXISTS carts (
+    id TEXT PRIMARY KEY,
+    version INTEGER NOT NULL,
+    lines TEXT NOT NULL,
+    changes TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS carts_expiry ON carts (expires_at);
+CREATE TABLE IF NOT EXISTS cart_holds (
+    cart_id TEXT NOT NULL,
+    product_id INTEGER NOT NULL,
+    quantity INTEGER NOT NULL,
+    expires_at REAL NOT NULL,
+    PRIMARY KEY (cart_id, product_id)
+);
+CREATE INDEX IF NOT EXISTS cart_holds_product ON cart_holds (product_id, expires_at);
+CREATE TABLE IF NOT EXISTS technicians (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    skills TEXT NOT NULL,
+    materials TEXT NOT NULL,
+    active INTEGER NOT NULL DEFAULT 1,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS technician_bookings (
+    request_id INTEGER PRIMARY KEY,
+    technician_id INTEGER NOT NULL,
+    start_slot INTEGER NOT NULL,
+    end_slot INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS technician_bookings_technician ON technician_bookings (technician_id, start_slot);
+CREATE TABLE IF NOT EXISTS schedule_version (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    version INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO schedule_version (id, version) VALUES (1, 0);
+CREATE TABLE IF NOT EXISTS co_purchases (
+    product_id INTEGER NOT NULL,
+    other_id INTEGER NOT NULL,
+    orders INTEGER NOT NULL,
+    version INTEGER NOT NULL,
+    PRIMARY KEY (product_id, other_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS co_purchases_version ON co_purchases (version);
+CREATE TABLE IF NOT EXISTS recommendation_state (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    last_order_id INTEGER NOT NULL,
+    version INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO recommendation_state (id, last_order_id, version) VALUES (1, 0, 0);
+CREATE TABLE IF NOT EXISTS integrity_checks (
+    file TEXT PRIMARY KEY,
+    report TEXT NOT NULL,
+    checked_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    type TEXT NOT NULL,
+    data TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+'''
+_shared_state = threading.local()
+_idle_connections = {}
+
+class GreenConnection:
+    """A SQLite connection whose statements run on the I/O pool
+
+    While another worker holds the write lock, SQLite waits out its busy
+    timeout by sleeping in C, which under gevent would stall every
+    greenlet in the process. A real thread does the waiting instead.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, *args):
+        return io_pool().apply(self.conn.execute, args)
+
+    def executemany(self, *args):
+        return io_pool().apply(self.conn.executemany, args)
+
+    def executescript(self, script):
+        return io_pool().apply(self.conn.executescript, (script,))
+
+    @property
+    def in_transaction(self):
+        return self.conn.in_transaction
+
+    def close(self):
+        self.conn.close()
+
+def shared_db():
+    """Per-thread connection to the SQLite file shared by all workers
+
+    Under gevent every request is its own greenlet, so connections are
+    lent from a per-process pool instead and returned at teardown; held
+    event streams then cost a socket each, not a database connection.
+    """
+    conn = getattr(_shared_state, 'conn', None)
+    if conn is None or _shared_state.pid != os.getpid():
+        idle = _idle_connections.get(os.getpid())
+        if idle:
+            conn = idle.pop()
+        else:
+            conn = sqlite3.connect(SHARED_STATE_FILE, timeout=10, isolation_level=None,
+                                   check_same_thread=not green())
+            if green():
+                conn = GreenConnection(conn)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(SHARED_STATE_SCHEMA)
+        _shared_state.conn = conn
+        _shared_state.pid = os.getpid()
+    return conn
+
+@app.teardown_request
+def return_shared_db(exc):
+    conn = getattr(_shared_state, 'conn', None)
+    if not green() or conn is None or _shared_state.pid != os.getpid():
+        return
+    if conn.in_transaction:
+        conn.execute('ROLLBACK')
+    _shared_state.conn = None
+    _idle_connections.setdefault(os.getpid(), []).append(conn)
+
+# Idempotency keys for retried submissions
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', 24 * 3600))
+IDEMPOTENCY_MAX_KEYS = int(os.environ.get('IDEMPOTENCY_MAX_KEYS', 50000))
+# A reservation older than this belongs to a worker that died mid-request;
+# keep it well above the worker timeout so a slow request is never taken over
+IDEMPOTENCY_LEASE = int(os.environ.get('IDEMPOTENCY_LEASE', 120))
+
+def evict_idempotency_keys(db):
+    """Drop expired keys, then the oldest ones beyond the size bound"""
+    db.execute('DELETE FROM idempotency_keys WHERE created_at < ?',
+               (time.time() - IDEMPOTENCY_TTL,))
+    db.execute('''DELETE FROM idempotency_keys WHERE key IN (
+                      SELECT key FROM idempotency_keys
+                      ORDER BY created_at DESC LIMIT -1 OFFSET ?)''',
+               (IDEMPOTENCY_MAX_KEYS,))
+
+def idempotent(view):
+    """Replay the stored response when a request repeats its Idempotency-Key
+
+    The first request with a key reserves it before running the view, so a
+    retry that races the original gets a 409 instead of a second write.
+    A reservation left by a worker that died is taken over once
+    IDEMPOTENCY_LEASE passes. Only successful responses are kept; failures
+    release the key so the client can try again.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        client_key = request.headers.get('Idempotency-Key')
+        if not client_key:
+            return view(*args, **kwargs)
+
+        key = f'{request.endpoint}:{client_key}'
+        fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+        db = shared_db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            reserved_at = time.time()
+            row = db.execute('''SELECT fingerprint, status_code, body FROM idempotency_keys
+                                WHERE key = ? AND created_at >= ?
+                                  AND (status_code IS NOT NULL OR created_at >= ?)''',
+                             (key, reserved_at - IDEMPOTENCY_TTL, reserved_at - IDEMPOTENCY_LEASE)).fetchone()
+            if row is None:
+                db.execute('''INSERT OR REPLACE INTO idempotency_keys (key, fingerprint, created_at)
+                              VALUES (?, ?, ?)''', (key, fingerprint, reserved_at))
+                evict_idempotency_keys(db)
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+
+        if row is not None:
+            stored_fingerprint, status_code, body = row
+            if stored_fingerprint != fingerprint:
+                return jsonify({'success': False,
+                                'error': 'Idempotency-Key was already used with a different request'}), 422
+            if status_code is None:
+                return jsonify({'success': False, 'error': 'A request with this Idempotency-Key is in progress'}), 409
+            response = make_response(body, status_code)
+            response.mimetype = 'application/json'
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+
+        # Matching created_at leaves alone a key another worker has taken over
+        try:
+            response = make_response(view(*args, **kwargs))
+        except Exception:
+            db.execute('DELETE FROM idempotency_keys WHERE key = ? AND created_at = ?', (key, reserved_at))
+            raise
+        result = response.get_json(silent=True) or {}
+        if response.status_code < 400 and result.get('success'):
+            db.execute('UPDATE idempotency_keys SET status_code = ?, body = ? WHERE key = ? AND created_at = ?',
+                       (response.status_code, response.get_data(), key, reserved_at))
+        else:
+            db.execute('DELETE FROM idempotency_keys WHERE key = ? AND created_at = ?', (key, reserved_at))
+        return response
+    return wrapper
+
+def after_commit(step, *args, **kwargs):
+    """Run follow-up work for a write that has been saved, logging instead of raising
+
+    Once the write is saved the request has succeeded. Failing it here
+    would make the client retry, and the retry would write a second time.
+    """
+    try:
+        step(*args, **kwargs)
+    except Exception:
+        app.logger.exception('%s failed after the write was saved', step.__name__)
+
+# Per-client token buckets for API admission control
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', '1') == '1'
+RATE_LIMITS = {
+    # scope: (bucket capacity, tokens refilled per second)
+    'read': (int(os.environ.get('RATE_LIMIT_READ_BURST', 120)),
+             float(os.environ.get('RATE_LIMIT_READ_PER_SEC', 20))),
+    'write': (int(os.environ.get('RATE_LIMIT_WRITE_BURST', 20)),
+              float(os.environ.get('RATE_LIMIT_WRITE_PER_SEC', 1))),
+}
+RATE_BUCKET_IDLE_TTL = 3600
+WRITE_METHODS = {'POST', 'PUT', 'PATCH', 'DELETE'}
+READ_ONLY_ENDPOINTS = {'create_quote', 'preview_allocation'}  # POSTs that change nothing
+API_KEYS = {key for key in os.environ.get('API_KEYS', '').split(',') if key}
+READ_THROTTLE_FLUSH_INTERVAL = 1.0
+
+def client_identity():
+    """An issued API key when the client sends one, otherwise its address
+
+    Keys not in API_KEYS are ignored; otherwise a client could dodge its
+    limit by sending a fresh key with every request.
+    """
+    api_key = request.headers.get('X-API-Key')
+    if api_key in API_KEYS:
+        return 'key:' + hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:32]
+    return 'ip:' + (request.remote_addr or 'unknown')
+
+class LocalBuckets:
+    """Read token buckets kept in this process's memory
+
+    Admitting a GET never takes SQLite's write lock, so reads in different
+    workers do not queue behind each other; the price is that a client's
+    read budget applies per worker. Throttled reads are counted here and
+    added to the shared stats at most once per READ_THROTTLE_FLUSH_INTERVAL.
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        self.throttled = {}
+        self.flushed_at = 0
+        self.lock = threading.Lock()
+
+    def take(self, key, capacity, refill_rate, now, endpoint):
+        with self.lock:
+            tokens, updated_at = self.buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated_at) * refill_rate)
+            if tokens >= 1:
+                retry_after = 0
+                tokens -= 1
+            else:
+                retry_after = (1 - tokens) / refill_rate
+                self.throttled[key, endpoint] = self.throttled.get((key, endpoint), 0) + 1
+            self.buckets[key] = (tokens, now)
+            if random.random() < 0.001:
+                self.buckets = {k: bucket for k, bucket in self.buckets.items()
+                                if bucket[1] >= now - RATE_BUCKET_IDLE_TTL}
+            return retry_after
+
+    def drain(self, now):
+        """Throttle counts not yet recorded, once the flush interval has passed"""
+        with self.lock:
+            if not self.throttled or now - self.flushed_at < READ_THROTTLE_FLUSH_INTERVAL:
+                return {}
+            throttled, self.throttled, self.flushed_at = self.throttled, {}, now
+            return throttled
+
+READ_BUCKETS = LocalBuckets()
+
+def record_read_throttles(now):
+    throttled = READ_BUCKETS.drain(now)
+    if not throttled:
+        return
+    db = shared_db()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        for (key, endpoint), count in throttled.items():
+            db.execute('''INSERT INTO rate_buckets (key, tokens, updated_at, throttled) VALUES (?, 0, ?, ?)
+                          ON CONFLICT(key) DO UPDATE SET throttled = throttled + excluded.throttled,
+                                                         updated_at = excluded.updated_at''',
+                       (key, now, count))
+            db.execute('''INSERT INTO rate_limit_stats (scope, endpoint, throttled, last_throttled_at)
+                          VALUES ('read', ?, ?, ?)
+                          ON CONFLICT(scope, endpoint) DO UPDATE SET
+                              throttled = throttled + excluded.throttled,
+                              last_throttled_at = excluded.last_throttled_at''',
+                       (endpoint, count, now))
+        db.execute('COMMIT')
+    except Exception:
+        db.execute('ROLLBACK')
+        raise
+
+def take_token(scope, client):
+    """Take one token from the client's bucket, returning seconds to wait if empty"""
+    capacity, refill_rate = RATE_LIMITS[scope]
+    key = f'{scope}:{client}'
+    now = time.time()
+    if scope == 'read':
+        retry_after = READ_BUCKETS.take(key, capacity, refill_rate, now, request.endpoint or request.path)
+        record_read_throttles(now)
+        return retry_after
+    db = shared_db()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        row = db.execute('SELECT tokens, updated_at FROM rate_buckets WHERE key = ?', (key,)).fetchone()
+        tokens = capacity if row is None else min(capacity, row[0] + (now - row[1]) * refill_rate)
+        if tokens >= 1:
+            retry_after = 0
+            tokens -= 1
+            db.execute('''INSERT INTO rate_buckets (key, tokens, updated_at) VALUES (?, ?, ?)
+                          ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens,
+                                                         updated_at = excluded.updated_at''',
+                       (key, tokens, now))
+        else:
+            retry_after = (1 - tokens) / refill_rate
+            db.execute('''UPDATE rate_buckets SET tokens = ?, updated_at = ?, throttled = throttled + 1
+                          WHERE key = ?''', (tokens, now, key))
+            db.execute('''INSERT INTO rate_limit_stats (scope, endpoint, throttled, last_throttled_at)
+                          VALUES (?, ?, 1, ?)
+                          ON CONFLICT(scope, endpoint) DO UPDATE SET
+                              throttled = throttled + 1, last_throttled_at = excluded.last_throttled_at''',
+                       (scope, request.endpoint or request.path, now))
+        if random.random() < 0.001:
+            db.execute('DELETE FROM rate_buckets WHERE updated_at < ?', (now - RATE_BUCKET_IDLE_TTL,))
+        db.execute('COMMIT')
+    except Exception:
+        db.execute('ROLLBACK')
+        raise
+    return retry_after
+
+@app.before_request
+def admission_control():
+    """Throttle API clients that exhaust their read or write budget"""
+    if not RATE_LIMIT_ENABLED or not request.path.startswith('/api/'):
+        return None
+    writes = request.method in WRITE_METHODS and request.endpoint not in READ_ONLY_ENDPOINTS
+    scope = 'write' if writes else 'read'
+    retry_after = take_token(scope, client_identity())
+    if retry_after:
+        response = jsonify({'success': False, 'error': 'Too many requests, please slow down'})
+        response.status_code = 429
+        response.headers['Retry-After'] = str(math.ceil(retry_after))
+        return response
+    return None
+
+# Change feed for the admin dashboard
+EVENT_RETENTION = int(os.environ.get('EVENT_RETENTION', 24 * 3600))
+EVENT_POLL_INTERVAL = 0.5
+EVENT_HEARTBEAT = 15
+EVENT_QUEUE_SIZE = 1000
+
+class Subscriber(queue.Queue):
+    """Queue of events for one stream, flagged once it falls too far behind"""
+    dropped = False
+
+class EventBroker:
+    """Fans committed changes out to every event stream in this process
+
+    Events are appended to the shared events table, so changes made by any
+    worker reach every dashboard. One thread per process tails the table
+    and copies new rows onto the subscribers' queues; a subscriber that
+    falls too far behind is dropped and reconnects with Last-Event-ID.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.subscribers = set()
+        self.last_id = 0
+        self.pid = None
+
+    def subscribe(self, last_event_id=None):
+        subscriber = Subscriber(maxsize=EVENT_QUEUE_SIZE)
+        with self.lock:
+            self._ensure_thread()
+            if not self.subscribers:
+                # The tail thread idles without subscribers; start a fresh stream from now
+                self.last_id = max(self.last_id, self._max_id(shared_db()))
+            if last_event_id is not None:
+                for row in shared_db().execute(
+                        'SELECT id, type, data FROM events WHERE id > ? AND id <= ? ORDER BY id LIMIT ?',
+                        (last_event_id, self.last_id, EVENT_QUEUE_SIZE)):
+                    subscriber.put_nowait(row)
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def _ensure_thread(self):
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.subscribers = set()
+        self.last_id = self._max_id(shared_db())
+        threading.Thread(target=self._run, name='event-broker', daemon=True).start()
+
+    @staticmethod
+    def _max_id(db):
+        return db.execute('SELECT MAX(id) FROM events').fetchone()[0] or 0
+
+    def _run(self):
+        db = shared_db()
+        last_cleanup = 0
+        while True:
+            self.wake.wait(EVENT_POLL_INTERVAL)
+            self.wake.clear()
+            if time.time() - last_cleanup > 60:
+                db.execute('DELETE FROM events WHERE created_at < ?', (time.time() - EVENT_RETENTION,))
+                last_cleanup = time.time()
+            if not self.subscribers:
+                # Skip what nobody is listening to, so it is not replayed to the next dashboard
+                with self.lock:
+                    self.last_id = max(self.last_id, self._max_id(db))
+                continue
+            rows = db.execute('SELECT id, type, data FROM events WHERE id > ? ORDER BY id LIMIT 500',
+                              (self.last_id,)).fetchall()
+            with self.lock:
+                # A subscribe may have moved last_id past some of these meanwhile
+                rows = [row for row in rows if row[0] > self.last_id]
+                if not rows:
+                    continue
+                self.last_id = rows[-1][0]
+                for subscriber in list(self.subscribers):
+                    try:
+                        for row in rows:
+                            subscriber.put_nowait(row)
+                    except queue.Full:
+                        subscriber.dropped = True
+                        self.subscribers.discard(subscriber)
+
+EVENT_BROKER = EventBroker()
+
+def publish_event(event_type, data):
+    """Record a committed change for the dashboards' event streams"""
+    publish_events(event_type, [data])
+
+def publish_events(event_type, records):
+    """Record several changes of one type in a single transaction"""
+    now = time.time()
+    db = shared_db()
+    db.execute('BEGIN')
+    db.executemany('INSERT INTO events (type, data, created_at) VALUES (?, ?, ?)',
+                   [(event_type, json.dumps(data, default=str), now) for data in records])
+    db.execute('COMMIT')
+    EVENT_BROKER.wake.set()
+
+# Email notifications, sent from a persistent outbox by a background thread
+NOTIFICATION_TEMPLATES = {
+    'order_confirmation': (
+        'Your PipeDrill Pro order #{{ order.id }}',
+        '''Thank you for your order!
+
+Order #{{ order.id }} placed {{ order.timestamp[:10] }}
+{% for item in order['items'] %}  {{ item.quantity or 1 }} x {{ item.name }}
+{% endfor %}
+Total: ${{ '%.2f' % order.total }}
+
+We will let you know when it ships.
+'''),
+    'booking_acknowledgement': (
+        'We received your {{ request.service_type }} request',
+        '''Hi {{ request.contact_name }},
+
+We received your service request #{{ request.id }} for {{ request.service_type }}
+on {{ request.pipe_material }} pipe ({{ request.pipe_diameter }}" diameter,
+about {{ request.estimated_hours }} hours). A technician will contact you
+at {{ request.contact_phone }} to confirm the booking.
+'''),
+    'admin_alert': (
+        '[PipeDrill] {{ subject }}',
+        '''{{ subject }}
+
+{% for key, value in details.items() %}{{ key }}: {{ value }}
+{% endfor %}'''),
+}
+NOTIFICATION_BATCH_SIZE = 50
+NOTIFICATION_MAX_ATTEMPTS = 8
+NOTIFICATION_RETRY_BASE = 30
+NOTIFICATION_LEASE = 300
+NOTIFICATION_POLL_INTERVAL = 5
+
+_compiled_templates = {}
+# Emails are plain text, so nothing in them may be HTML-escaped
+_text_templates = Environment(autoescape=False)
+_notification_wake = threading.Event()
+_notification_worker_pid = None
+
+def notification_template(name):
+    """Subject and body templates, compiled on first use and cached"""
+    if name not in _compiled_templates:
+        subject, body = NOTIFICATION_TEMPLATES[name]
+        _compiled_templates[name] = (_text_templates.from_string(subject),
+                                     _text_templates.from_string(body))
+    return _compiled_templates[name]
+
+def notify(template, recipient, **context):
+    """Queue an email; the request never waits on SMTP"""
+    if not app.config['MAIL_SERVER'] or not recipient:
+        return
+    now = time.time()
+    shared_db().execute(
+        'INSERT INTO outbox (template, recipient, context, next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?)',
+        (template, recipient, json.dumps(context, default=str), now, now))
+    start_notification_worker()
+    _notification_wake.set()
+
+def notify_admin(subject, **details):
+    notify('admin_alert', ADMIN_EMAIL, subject=subject, details=details)
+
+def start_notification_worker():
+    global _notification_worker_pid
+    if _notification_worker_pid == os.getpid():
+        return
+    _notification_worker_pid = os.getpid()
+    threading.Thread(target=notification_worker, name='notifications', daemon=True).start()
+
+def claim_notifications(db):
+    """Lease a batch of due messages so no other worker sends them too"""
+    now = time.time()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        rows = db.execute(
+            '''SELECT id, template, recipient, context, attempts FROM outbox
+               WHERE (status = 'queued' AND next_attempt_at <= ?) OR (status = 'sending' AND next_attempt_at <= ?)
+               ORDER BY next_attempt_at LIMIT ?''',
+            (now, now, NOTIFICATION_BATCH_SIZE)).fetchall()
+        db.executemany("UPDATE outbox SET status = 'sending', next_attempt_at = ? WHERE id = ?",
+                       [(now + NOTIFICATION_LEASE, row[0]) for row in rows])
+        db.execute('COMMIT')
+    except Exception:
+        db.execute('ROLLBACK')
+        raise
+    return rows
+
+def send_notifications(db):
+    """Send one batch over a single SMTP connection, returning how many were sent"""
+    rows = claim_notifications(db)
+    if not rows:
+        return 0
+    pending = {row[0]: row for row in rows}
+    sent = 0
+    with app.app_context():
+        try:
+            with mail.connect() as connection:
+                for message_id, template, recipient, context, attempts in rows:
+                    row = pending.pop(message_id)
+                    try:
+                        subject, body = notification_template(template)
+                        context = json.loads(context)
+                        connection.send(Message(subject.render(**context).strip(),
+                                                recipients=[recipient], body=body.render(**context)))
+                    except smtplib.SMTPServerDisconnected:
+                        pending[message_id] = row
+                        raise
+                    except Exception as e:
+                        retry_notification(db, row, e)
+                        continue
+                    db.execute("UPDATE outbox SET status = 'sent', attempts = attempts + 1 WHERE id = ?",
+                               (message_id,))
+                    sent += 1
+        except Exception as e:
+            # The connection itself failed; everything not yet sent is retried
+            for row in pending.values():
+                retry_notification(db, row, e)
+    return sent
+
+def retry_notification(db, row, error):
+    """Back off exponentially, giving up after NOTIFICATION_MAX_ATTEMPTS"""
+    message_id, attempts = row[0], row[4] + 1
+    status = 'failed' if attempts >= NOTIFICATION_MAX_ATTEMPTS else 'queued'
+    delay = NOTIFICATION_RETRY_BASE * 2 ** (attempts - 1)
+    db.execute('UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?',
+               (status, attempts, time.time() + delay, str(error), message_id))
+
+def notification_worker():
+    db = shared_db()
+    while True:
+        try:
+            while send_notifications(db):
+                pass
+        except Exception as e:
+            app.logger.warning('Notification worker error: %s', e)
+        _notification_wake.wait(NOTIFICATION_POLL_INTERVAL)
+        _notification_wake.clear()
+
+@app.before_request
+def resume_notifications():
+    """Pick up mail left in the outbox by a previous process"""
+    if app.config['MAIL_SERVER']:
+        start_notification_worker()
+
+# Catalog cache, reloaded when the catalog file changes on disk
+CATALOG_POLL_INTERVAL = float(os.environ.get('CATALOG_POLL_INTERVAL', 1.0))
+
+class CatalogSnapshot:
+    """A validated, read-only view of the catalog file
+
+    Snapshots are replaced, never modified, so a request keeps a consistent
+    catalog even while a reload publishes a new one. Values derived from
+    the catalog are memoized on the snapshot and die with it.
+    """
+
+    def __init__(self, data, version):
+        self.data = data
+        self.version = version
+        self.products = data.get('products', [])
+        self.services = data.get('services', [])
+        self.products_by_id = {p['id']: p for p in self.products}
+        self.services_by_id = {s['id']: s for s in self.services}
+        self.locations = catalog_locations(data)
+        self.locations_by_id = {l['id']: l for l in self.locations}
+        self.loaded_at = time.time()
+        self._memo = {}
+        self._memo_lock = threading.Lock()
+
+    def memo(self, key, build):
+        if key not in self._memo:
+            with self._memo_lock:
+                if key not in self._memo:
+                    self._memo[key] = build()
+        return self._memo[key]
+
+def validate_catalog(data):
+    """Raise ValueError unless data looks like a usable catalog"""
+    if not isinstance(data, dict) or not isinstance(data.get('products'), list):
+        raise ValueError('catalog must be an object with a products list')
+    if not isinstance(catalog_locations(data), list):
+        raise ValueError('locations must be a list')
+    location_ids = set()
+    for location in catalog_locations(data):
+        if not isinstance(location, dict) or not isinstance(location.get('id'), str) or not location['id']:
+            raise ValueError(f'location without a string id: {location!r:.80}')
+        if location['id'] in location_ids:
+            raise ValueError(f"duplicate location id {location['id']!r}")
+        location_ids.add(location['id'])
+        if any(not isinstance(location.get(field, 0), (int, float)) for field in ('lat', 'lon', 'unit_cost')):
+            raise ValueError(f"location {location['id']!r} has invalid coordinates or unit_cost")
+    seen = set()
+    for product in data['products']:
+        if not isinstance(product, dict) or not isinstance(product.get('id'), int):
+            raise ValueError(f'product without an integer id: {product!r:.80}')
+        if product['id'] in seen:
+            raise ValueError(f"duplicate product id {product['id']}")
+        seen.add(product['id'])
+        if not isinstance(product.get('name'), str):
+            raise ValueError(f"product {product['id']} has no name")
+        if not isinstance(product.get('price'), (int, float)) or product['price'] < 0:
+            raise ValueError(f"product {product['id']} has an invalid price")
+        if not isinstance(product.get('stock', 0), int) or product.get('stock', 0) < 0:
+            raise ValueError(f"product {product['id']} has an invalid stock count")
+        stocks = product.get('stock_by_location')
+        if stocks is None:
+            if product.get('stock') and DEFAULT_LOCATION not in location_ids:
+                raise ValueError(f"product {product['id']} has stock but no stock_by_location")
+        elif (not isinstance(stocks, dict) or set(stocks) - location_ids
+              or any(not isinstance(units, int) or units < 0 for units in stocks.values())):
+            raise ValueError(f"product {product['id']} has an invalid stock_by_location")
+        elif sum(stocks.values()) != product.get('stock', 0):
+            raise ValueError(f"product {product['id']} stock does not match its stock_by_location")
+    for service in data.get('services', []):
+        if not isinstance(service, dict) or not isinstance(service.get('id'), int):
+            raise ValueError(f'service without an integer id: {service!r:.80}')
+        if not isinstance(service.get('hourly_rate'), (int, float)):
+            raise ValueError(f"service {service['id']} has an invalid hourly_rate")
+
+def save_catalog(products_data):
+    """Save the catalog, refusing one that other workers would reject on reload"""
+    validate_catalog(products_data)
+    save_data(PRODUCTS_FILE, products_data)
+
+class CatalogCache:
+    """Holds the current catalog snapshot and the thread that keeps it fresh"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.snapshot = None
+        self.error = None
+        self.rejected_version = None
+        self.lock = threading.Lock()
+        self.watcher_pid = None
+
+    def current(self):
+        # No threads during startup: a gunicorn master is about to fork
+        if self.watcher_pid != os.getpid() and not STARTUP.running:
+            self.start_watcher()
+        if self.snapshot is None:
+            with self.lock:
+                if self.snapshot is None:
+                    self.reload()
+        return self.snapshot
+
+    def publish(self, data):
+        """Install a catalog this process has just written"""
+        with self.lock:
+            self.snapshot = CatalogSnapshot(data, STORAGE.stamp(self.filename))
+            self.error = None
+
+    def reload(self):
+        """Parse and validate the file, keeping the old snapshot if it is bad"""
+        try:
+            version = STORAGE.stamp(self.filename)
+            if self.snapshot is not None and version in (self.snapshot.version, self.rejected_version):
+                return False
+            raw = STORAGE.read(self.filename)
+        except StorageError as e:
+            return self.keep_previous('storage is unavailable', e)
+        try:
+            data = codec_for(self.filename).loads(raw)
+            validate_catalog(data)
+        except Exception as e:
+            self.rejected_version = version
+            return self.keep_previous(f'{self.filename} is invalid', e)
+        self.snapshot = CatalogSnapshot(data, version)
+        self.error = None
+        return True
+
+    def keep_previous(self, reason, error):
+        self.error = f'{datetime.now().isoformat()}: {error}'
+        app.logger.warning('Keeping the previous catalog, %s: %s', reason, error)
+        if self.snapshot is None:
+            self.snapshot = CatalogSnapshot({'products': [], 'services': []}, None)
+        return False
+
+    def start_watcher(self):
+        with self.lock:
+            if self.watcher_pid == os.getpid():
+                return
+            self.watcher_pid = os.getpid()
+            threading.Thread(target=self.watch, name='catalog-watcher', daemon=True).start()
+
+    def watch(self):
+        try:
+            changes = STORAGE.watch(self.filename)
+            # Catch anything written before the watch was in place
+            with self.lock:
+                self.reload()
+            for _ in changes:
+                with self.lock:
+                    self.reload()
+        except OSError as e:
+            app.logger.info('Change notifications unavailable (%s), polling %s instead', e, self.filename)
+        while True:
+            time.sleep(CATALOG_POLL_INTERVAL)
+            with self.lock:
+                self.reload()
+
+CATALOG = CatalogCache(PRODUCTS_FILE)
+
+def current_catalog():
+    return CATALOG.current()
+
+# Low-stock index: products ordered by stock minus reorder threshold
+DEFAULT_REORDER_THRESHOLD = int(os.environ.get('DEFAULT_REORDER_THRESHOLD', 10))
+
+def reorder_threshold(product):
+    return product.get('reorder_threshold', DEFAULT_REORDER_THRESHOLD)
+
+class StockIndex:
+    """Sorted (stock - threshold, id) pairs, kept current on every stock change
+
+    Products at or below their threshold sit at the front of the list, so
+    listing them costs O(k). The index is rebuilt only when the catalog was
+    replaced by something other than this process's own stock updates.
+    """
+
+    def __init__(self):
+        self.entries = []
+        self.items = {}
+        self.version = None
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        catalog = current_catalog()
+        if catalog.version == self.version:
+            return
+        with self.lock:
+            self.items = {p['id']: self._item(p) for p in catalog.products}
+            self.entries = sorted((item['margin'], product_id) for product_id, item in self.items.items())
+            self.version = catalog.version
+
+    def _item(self, product):
+        stock = product.get('stock', 0)
+        threshold = reorder_threshold(product)
+        return {'id': product['id'], 'name': product.get('name'), 'stock': stock,
+                'reorder_threshold': threshold, 'margin': stock - threshold}
+
+    def update(self, product):
+        """Re-index one product, returning (was_low, is_low)"""
+        with self.lock:
+            was_low = self._remove(product['id'])
+            item = self._item(product)
+            self.items[product['id']] = item
+            bisect.insort(self.entries, (item['margin'], product['id']))
+            self.version = current_catalog().version
+            return was_low, item['margin'] <= 0
+
+    def remove(self, product_id):
+        with self.lock:
+            self._remove(product_id)
+            self.version = current_catalog().version
+
+    def _remove(self, product_id):
+        item = self.items.pop(product_id, None)
+        if item is None:
+            return False
+        position = bisect.bisect_left(self.entries, (item['margin'], product_id))
+        del self.entries[position]
+        return item['margin'] <= 0
+
+    def low(self, limit=None):
+        with self.lock:
+            end = bisect.bisect_right(self.entries, (0, float('inf')))
+            if limit is not None:
+                end = min(end, limit)
+            return [self.items[product_id] for _, product_id in self.entries[:end]]
+
+STOCK_INDEX = StockIndex()
+
+def stock_changed(product):
+    """Update the stock indexes and announce threshold crossings"""
+    LOCATION_STOCK.update(product)
+    was_low, is_low = STOCK_INDEX.update(product)
+    if is_low and not was_low:
+        publish_event('product.low_stock', STOCK_INDEX.items[product['id']])
+        notify_admin(f"Low stock: {product.get('name')}", stock=product.get('stock'),
+                     reorder_threshold=reorder_threshold(product))
+    elif was_low and not is_low:
+        publish_event('product.restocked', STOCK_INDEX.items[product['id']])
+
+# Multi-location inventory: stock held per yard, summed into each product's stock.
+# product['stock'] stays the cached total the catalog view and carts read, and
+# every per-yard change applies its delta to it. A catalog without locations
+# has one implicit yard, and a product without stock_by_location keeps all of
+# its stock there.
+DEFAULT_LOCATION = os.environ.get('DEFAULT_LOCATION', 'main')
+EARTH_RADIUS_KM = 6371.0
+SHIPPING_COST_PER_KM = float(os.environ.get('SHIPPING_COST_PER_KM', 0.002))
+ALLOCATION_STRATEGIES = ('nearest', 'cost')
+LOCATION_FIELDS = ('id', 'name', 'lat', 'lon', 'unit_cost')
+
+def catalog_locations(data):
+    return data.get('locations') or [{'id': DEFAULT_LOCATION, 'name': 'Main yard'}]
+
+def stock_by_location(product):
+    """{location id: units} for a product; read it, never modify it"""
+    stocks = product.get('stock_by_location')
+    if stocks is not None:
+        return stocks
+    return {DEFAULT_LOCATION: product['stock']} if product.get('stock') else {}
+
+def set_location_stock(product, location_id, quantity):
+    """Set one yard's stock and move the product's total by the difference"""
+    stocks = dict(stock_by_location(product))
+    delta = quantity - stocks.get(location_id, 0)
+    if quantity:
+        stocks[location_id] = quantity
+    else:
+        stocks.pop(location_id, None)
+    product['stock_by_location'] = stocks
+    product['stock'] = product.get('stock', 0) + delta
+
+def distance_km(location, destination):
+    """Great-circle distance, 0 without a destination, None if the yard has no coordinates"""
+    if destination is None:
+        return 0
+    if not isinstance(location.get('lat'), (int, float)) or not isinstance(location.get('lon'), (int, float)):
+        return None
+    lat1, lon1, lat2, lon2 = map(math.radians, (location['lat'], location['lon'], *destination))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+def rank_locations(locations, destination=None, strategy='nearest'):
+    """Location ids, best first
+
+    'nearest' orders by distance to the destination; 'cost' by the yard's
+    unit_cost plus SHIPPING_COST_PER_KM per km. Yards without coordinates
+    come last, and ties keep catalog order, so the first yard is the default.
+    """
+    def key(position):
+        location = locations[position]
+        distance = distance_km(location, destination)
+        cost = location.get('unit_cost', 0) + SHIPPING_COST_PER_KM * (distance or 0)
+        return (distance is None, cost if strategy == 'cost' else distance or 0, position)
+    return [locations[position]['id'] for position in sorted(range(len(locations)), key=key)]
+
+def fulfillment_request(data):
+    """(destination, strategy) from an order or allocation request body"""
+    strategy = data.get('fulfillment', 'nearest')
+    if strategy not in ALLOCATION_STRATEGIES:
+        raise ValueError(f'fulfillment must be one of {list(ALLOCATION_STRATEGIES)}')
+    ship_to = data.get('ship_to')
+    if ship_to is None:
+        return None, strategy
+    if not isinstance(ship_to, dict) or not all(isinstance(ship_to.get(k), (int, float)) for k in ('lat', 'lon')):
+        raise ValueError('ship_to needs numeric lat and lon')
+    return (ship_to['lat'], ship_to['lon']), strategy
+
+def order_lines(items, products_by_id):
+    """{product id: quantity} for the catalog products among order items
+
+    Items that are not catalog products, like quoted custom work, are left
+    out: they have no stock to allocate.
+    """
+    lines = {}
+    for item in items:
+        if not isinstance(item, dict) or not isinstance(item.get('id'), int) or item['id'] not in products_by_id:
+            continue
+        quantity = item.get('quantity', 1)
+        if not isinstance(quantity, int) or quantity < 1:
+            raise ValueError(f"Invalid quantity for product {item['id']}")
+        lines[item['id']] = lines.get(item['id'], 0) + quantity
+    return lines
+
+def allocate(lines, products_by_id, locations, destination=None, strategy='nearest'):
+    """Split order lines across yards as [{'location', 'items': [{'id', 'quantity'}]}]
+
+    The best-ranked yard that can ship every line wins, so an order goes
+    out in one shipment whenever it can; otherwise each line is filled from
+    the best-ranked yards that hold it. Raises CartConflict on a shortage.
+    """
+    for product_id, quantity in lines.items():
+        product = products_by_id[product_id]
+        if product.get('stock', 0) < quantity:
+            raise CartConflict(f"Only {product.get('stock', 0)} of {product.get('name')} in stock",
+                               product_id, product.get('stock', 0))
+    ranked = rank_locations(locations, destination, strategy)
+    for location_id in ranked:
+        if all(stock_by_location(products_by_id[product_id]).get(location_id, 0) >= quantity
+               for product_id, quantity in lines.items()):
+            return [{'location': location_id,
+                     'items': [{'id': product_id, 'quantity': quantity} for product_id, quantity in lines.items()]}]
+    plan = {}
+    for product_id, quantity in lines.items():
+        stocks = stock_by_location(products_by_id[product_id])
+        for location_id in ranked:
+            take = min(quantity, stocks.get(location_id, 0))
+            if take:
+                plan.setdefault(location_id, []).append({'id': product_id, 'quantity': take})
+                quantity -= take
+            if not quantity:
+                break
+    return [{'location': location_id, 'items': plan[location_id]} for location_id in ranked if location_id in plan]
+
+def apply_allocations(products_data, allocations, sign):
+    """Take (sign=-1) or return (sign=1) allocated stock, returning the products changed
+
+    Stock returned to a yard that has since been removed goes to the first yard.
+    """
+    products_by_id = {p['id']: p for p in products_data.get('products', [])}
+    known = {location['id'] for location in catalog_locations(products_data)}
+    changed = {}
+    for allocation in allocations:
+        location_id = allocation['location']
+        if location_id not in known:
+            location_id = catalog_locations(products_data)[0]['id']
+        for item in allocation['items']:
+            product = products_by_id.get(item['id'])
+            if product is None:
+                continue
+            stock = stock_by_location(product).get(location_id, 0) + sign * item['quantity']
+            if stock < 0:
+                raise CartConflict(f"Only {product.get('stock', 0)} of {product.get('name')} in stock",
+                                   product['id'], product.get('stock', 0))
+            set_location_stock(product, location_id, stock)
+            changed[product['id']] = product
+    return list(changed.values())
+
+def inventory_changed(products_data, changed):
+    """Publish a catalog whose stock this process changed, updating the stock indexes"""
+    CATALOG.publish(products_data)
+    for product in changed:
+        stock_changed(product)
+        FACETS.update(product)
+
+def restock_orders(orders):
+    """Return cancelled orders' stock to the yards it was allocated from"""
+    allocations = [allocation for order in orders for allocation in order.get('allocations', [])]
+    if not allocations:
+        return
+    with data_lock(PRODUCTS_FILE):
+        STOCK_INDEX.refresh()
+        FACETS.refresh()
+        LOCATION_STOCK.refresh()
+        products_data = load_data(PRODUCTS_FILE)
+        changed = apply_allocations(products_data, allocations, 1)
+        save_catalog(products_data)
+        inventory_changed(products_data, changed)
+    publish_events('product.updated', changed)
+
+class LocationStockIndex:
+    """{product id: units} for every yard, kept current on every stock change
+
+    Listing what a yard holds costs O(k) and per-yard totals are kept as
+    running sums. Like StockIndex, the index is rebuilt only when the
+    catalog was replaced by something other than this process's own updates.
+    """
+
+    def __init__(self):
+        self.stock = {}
+        self.units = {}
+        self.indexed = {}
+        self.version = None
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        catalog = current_catalog()
+        if catalog.version == self.version:
+            return
+        with self.lock:
+            self.stock, self.units, self.indexed = {}, {}, {}
+            for product in catalog.products:
+                self._add(product)
+            self.version = catalog.version
+
+    def _add(self, product):
+        stocks = dict(stock_by_location(product))
+        self.indexed[product['id']] = stocks
+        for location_id, units in stocks.items():
+            self.stock.setdefault(location_id, {})[product['id']] = units
+            self.units[location_id] = self.units.get(location_id, 0) + units
+
+    def _remove(self, product_id):
+        for location_id, units in self.indexed.pop(product_id, {}).items():
+            del self.stock[location_id][product_id]
+            self.units[location_id] -= units
+
+    def update(self, product):
+        with self.lock:
+            self._remove(product['id'])
+            self._add(product)
+            self.version = current_catalog().version
+
+    def remove(self, product_id):
+        with self.lock:
+            self._remove(product_id)
+            self.version = current_catalog().version
+
+    def at(self, location_id):
+        with self.lock:
+            return dict(self.stock.get(location_id, {}))
+
+    def totals(self, location_id):
+        with self.lock:
+            return {'products': len(self.stock.get(location_id, ())), 'units': self.units.get(location_id, 0)}
+
+LOCATION_STOCK = LocationStockIndex()
+
+# Product facets: bitsets over catalog positions, kept current on every product change
+PRICE_BANDS = (50, 250, 1000)
+FACET_NAMES = ('category', 'material', 'price_band')
+SEARCH_CACHE_SIZE = 256
+
+def price_band(price):
+    position = bisect.bisect_right(PRICE_BANDS, price)
+    if position == 0:
+        return f'under-{PRICE_BANDS[0]}'
+    if position == len(PRICE_BANDS):
+        return f'{PRICE_BANDS[-1]}-plus'
+    return f'{PRICE_BANDS[position - 1]}-{PRICE_BANDS[position]}'
+
+def facet_values(product):
+    """The value a product is counted under for each facet it has"""
+    values = {
+        'category': product.get('category'),
+        'material': (product.get('specs') or {}).get('material'),
+        'price_band': price_band(product['price']) if isinstance(product.get('price'), (int, float)) else None,
+    }
+    return {facet: value for facet, value in values.items() if isinstance(value, str) and value}
+
+class FacetIndex:
+    """Per-value bitsets over product slots, so queries cost O(facet values)
+
+    Each product owns one bit, in catalog order. Every facet value keeps an
+    int with the bits of the products that carry it, and one more int
+    marks the products in stock, so a filtered query is a few ANDs and each
+    count is a popcount. Like StockIndex, the bitsets are rebuilt only when
+    the catalog was replaced by something other than this process's own
+    product updates.
+    """
+
+    def __init__(self):
+        self.version = None
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.slots = {}
+        self.products = []
+        self.text = []
+        self.searches = {}
+        self.values = {}
+        self.bits = {facet: {} for facet in FACET_NAMES}
+        self.live = 0
+        self.in_stock = 0
+
+    def refresh(self):
+        catalog = current_catalog()
+        if catalog.version == self.version:
+            return
+        with self.lock:
+            self._reset()
+            for product in catalog.products:
+                self._add(product)
+            self.version = catalog.version
+
+    def _add(self, product):
+        slot = len(self.products)
+        self.slots[product['id']] = slot
+        self.products.append(product)
+        self.text.append('')
+        self.live |= 1 << slot
+        self._set_bits(product, slot)
+
+    def _set_bits(self, product, slot):
+        bit = 1 << slot
+        if product.get('stock', 0) > 0:
+            self.in_stock |= bit
+        self.text[slot] = ' '.join(str(product.get(field) or '') for field in ('name', 'description', 'category')).lower()
+        self.searches.clear()
+        self.values[product['id']] = facet_values(product)
+        for facet, value in self.values[product['id']].items():
+            self.bits[facet][value] = self.bits[facet].get(value, 0) | bit
+
+    def _clear_bits(self, product_id, slot):
+        bit = 1 << slot
+        self.in_stock &= ~bit
+        self.text[slot] = ''
+        self.searches.clear()
+        for facet, value in self.values.pop(product_id, {}).items():
+            remaining = self.bits[facet][value] & ~bit
+            if remaining:
+                self.bits[facet][value] = remaining
+            else:
+                del self.bits[facet][value]
+
+    def update(self, product):
+        """Index a new or changed product, keeping its place in the ordering"""
+        with self.lock:
+            slot = self.slots.get(product['id'])
+            if slot is None:
+                self._add(product)
+            else:
+                self._clear_bits(product['id'], slot)
+                self.products[slot] = product
+                self._set_bits(product, slot)
+            self.version = current_catalog().version
+
+    def remove(self, product_id):
+        with self.lock:
+            slot = self.slots.pop(product_id, None)
+            if slot is not None:
+                self._clear_bits(product_id, slot)
+                self.products[slot] = None
+                self.live &= ~(1 << slot)
+            self.version = current_catalog().version
+
+    def _search(self, term):
+        """Bitset of products whose name, description or category contains term"""
+        if term not in self.searches:
+            if len(self.searches) >= SEARCH_CACHE_SIZE:
+                self.searches.clear()
+            bits = bytearray((len(self.text) + 7) // 8)
+            for slot, text in enumerate(self.text):
+                if term in text:
+                    bits[slot >> 3] |= 1 << (slot & 7)
+            self.searches[term] = int.from_bytes(bits, 'little')
+        return self.searches[term]
+
+    def query(self, filters, in_stock=False, search=None, offset=0, limit=None):
+        """Products matching every facet filter, and counts per facet value
+
+        filters maps a facet to the values it accepts. Each facet is counted
+        with its own filter left out, so the counts show what picking another
+        value of that facet would return. A search term narrows both.
+        """
+        with self.lock:
+            base = self.live & self.in_stock if in_stock else self.live
+            if search:
+                base &= self._search(search.lower())
+            masks = {}
+            for facet, accepted in filters.items():
+                masks[facet] = 0
+                for value in accepted:
+                    masks[facet] |= self.bits[facet].get(value, 0)
+            matches = base
+            for mask in masks.values():
+                matches &= mask
+            facets = {}
+            for facet in FACET_NAMES:
+                scope = base
+                for other, mask in masks.items():
+                    if other != facet:
+                        scope &= mask
+                facets[facet] = {value: {'count': (bits & scope).bit_count(),
+                                         'in_stock': (bits & scope & self.in_stock).bit_count()}
+                                 for value, bits in sorted(self.bits[facet].items())}
+            return {'products': self._page(matches, offset, limit), 'total': matches.bit_count(),
+                    'in_stock': (matches & self.in_stock).bit_count(), 'facets': facets}
+
+    def _page(self, matches, offset, limit):
+        """Products for the set bits of matches, skipping whole bytes up to offset"""
+        page, position = [], 0
+        raw = matches.to_bytes((matches.bit_length() + 7) // 8, 'little')
+        for index, byte in enumerate(raw):
+            if not byte:
+                continue
+            count = byte.bit_count()
+            if position + count <= offset:
+                position += count
+                continue
+            for bit in range(8):
+                if byte >> bit & 1:
+                    if position >= offset:
+                        if limit is not None and len(page) >= limit:
+                            return page
+                        page.append(self.products[index * 8 + bit])
+                    position += 1
+        return page
+
+FACETS = FacetIndex()
+
+# Server-side carts, shared by every device that knows the cart id. Carts and
+# their stock holds live in this node's shared SQLite state, which a storage
+# server does not share: they only work when every request for a cart reaches
+# one node. With several nodes, a cart opened on one is not found on another,
+# and its holds do not count against the stock the others offer.
+CART_TTL = int(os.environ.get('CART_TTL', 30 * 24 * 3600))
+CART_HOLD_SECONDS = int(os.environ.get('CART_HOLD_SECONDS', 30 * 60))
+CART_CHANGE_LOG = 200
+MAX_CART_QUANTITY = 10000
+TAX_RATE = Decimal(os.environ.get('TAX_RATE', '0.08'))
+
+class CartConflict(Exception):
+    """A cart change or an order asked for more of a product than is available"""
+
+    def __init__(self, message, product_id, available):
+        super().__init__(message)
+        self.product_id = product_id
+        self.available = available
+
+def evict_carts(db):
+    """Drop expired carts, their holds, and holds that lapsed on idle carts"""
+    now = time.time()
+    db.execute('DELETE FROM cart_holds WHERE expires_at < ?', (now,))
+    db.execute('DELETE FROM carts WHERE expires_at < ?', (now,))
+
+def load_cart(db, cart_id):
+    row = db.execute('SELECT version, lines, changes FROM carts WHERE id = ? AND expires_at >= ?',
+                     (cart_id, time.time())).fetchone()
+    if row is None:
+        return None
+    return {'id': cart_id, 'version': row[0],
+            'lines': {int(product_id): quantity for product_id, quantity in json.loads(row[1]).items()},
+            'changes': json.loads(row[2])}
+
+def save_cart(db, cart, touched):
+    """Write a cart back and move its stock holds to the new quantities"""
+    now = time.time()
+    db.execute('''UPDATE carts SET version = ?, lines = ?, changes = ?, updated_at = ?, expires_at = ?
+                  WHERE id = ?''',
+               (cart['version'], json.dumps(cart['lines']), json.dumps(cart['changes']),
+                now, now + CART_TTL, cart['id']))
+    for product_id in touched:
+        quantity = cart['lines'].get(product_id, 0)
+        if quantity:
+            db.execute('INSERT OR REPLACE INTO cart_holds VALUES (?, ?, ?, ?)',
+                       (cart['id'], product_id, quantity, now + CART_HOLD_SECONDS))
+        else:
+            db.execute('DELETE FROM cart_holds WHERE cart_id = ? AND product_id = ?', (cart['id'], product_id))
+    db.execute('UPDATE cart_holds SET expires_at = ? WHERE cart_id = ?', (now + CART_HOLD_SECONDS, cart['id']))
+
+def apply_cart_ops(db, cart, ops):
+    """Apply add/set/remove ops to a cart, returning the product ids they touched
+
+    Raising a quantity is checked against the product's stock minus what
+    other active carts hold, one indexed sum per product. Lowering a
+    quantity always succeeds, even if stock has since dropped below it.
+    """
+    if not isinstance(ops, list):
+        raise ValueError('ops must be a list')
+    catalog = current_catalog()
+    before = dict(cart['lines'])
+    for op in ops:
+        if not isinstance(op, dict):
+            raise ValueError('Every cart op must be an object')
+        kind, product_id = op.get('op'), op.get('product_id')
+        if kind not in ('add', 'set', 'remove'):
+            raise ValueError(f'Unknown cart op {kind!r}, expected add, set or remove')
+        if not isinstance(product_id, int):
+            raise ValueError('Every cart op needs an integer product_id')
+        quantity = op.get('quantity', 1 if kind == 'add' else 0)
+        if not isinstance(quantity, int):
+            raise ValueError('quantity must be an integer')
+        if kind == 'add':
+            quantity += cart['lines'].get(product_id, 0)
+        elif kind == 'remove':
+            quantity = 0
+        quantity = max(quantity, 0)
+        if quantity > MAX_CART_QUANTITY:
+            raise ValueError(f'quantity cannot exceed {MAX_CART_QUANTITY}')
+        if quantity and product_id not in catalog.products_by_id:
+            raise ValueError(f'Product {product_id} not found')
+        if quantity:
+            cart['lines'][product_id] = quantity
+        else:
+            cart['lines'].pop(product_id, None)
+
+    touched = sorted(product_id for product_id in set(before) | set(cart['lines'])
+                     if before.get(product_id) != cart['lines'].get(product_id))
+    now = time.time()
+    for product_id in touched:
+        quantity = cart['lines'].get(product_id, 0)
+        if quantity <= before.get(product_id, 0):
+            continue
+        product = catalog.products_by_id[product_id]
+        held = db.execute('''SELECT COALESCE(SUM(quantity), 0) FROM cart_holds
+                             WHERE product_id = ? AND expires_at >= ? AND cart_id != ?''',
+                          (product_id, now, cart['id'])).fetchone()[0]
+        available = max(product.get('stock', 0) - held, 0)
+        if quantity > available:
+            raise CartConflict(f"Only {available} of {product.get('name')} available", product_id, available)
+
+    if touched:
+        cart['version'] += 1
+        cart['changes'] = (cart['changes'] + [[cart['version'], product_id] for product_id in touched])[-CART_CHANGE_LOG:]
+    return touched
+
+def cart_line(product_id, quantity, catalog):
+    product = catalog.products_by_id.get(product_id, {})
+    return {'product_id': product_id, 'quantity': quantity, 'name': product.get('name'),
+            'price': product.get('price'), 'unit': product.get('unit'), 'image': product.get('image'),
+            'images': product.get('images'), 'stock': product.get('stock', 0), 'available': bool(product)}
+
+def cart_totals(cart, catalog):
+    subtotal = sum((Decimal(str(catalog.products_by_id[product_id].get('price', 0))) * quantity
+                    for product_id, quantity in cart['lines'].items() if product_id in catalog.products_by_id),
+                   Decimal('0')).quantize(Decimal('0.01'))
+    tax = (subtotal * TAX_RATE).quantize(Decimal('0.01'))
+    return {'items': sum(cart['lines'].values()), 'subtotal': float(subtotal),
+            'tax': float(tax), 'total': float(subtotal + tax)}
+
+def cart_response(cart, since=None):
+    """The cart as a delta since a version the client holds, or in full
+
+    A delta lists only the lines changed after since, plus the ids of lines
+    removed since then. A client further behind than the change log gets
+    the whole cart, marked full.
+    """
+    catalog = current_catalog()
+    oldest = cart['changes'][0][0] if cart['changes'] else cart['version'] + 1
+    full = since is None or since > cart['version'] or (since < cart['version'] and since + 1 < oldest)
+    if full:
+        changed = set(cart['lines'])
+    else:
+        changed = {product_id for version, product_id in cart['changes'] if version > since}
+    return {'cart_id': cart['id'], 'version': cart['version'], 'full': full,
+            'lines': [cart_line(product_id, cart['lines'][product_id], catalog)
+                      for product_id in sorted(changed) if product_id in cart['lines']],
+            'removed': sorted(product_id for product_id in changed if product_id not in cart['lines']),
+            'totals': cart_totals(cart, catalog)}
+
+def checkout_cart(cart_id):
+    """Claim a cart for checkout, returning it with its order items and server-computed total
+
+    The cart is deleted in the transaction that reads it, so when two
+    holders of a shared cart check out at once only one of them gets it.
+    """
+    db = shared_db()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        cart = load_cart(db, cart_id)
+        if cart is None:
+            raise ValueError('Cart not found or expired')
+        if not cart['lines']:
+            raise ValueError('Cart is empty')
+        catalog = current_catalog()
+        missing = sorted(product_id for product_id in cart['lines'] if product_id not in catalog.products_by_id)
+        if missing:
+            raise ValueError(f'Products no longer available: {missing}')
+        items = []
+        for product_id, quantity in cart['lines'].items():
+            line = cart_line(product_id, quantity, catalog)
+            items.append({'id': product_id, 'name': line['name'], 'price': line['price'],
+                          'quantity': quantity, 'unit': line['unit'], 'image': line['image']})
+        total = cart_totals(cart, catalog)['total']
+        db.execute('DELETE FROM cart_holds WHERE cart_id = ?', (cart_id,))
+        db.execute('DELETE FROM carts WHERE id = ?', (cart_id,))
+        db.execute('COMMIT')
+    except Exception:
+        db.execute('ROLLBACK')
+        raise
+    return cart, items, total
+
+def return_cart(cart):
+    """Put back a cart claimed by a checkout that failed, holds included"""
+    db = shared_db()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        now = time.time()
+        db.execute('INSERT OR REPLACE INTO carts VALUES (?, ?, ?, ?, ?, ?)',
+                   (cart['id'], cart['version'], '{}', '[]', now, now + CART_TTL))
+        save_cart(db, cart, list(cart['lines']))
+        db.execute('COMMIT')
+    except Exception:
+        db.execute('ROLLBACK')
+        raise
+
+# Frequently bought together: co-purchase counts folded in from orders as they land
+RECOMMENDATION_SLOTS = int(os.environ.get('RECOMMENDATION_SLOTS', 12))
+RECOMMENDATION_BATCH = 2000
+MAX_RECOMMENDATIONS = 8
+
+def order_products(order, catalog):
+    """Distinct catalog product ids in an order"""
+    return sorted({item['id'] for item in order.get('items') or []
+                   if isinstance(item, dict) and isinstance(item.get('id'), int)
+                   and item['id'] in catalog.products_by_id})
+
+def fold_orders(db, orders, after_id, catalog):
+    """Add the orders that follow order after_id to the co-purchase counts
+
+    One transaction that also advances last_order_id, so a crash or a
+    second worker running the same job never counts an order twice.
+    Returns False, changing nothing, if the counts are not at after_id.
+    """
+    pairs = {}
+    for order in orders:
+        products = order_products(order, catalog)
+        for product_id in products:
+            for other_id in products:
+                if other_id != product_id:
+                    pairs[product_id, other_id] = pairs.get((product_id, other_id), 0) + 1
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        current, version = db.execute('SELECT last_order_id, version FROM recommendation_state').fetchone()
+        if current != after_id:
+            db.execute('ROLLBACK')
+            return False
+        version += 1
+        db.executemany('''INSERT INTO co_purchases (product_id, other_id, orders, version) VALUES (?, ?, ?, ?)
+                          ON CONFLICT(product_id, other_id) DO UPDATE SET
+                              orders = orders + excluded.orders, version = excluded.version''',
+                       [(product_id, other_id, count, version) for (product_id, other_id), count in pairs.items()])
+        db.execute('UPDATE recommendation_state SET last_order_id = ?, version = ?', (orders[-1]['id'], version))
+        db.execute('COMMIT')
+    except Exception:
+        db.execute('ROLLBACK')
+        raise
+    return True
+
+def fold_new_order(order):
+    """Count an order as it is saved, under the orders lock
+
+    Order ids follow each other, so the order is counted at once unless
+    earlier ones are still pending; then the catch-up job takes it too.
+    Placing an order therefore never reads the order history.
+    """
+    if not fold_orders(shared_db(), [order], order['id'] - 1, current_catalog()):
+        schedule_recommendations()
+
+def update_recommendations():
+    """Catch up on orders not yet counted, reading the order history
+
+    Only needed when orders were not counted as they were placed: a
+    failed fold, or orders written before this job existed. Returns how
+    many orders were folded in.
+    """
+    db = shared_db()
+    catalog = current_catalog()
+    last_order_id = db.execute('SELECT last_order_id FROM recommendation_state').fetchone()[0]
+    orders = sorted((o for o in load_data(ORDERS_FILE) or []
+                     if o.get('type', 'product') == 'product' and o.get('id', 0) > last_order_id),
+                    key=lambda o: o['id'])
+    folded = 0
+    for start in range(0, len(orders), RECOMMENDATION_BATCH):
+        batch = orders[start:start + RECOMMENDATION_BATCH]
+        if not fold_orders(db, batch, last_order_id, catalog):
+            # Another worker is running the job and got here first
+            return folded
+        last_order_id = batch[-1]['id']
+        folded += len(batch)
+    return folded
+
+_recommendations_queued = threading.Event()
+
+def run_recommendations():
+    _recommendations_queued.clear()
+    try:
+        update_recommendations()
+    except Exception as e:
+        app.logger.warning('Updating recommendations failed: %s', e)
+
+def schedule_recommendations():
+    """Queue one background update, coalescing orders that land while it waits"""
+    if not _recommendations_queued.is_set():
+        _recommendations_queued.set()
+        executor('recommendations', 1).submit(run_recommendations)
+
+class RecommendationIndex:
+    """Top co-purchased products for every product, RECOMMENDATION_SLOTS each
+
+    Neighbours and their counts sit in two flat arrays with a fixed stride,
+    so a lookup is one slice of k entries and a product whose counts moved
+    is rewritten in place. Each product with co-purchases gets the next
+    dense slot, and neighbours are stored by slot too, so the arrays grow
+    with the number of products bought together, not with their ids. Only
+    products the job touched since this process last looked are read back.
+    """
+
+    def __init__(self, slots=RECOMMENDATION_SLOTS):
+        self.slots = slots
+        self.slot_of = {}
+        self.ids = []
+        # Neighbour slot + 1, with 0 marking an empty entry
+        self.neighbors = array('i')
+        self.counts = array('i')
+        self.version = None
+        self.lock = threading.Lock()
+
+    def refresh(self, db):
+        version = db.execute('SELECT version FROM recommendation_state').fetchone()[0]
+        if version == self.version:
+            return
+        with self.lock:
+            if self.version is None or version < self.version:
+                self.slot_of, self.ids = {}, []
+                self.neighbors, self.counts = array('i'), array('i')
+                changed = db.execute('SELECT DISTINCT product_id FROM co_purchases').fetchall()
+            else:
+                changed = db.execute('SELECT DISTINCT product_id FROM co_purchases WHERE version > ?',
+                                     (self.version,)).fetchall()
+            for (product_id,) in changed:
+                self._load(db, product_id)
+            self.version = version
+
+    def _slot(self, product_id):
+        slot = self.slot_of.get(product_id)
+        if slot is None:
+            slot = self.slot_of[product_id] = len(self.ids)
+            self.ids.append(product_id)
+            self.neighbors.extend(array('i', [0]) * self.slots)
+            self.counts.extend(array('i', [0]) * self.slots)
+        return slot
+
+    def _load(self, db, product_id):
+        start = self._slot(product_id) * self.slots
+        top = db.execute('''SELECT other_id, orders FROM co_purchases WHERE product_id = ?
+                            ORDER BY orders DESC, other_id LIMIT ?''', (product_id, self.slots)).fetchall()
+        neighbors = [self._slot(other_id) + 1 for other_id, _ in top] + [0] * (self.slots - len(top))
+        counts = [count for _, count in top] + [0] * (self.slots - len(top))
+        self.neighbors[start:start + self.slots] = array('i', neighbors)
+        self.counts[start:start + self.slots] = array('i', counts)
+
+    def neighbors_of(self, product_id):
+        """(product id, orders bought together) pairs, most frequent first"""
+        with self.lock:
+            slot = self.slot_of.get(product_id)
+            if slot is None:
+                return []
+            start = slot * self.slots
+            neighbors = self.neighbors[start:start + self.slots]
+            counts = self.counts[start:start + self.slots]
+            return [(self.ids[neighbor - 1], count) for neighbor, count in zip(neighbors, counts) if neighbor]
+
+RECOMMENDATIONS = RecommendationIndex()
+
+# Status transitions for orders and service requests
+ORDER_TRANSITIONS = {
+    'Processing': {'In-Progress', 'Shipped', 'Cancelled'},
+    'In-Progress': {'Shipped', 'Cancelled'},
+    'Shipped': {'Completed'},
+    'Completed': set(),
+    'Cancelled': set(),
+}
+SERVICE_REQUEST_TRANSITIONS = {
+    'Pending': {'Scheduled', 'In-Progress', 'Cancelled'},
+    'Scheduled': {'In-Progress', 'Cancelled'},
+    'In-Progress': {'Completed', 'Cancelled'},
+    'Completed': set(),
+    'Cancelled': set(),
+}
+MAX_BULK_TRANSITION = 5000
+
+def transition_status(filename, kind, transitions, record_ids, new_status, actor=None, note=None, fields=None):
+    """Move records to new_status, returning the updated records and per-id errors
+
+    fields optionally maps record ids to other fields set with the status.
+    """
+    if new_status not in transitions:
+        raise ValueError(f'Unknown status {new_status!r}, expected one of {sorted(transitions)}')
+    now = datetime.now().isoformat()
+    updated, errors, entries, audit = [], {}, [], []
+    with data_lock(filename):
+        table = record_table(filename)
+        table.refresh()
+        for record_id in record_ids:
+            record = table.get(record_id)
+            if record is None:
+                errors[record_id] = 'Not found'
+                continue
+            current = record.get('status')
+            if new_status not in transitions.get(current, ()):
+                errors[record_id] = f'Cannot change status from {current} to {new_status}'
+                continue
+            entries.append({'id': record_id, 'set': {'status': new_status, 'updated_at': now,
+                                                     **(fields or {}).get(record_id, {})}})
+            audit.append({'kind': kind, 'id': record_id, 'from': current, 'to': new_status,
+                          'actor': actor, 'note': note, 'timestamp': now})
+        table.update(entries)
+        updated = [dict(table.get(entry['id'])) for entry in entries]
+    append_audit(audit)
+    if kind == 'service_request' and new_status == 'Cancelled' and updated:
+        release_bookings([record['id'] for record in updated])
+    if kind == 'order' and new_status == 'Cancelled' and updated:
+        restock_orders(updated)
+    if updated:
+        publish_events(f'{kind}.updated', updated)
+    return updated, errors
+
+def append_audit(entries):
+    """Append status changes to the audit trail
+
+    Each batch starts on a new line, so an append torn by a crash ends
+    there instead of swallowing the first entry written after it.
+    """
+    if entries:
+        STORAGE.append(STATUS_AUDIT_FILE,
+                       ('\n' + ''.join(json.dumps(entry) + '\n' for entry in entries)).encode('utf-8'))
+
+def status_change_request():
+    """Validate a status-change body shared by the single and bulk endpoints"""
+    data = request.get_json() or {}
+    status = data.get('status')
+    if not isinstance(status, str) or not status:
+        raise ValueError('status is required')
+    return data, status
+
+# Technician scheduling over working-hour slots
+SCHEDULE_EPOCH = date(2024, 1, 1)
+SCHEDULE_DAY_START = int(os.environ.get('SCHEDULE_DAY_START', 8))
+SCHEDULE_DAY_HOURS = int(os.environ.get('SCHEDULE_DAY_HOURS', 8))
+SCHEDULE_WORKDAYS = 5
+SCHEDULE_HORIZON_DAYS = int(os.environ.get('SCHEDULE_HORIZON_DAYS', 90))
+SERVICE_TYPE_CATEGORIES = {'precision-drilling': 'drilling', 'threading': 'threading',
+                           'fabrication': 'fabrication', 'emergency': 'repair'}
+METALS = {'steel', 'stainless-steel', 'carbon-steel', 'aluminum', 'copper', 'brass'}
+MAX_SCHEDULE_BATCH = 1000
+
+def material_key(name):
+    return re.sub(r'[^a-z0-9]+', '-', str(name).lower()).strip('-')
+
+def material_family(material):
+    """The metal a graded material belongs to, so carbon-steel and stainless-steel are both steel"""
+    family = material.rsplit('-', 1)[-1]
+    return family if family in METALS else material
+
+def handles_material(materials, material):
+    """Whether a service's or technician's materials cover material
+
+    A bare metal such as Steel covers every grade of it, while a listed
+    grade such as Stainless Steel covers only itself.
+    """
+    family = material_family(material)
+    return (not material or material in materials or family in materials or 'all-materials' in materials
+            or ('all-metals' in materials and family in METALS))
+
+def slot_at(moment):
+    """The first working-hour slot starting at or after moment
+
+    Slot n is the nth working hour since SCHEDULE_EPOCH, a Monday, counting
+    SCHEDULE_DAY_HOURS from SCHEDULE_DAY_START on weekdays only, so a job
+    longer than what is left of a day is still one run of slots.
+    """
+    weeks, weekday = divmod((moment.date() - SCHEDULE_EPOCH).days, 7)
+    hour = math.ceil(moment.hour - SCHEDULE_DAY_START + (moment.minute * 60 + moment.second) / 3600)
+    if weekday >= SCHEDULE_WORKDAYS:
+        weekday, hour = SCHEDULE_WORKDAYS, 0
+    hour = min(max(hour, 0), SCHEDULE_DAY_HOURS)
+    return (weeks * SCHEDULE_WORKDAYS + weekday) * SCHEDULE_DAY_HOURS + hour
+
+def slot_time(slot):
+    workday, hour = divmod(slot, SCHEDULE_DAY_HOURS)
+    weeks, weekday = divmod(workday, SCHEDULE_WORKDAYS)
+    day = SCHEDULE_EPOCH + timedelta(days=weeks * 7 + weekday)
+    return datetime(day.year, day.month, day.day, SCHEDULE_DAY_START) + timedelta(hours=hour)
+
+def booking_times(start, end):
+    return {'start': slot_time(start).isoformat(),
+            'end': (slot_time(end - 1) + timedelta(hours=1)).isoformat()}
+
+class SlotTree:
+    """Free slots of one technician from base on, indexed by free-run length
+
+    A segment tree over the slots: every node keeps the longest run of free
+    slots inside it and the free runs touching its two ends, so the earliest
+    run of n free slots at or after a given slot is found in O(log size),
+    and booking or releasing a job only recomputes the nodes above it.
+    """
+
+    def __init__(self, base, size):
+        self.base = base
+        self.size = 1 << max(size - 1, 1).bit_length()
+        lengths = [0] + [self.size >> (node.bit_length() - 1) for node in range(1, 2 * self.size)]
+        self.best = lengths
+        self.prefix = lengths[:]
+        self.suffix = lengths[:]
+
+    def earliest(self, count, start):
+        """First slot at or after start that opens count free slots, or None"""
+        if count > self.size:
+            return None
+        found = self._find(1, 0, self.size, count, max(start - self.base, 0))
+        return None if found is None else found + self.base
+
+    def _find(self, node, lo, hi, count, start):
+        if hi - max(lo, start) < count or self.best[node] < count:
+            return None
+        if hi - lo == 1:
+            return lo
+        mid = (lo + hi) // 2
+        left, right = 2 * node, 2 * node + 1
+        found = self._find(left, lo, mid, count, start)
+        if found is not None:
+            return found
+        # A run crossing into the right half
+        first = max(mid - self.suffix[left], start)
+        if first < mid and mid - first + self.prefix[right] >= count:
+            return first
+        return self._find(right, mid, hi, count, start)
+
+    def book(self, start, end):
+        self._set(start, end, 0)
+
+    def release(self, start, end):
+        self._set(start, end, 1)
+
+    def _set(self, start, end, free):
+        start, end = max(start - self.base, 0), min(end - self.base, self.size)
+        if start >= end:
+            return
+        lo, hi = start + self.size, end - 1 + self.size
+        for leaf in range(lo, hi + 1):
+            self.best[leaf] = self.prefix[leaf] = self.suffix[leaf] = free
+        half = 1
+        while lo > 1:
+            lo, hi = lo // 2, hi // 2
+            for node in range(lo, hi + 1):
+                left, right = 2 * node, 2 * node + 1
+                self.best[node] = max(self.best[left], self.best[right], self.suffix[left] + self.prefix[right])
+                self.prefix[node] = self.prefix[left] if self.prefix[left] < half else half + self.prefix[right]
+                self.suffix[node] = self.suffix[right] if self.suffix[right] < half else half + self.suffix[left]
+            half *= 2
+
+def technician_from_row(row):
+    technician_id, name, skills, materials = row
+    return {'id': technician_id, 'name': name, 'skills': json.loads(skills), 'materials': json.loads(materials)}
+
+def bump_schedule_version(db):
+    db.execute('UPDATE schedule_version SET version = version + 1')
+    return db.execute('SELECT version FROM schedule_version').fetchone()[0]
+
+class TechnicianSchedule:
+    """Every active technician's free slots, for earliest-slot queries
+
+    Each technician gets a SlotTree covering SCHEDULE_HORIZON_DAYS from the
+    start of today. Technicians and bookings live in the shared database;
+    the trees are rebuilt when another worker changed them or a new day
+    began, and updated in place for this process's own bookings, which
+    always happen inside a write transaction.
+    """
+
+    def __init__(self):
+        self.version = None
+        self.base = None
+        self.lock = threading.Lock()
+        self.technicians = {}
+        self.trees = {}
+
+    def refresh(self, db):
+        version = db.execute('SELECT version FROM schedule_version').fetchone()[0]
+        now = slot_at(datetime.now())
+        base = now - now % SCHEDULE_DAY_HOURS
+        if version == self.version and base == self.base:
+            return
+        size = SCHEDULE_HORIZON_DAYS * SCHEDULE_WORKDAYS // 7 * SCHEDULE_DAY_HOURS
+        with self.lock:
+            self.technicians = {row[0]: technician_from_row(row) for row in db.execute(
+                'SELECT id, name, skills, materials FROM technicians WHERE active = 1')}
+            self.trees = {technician_id: SlotTree(base, size) for technician_id in self.technicians}
+            for technician_id, start, end in db.execute(
+                    'SELECT technician_id, start_slot, end_slot FROM technician_bookings WHERE end_slot > ?',
+                    (base,)):
+                if technician_id in self.trees:
+                    self.trees[technician_id].book(start, end)
+            self.version, self.base = version, base
+
+    def earliest(self, category, material, count):
+        """(technician id, first slot) of the earliest qualified opening, or None"""
+        start = slot_at(datetime.now())
+        best = None
+        with self.lock:
+            for technician_id, technician in self.technicians.items():
+                if category not in technician['skills'] or not handles_material(technician['materials'], material):
+                    continue
+                slot = self.trees[technician_id].earliest(count, start)
+                if slot is not None and (best is None or slot < best[1]):
+                    best = (technician_id, slot)
+        return best
+
+    def book(self, technician_id, start, end):
+        with self.lock:
+            self.trees[technician_id].book(start, end)
+
+    def release(self, technician_id, start, end):
+        with self.lock:
+            if technician_id in self.trees:
+                self.trees[technician_id].release(start, end)
+
+SCHEDULE = TechnicianSchedule()
+
+def validate_technician(data, catalog):
+    """Name, skills and materials of a new technician
+
+    Skills are service categories; materials default to everything the
+    services in those categories list.
+    """
+    name = data.get('name')
+    if not isinstance(name, str) or not name.strip():
+        raise ValueError('name is required')
+    services = {service.get('category'): service for service in catalog.services}
+    skills = data.get('skills')
+    if not isinstance(skills, list) or not skills:
+        raise ValueError(f'skills must be a list of service categories: {sorted(services)}')
+    skills = sorted({SERVICE_TYPE_CATEGORIES.get(skill, skill) for skill in skills})
+    unknown = [skill for skill in skills if skill not in services]
+    if unknown:
+        raise ValueError(f'Unknown skills {unknown}, expected service categories {sorted(services)}')
+    materials = data.get('materials')
+    if materials is None:
+        materials = [material for skill in skills for material in services[skill].get('materials', [])]
+    elif not isinstance(materials, list) or not all(isinstance(material, str) for material in materials):
+        raise ValueError('materials must be a list of strings')
+    return name.strip(), skills, sorted({material_key(material) for material in materials})
+
+def booking_needs(record, catalog):
+    """Skill, material and number of slots a service request needs"""
+    service_type = record.get('service_type')
+    category = SERVICE_TYPE_CATEGORIES.get(service_type, service_type)
+    service = next((s for s in catalog.services if s.get('category') == category), None)
+    if service is None:
+        raise ValueError(f'Unknown service type {service_type!r}')
+    material = material_key(record.get('pipe_material') or '')
+    if not handles_material({material_key(m) for m in service.get('materials', [])}, material):
+        raise ValueError(f"{service['name']} does not handle {record.get('pipe_material')}")
+    try:
+        hours = float(record.get('estimated_hours') or 0)
+    except (TypeError, ValueError):
+        raise ValueError('estimated_hours must be a number')
+    if not math.isfinite(hours) or hours < 0:
+        raise ValueError('estimated_hours must be a positive number')
+    return category, material, max(math.ceil(hours), int(service.get('min_hours') or 1), 1)
+
+def no_opening(category, material):
+    return (f"No {category} technician for {material or 'any material'} "
+            f'is free within {SCHEDULE_HORIZON_DAYS} days')
+
+def schedule_requests(request_ids=None, actor=None):
+    """Book the earliest qualified technician for pending service requests
+
+    Emergencies go first, then requests in the order they arrived. Returns
+    the scheduled requests and, per request id, why one was not booked.
+    """
+    errors = {}
+    with data_lock(REQUESTS_FILE):
+        table = record_table(REQUESTS_FILE)
+        table.refresh()
+        if request_ids is None:
+            candidates = [dict(r) for r in table.records
+                          if r.get('type') == 'service' and r.get('status') == 'Pending']
+        else:
+            candidates = []
+            for request_id in request_ids:
+                record = table.get(request_id)
+                if record is None:
+                    errors[request_id] = 'Not found'
+                elif record.get('status') != 'Pending':
+                    errors[request_id] = f"Cannot schedule a request that is {record.get('status')}"
+                else:
+                    candidates.append(dict(record))
+    candidates.sort(key=lambda r: (r.get('service_type') != 'emergency', r.get('timestamp', '')))
+    catalog = current_catalog()
+    booked = {}
+    db = shared_db()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        SCHEDULE.refresh(db)
+        for record in candidates[:MAX_SCHEDULE_BATCH]:
+            if db.execute('SELECT 1 FROM technician_bookings WHERE request_id = ?', (record['id'],)).fetchone():
+                errors[record['id']] = 'Already scheduled'
+                continue
+            try:
+                category, material, count = booking_needs(record, catalog)
+            except ValueError as e:
+                errors[record['id']] = str(e)
+                continue
+            opening = SCHEDULE.earliest(category, material, count)
+            if opening is None:
+                errors[record['id']] = no_opening(category, material)
+                continue
+            technician_id, start = opening
+            SCHEDULE.book(technician_id, start, start + count)
+            db.execute('INSERT INTO technician_bookings (request_id, technician_id, start_slot, end_slot) '
+                       'VALUES (?, ?, ?, ?)', (record['id'], technician_id, start, start + count))
+            booked[record['id']] = (technician_id, start, start + count)
+        if booked:
+            SCHEDULE.version = bump_schedule_version(db)
+        db.execute('COMMIT')
+    except BaseException:
+        db.execute('ROLLBACK')
+        SCHEDULE.version = None
+        raise
+    if not booked:
+        return [], errors
+    fields = {}
+    for request_id, (technician_id, start, end) in booked.items():
+        times = booking_times(start, end)
+        fields[request_id] = {'technician_id': technician_id,
+                              'technician': SCHEDULE.technicians[technician_id]['name'],
+                              'scheduled_start': times['start'], 'scheduled_end': times['end']}
+    updated, failed = transition_status(REQUESTS_FILE, 'service_request', SERVICE_REQUEST_TRANSITIONS,
+                                        list(booked), 'Scheduled', actor, 'Technician assigned', fields)
+    if failed:
+        # Cancelled or rescheduled while the slots were being booked
+        release_bookings(list(failed))
+        errors.update(failed)
+    return updated, errors
+
+def release_bookings(request_ids):
+    """Free the slots booked for service requests"""
+    db = shared_db()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        SCHEDULE.refresh(db)
+        released = False
+        for request_id in request_ids:
+            row = db.execute('SELECT technician_id, start_slot, end_slot FROM technician_bookings '
+                             'WHERE request_id = ?', (request_id,)).fetchone()
+            if row is None:
+                continue
+            db.execute('DELETE FROM technician_bookings WHERE request_id = ?', (request_id,))
+            SCHEDULE.release(*row)
+            released = True
+        if released:
+            SCHEDULE.version = bump_schedule_version(db)
+        db.execute('COMMIT')
+    except BaseException:
+        db.execute('ROLLBACK')
+        SCHEDULE.version = None
+        raise
+
+# Service quotes, priced from rate tables memoized on the catalog snapshot
+MATERIAL_RATE_FACTORS = {'stainless-steel': Decimal('1.15'), 'copper': Decimal('1.10'),
+                         'brass': Decimal('1.05'), 'aluminum': Decimal('1.05')}
+DIAMETER_LIMITS = (2, 6, 12)  # inches; larger pipes fall in the last band
+DIAMETER_FACTORS = (Decimal('1.00'), Decimal('1.10'), Decimal('1.25'), Decimal('1.50'))
+EMERGENCY_SURCHARGE = Decimal(os.environ.get('EMERGENCY_SURCHARGE', '0.50'))
+VOLUME_DISCOUNTS = ((250, Decimal('0.15')), (100, Decimal('0.10')), (40, Decimal('0.05')))  # hours, discount
+MAX_QUOTE_LINES = 1000
+MAX_QUOTE_HOURS = 10000
+CENTS = Decimal('0.01')
+
+def build_rate_tables(catalog):
+    """Hourly rate of every service for each material and diameter band
+
+    A material without its own factor is priced at the plain rate, under
+    the '' row. Services that list volume discounts among their features
+    get them on quotes.
+    """
+    tables = {}
+    for service in catalog.services:
+        base = Decimal(str(service['hourly_rate']))
+        materials = {material_key(m) for m in service.get('materials', [])}
+        rates = {material: [(base * factor * band).quantize(CENTS) for band in DIAMETER_FACTORS]
+                 for material, factor in MATERIAL_RATE_FACTORS.items()}
+        rates[''] = [(base * band).quantize(CENTS) for band in DIAMETER_FACTORS]
+        category = service.get('category')
+        tables[category] = {
+            'service': service,
+            'min_hours': Decimal(str(service.get('min_hours') or 0)),
+            'materials': materials,
+            'rates': rates,
+            # The emergency service's rate already is the emergency rate
+            'surcharge': Decimal(0) if category == SERVICE_TYPE_CATEGORIES['emergency'] else EMERGENCY_SURCHARGE,
+            'volume_discount': any('volume discount' in str(f).lower() for f in service.get('features', [])),
+        }
+    return tables
+
+def quote_number(booking, key, required=False, maximum=None):
+    value = booking.get(key)
+    if value is None or value == '':
+        if required:
+            raise ValueError(f'{key} is required')
+        return Decimal(0)
+    if isinstance(value, bool):
+        raise ValueError(f'{key} must be a number')
+    try:
+        number = Decimal(str(value))
+    except ArithmeticError:
+        raise ValueError(f'{key} must be a number')
+    if not number.is_finite() or number < 0 or (maximum is not None and number > maximum):
+        raise ValueError(f'{key} must be a number between 0 and {maximum or "infinity"}')
+    return number
+
+def quote_line(tables, booking):
+    """One priced booking, with its category, billed hours and amount"""
+    if not isinstance(booking, dict):
+        raise ValueError('must be an object')
+    service_type = booking.get('service_type')
+    table = tables.get(SERVICE_TYPE_CATEGORIES.get(service_type, service_type))
+    if table is None:
+        raise ValueError(f'Unknown service type {service_type!r}')
+    service = table['service']
+    material = material_key(booking.get('material') or '')
+    if not handles_material(table['materials'], material):
+        raise ValueError(f"{service['name']} does not handle {booking.get('material')}")
+    hours = max(quote_number(booking, 'hours', required=True, maximum=MAX_QUOTE_HOURS), table['min_hours'])
+    diameter = quote_number(booking, 'diameter')
+    rate = table['rates'].get(material, table['rates'][''])[bisect.bisect_left(DIAMETER_LIMITS, diameter)]
+    surcharge = table['surcharge'] if booking.get('emergency') else Decimal(0)
+    amount = (rate * hours * (1 + surcharge)).quantize(CENTS)
+    line = {'service_id': service['id'], 'service': service['name'], 'material': material or None,
+            'diameter': float(diameter), 'hours': float(hours), 'rate': float(rate),
+            'emergency_surcharge': float(surcharge), 'amount': float(amount)}
+    return line, service.get('category'), hours, amount
+
+def price_quote(bookings, catalog):
+    """Price prospective bookings; volume discounts count hours across the quote"""
+    tables = catalog.memo('rate_tables', lambda: build_rate_tables(catalog))
+    lines, hours_by_category, amounts_by_category = [], {}, {}
+    for index, booking in enumerate(bookings):
+        try:
+            line, category, hours, amount = quote_line(tables, booking)
+        except ValueError as e:
+            raise ValueError(f'bookings[{index}]: {e}' if len(bookings) > 1 else str(e))
+        lines.append(line)
+        hours_by_category[category] = hours_by_category.get(category, 0) + hours
+        amounts_by_category[category] = amounts_by_category.get(category, 0) + amount
+    discounts = []
+    for category, hours in hours_by_category.items():
+        if not tables[category]['volume_discount']:
+            continue
+        rate = next((rate for threshold, rate in VOLUME_DISCOUNTS if hours >= threshold), None)
+        if rate:
+            discounts.append({'service': tables[category]['service']['name'], 'hours': float(hours),
+                              'rate': float(rate),
+                              'amount': -(amounts_by_category[category] * rate).quantize(CENTS)})
+    subtotal = sum(amounts_by_category.values(), Decimal(0)) + sum((d['amount'] for d in discounts), Decimal(0))
+    tax = (subtotal * TAX_RATE).quantize(CENTS)
+    for discount in discounts:
+        discount['amount'] = float(discount['amount'])
+    return {'lines': lines, 'discounts': discounts, 'subtotal': float(subtotal),
+            'tax': float(tax), 'total': float(subtotal + tax)}
+
+# Uploaded product images, stored by content hash with resized variants
+IMAGE_VARIANTS = {'thumb': 400, 'card': 800, 'detail': 1600}
+IMAGE_FORMATS = {'webp': ('WEBP', {'quality': 80, 'method': 4}),
+                 'jpeg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True})}
+IMAGE_SIGNATURES = {b'\xff\xd8\xff': 'jpg', b'\x89PNG\r\n\x1a\n': 'png', b'GIF8': 'gif'}
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', 2))
+
+def image_extension(raw):
+    """File extension for a supported image, judged by its signature"""
+    for signature, extension in IMAGE_SIGNATURES.items():
+        if raw.startswith(signature):
+            return extension
+    if raw[:4] == b'RIFF' and raw[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+def image_dir(digest):
+    return os.path.join(UPLOAD_FOLDER, digest[:2], digest)
+
+def image_urls(digest, extension):
+    """Variant URLs recorded on products that use an uploaded image"""
+    base = '/' + image_dir(digest).replace(os.sep, '/')
+    images = {'hash': digest, 'original': f'{base}/original.{extension}'}
+    for variant, width in IMAGE_VARIANTS.items():
+        images[variant] = {'width': width, **{fmt: f'{base}/{variant}.{fmt}' for fmt in IMAGE_FORMATS}}
+    return images
+
+def write_atomic(path, raw):
+    tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(raw)
+    os.replace(tmp, path)
+
+def render_image_variants(digest, extension):
+    """Resize an original upload into every variant and format"""
+    directory = image_dir(digest)
+    with Image.open(os.path.join(directory, f'original.{extension}')) as original:
+        original = ImageOps.exif_transpose(original)
+        if original.mode not in ('RGB', 'RGBA'):
+            original = original.convert('RGBA' if 'transparency' in original.info else 'RGB')
+        for variant, width in IMAGE_VARIANTS.items():
+            resized = original.copy()
+            resized.thumbnail((width, width * 4))
+            for fmt, (pil_format, options) in IMAGE_FORMATS.items():
+                path = os.path.join(directory, f'{variant}.{fmt}')
+                if os.path.exists(path):
+                    continue
+                image = resized.convert('RGB') if pil_format == 'JPEG' else resized
+                tmp = f'{path}.{os.getpid()}.tmp'
+                image.save(tmp, pil_format, **options)
+                os.replace(tmp, path)
+
+def log_render_failure(future, digest):
+    if future.exception() is not None:
+        app.logger.error('Image variants for %s could not be rendered: %s', digest, future.exception())
+
+def store_image(raw):
+    """Store an upload under its content hash and queue its variants"""
+    extension = image_extension(raw)
+    if extension is None:
+        raise ValueError('Unsupported image type, upload a JPEG, PNG, GIF or WebP file')
+    digest = hashlib.sha256(raw).hexdigest()
+    directory = image_dir(digest)
+    os.makedirs(directory, exist_ok=True)
+    original = os.path.join(directory, f'original.{extension}')
+    if not os.path.exists(original):
+        write_atomic(original, raw)
+    pending = Image is not None and not all(
+        os.path.exists(os.path.join(directory, f'{variant}.{fmt}'))
+        for variant in IMAGE_VARIANTS for fmt in IMAGE_FORMATS)
+    if pending:
+        executor('images', IMAGE_WORKERS).submit(render_image_variants, digest, extension).add_done_callback(
+            lambda future: log_render_failure(future, digest))
+    images = image_urls(digest, extension)
+    if Image is None:
+        # Without Pillow every variant falls back to the original file
+        for variant in IMAGE_VARIANTS:
+            images[variant] = {'width': None, 'webp': images['original'], 'jpeg': images['original']}
+    return images, pending
+
+# Remote product images, fetched once and served from a size-bounded disk cache
+IMAGE_CACHE_FOLDER = os.environ.get('IMAGE_CACHE_FOLDER', 'image_cache')
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get('IMAGE_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+IMAGE_CACHE_LOW_WATER = 0.9
+IMAGE_CACHE_TOUCH_INTERVAL = 600
+IMAGE_PROXY_HOSTS = {host.strip().lower() for host in
+                     os.environ.get('IMAGE_PROXY_HOSTS', 'images.unsplash.com').split(',') if host.strip()}
+IMAGE_FETCH_WORKERS = int(os.environ.get('IMAGE_FETCH_WORKERS', 4))
+IMAGE_FETCH_TIMEOUT = float(os.environ.get('IMAGE_FETCH_TIMEOUT', 10))
+IMAGE_FETCH_MAX_BYTES = int(os.environ.get('IMAGE_FETCH_MAX_BYTES', 10 * 1024 * 1024))
+IMAGE_FETCH_REDIRECTS = 3
+
+class ImageFetchError(OSError):
+    """A remote image could not be fetched, or what came back was not an image"""
+
+def proxy_allowed(url):
+    """Only http(s) URLs on an allowlisted host are fetched, so the proxy never reaches internal hosts"""
+    try:
+        parts = urlsplit(url)
+    except ValueError:
+        return False
+    return parts.scheme in ('http', 'https') and parts.netloc.lower() in IMAGE_PROXY_HOSTS
+
+def url_digest(url):
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+class RemoteImageCache:
+    """Remote images on local disk, evicting the least recently used past max_bytes
+
+    Files are named by the hash of their URL and a hit refreshes the
+    file's mtime, so every worker shares one recency order that survives
+    restarts. Sizes are tracked in memory; the folder is only rescanned
+    when this process sees the total go over the limit, and eviction then
+    frees down to the low-water mark so scans stay rare.
+    """
+
+    def __init__(self, folder=IMAGE_CACHE_FOLDER, max_bytes=IMAGE_CACHE_MAX_BYTES):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = None
+        self.total = 0
+        self.inflight = {}
+        self.pid = None
+        self.local = threading.local()
+
+    def path(self, digest):
+        return os.path.join(self.folder, digest[:2], digest)
+
+    def session(self):
+        """Keep-alive session per fetch thread, so repeat fetches reuse connections"""
+        if getattr(self.local, 'pid', None) != os.getpid():
+            self.local.session = requests.Session()
+            self.local.pid = os.getpid()
+        return self.local.session
+
+    def cached(self, url):
+        """Path of url's cached copy, marking it recently used, or None"""
+        digest = url_digest(url)
+        path = self.path(digest)
+        try:
+            if time.time() - os.stat(path).st_mtime > IMAGE_CACHE_TOUCH_INTERVAL:
+                os.utime(path)
+        except FileNotFoundError:
+            return None
+        with self.lock:
+            if self.entries is not None and digest in self.entries:
+                self.entries.move_to_end(digest)
+        return path
+
+    def get(self, url):
+        """Path of url's cached copy, fetching it first on a miss"""
+        path = self.cached(url)
+        if path is None:
+            path = self.fetch(url).result()
+        return path
+
+    def fetch(self, url):
+        """Fetch url on the bounded pool, sharing one download between concurrent misses"""
+        digest = url_digest(url)
+        with self.lock:
+            if self.pid != os.getpid():
+                self.inflight = {}
+                self.pid = os.getpid()
+            future = self.inflight.get(digest)
+            if future is None:
+                future = executor('image-fetch', IMAGE_FETCH_WORKERS).submit(self.download, url, digest)
+                self.inflight[digest] = future
+                future.add_done_callback(lambda _: self.inflight.pop(digest, None))
+        return future
+
+    def request(self, url):
+        """GET url, following redirects only while they stay on allowlisted hosts"""
+        for _ in range(IMAGE_FETCH_REDIRECTS + 1):
+            if not proxy_allowed(url):
+                raise ImageFetchError(f'{url} is not on an allowed image host')
+            try:
+                response = self.session().get(url, stream=True, allow_redirects=False,
+                                              timeout=IMAGE_FETCH_TIMEOUT)
+            except requests.RequestException as e:
+                raise ImageFetchError(f'Could not fetch {url}: {e}') from e
+            if not response.is_redirect:
+                if response.status_code != 200:
+                    response.close()
+                    raise ImageFetchError(f'{url} answered {response.status_code}')
+                return response
+            response.close()
+            url = urljoin(url, response.headers['Location'])
+        raise ImageFetchError(f'{url} redirected more than {IMAGE_FETCH_REDIRECTS} times')
+
+    def download(self, url, digest):
+        raw = bytearray()
+        with self.request(url) as response:
+            try:
+                for chunk in response.iter_content(64 * 1024):
+                    raw += chunk
+                    if len(raw) > IMAGE_FETCH_MAX_BYTES:
+                        raise ImageFetchError(f'{url} is larger than {IMAGE_FETCH_MAX_BYTES} bytes')
+            except requests.RequestException as e:
+                raise ImageFetchError(f'Could not fetch {url}: {e}') from e
+        if image_extension(raw) is None:
+            raise ImageFetchError(f'{url} is not a JPEG, PNG, GIF or WebP image')
+        path = self.path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_atomic(path, raw)
+        self.added(digest, len(raw))
+        return path
+
+    def scan(self):
+        found = []
+        for root, _, names in os.walk(self.folder):
+            for name in names:
+                if not re.fullmatch('[0-9a-f]{64}', name):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except FileNotFoundError:
+                    continue
+                found.append((stat.st_mtime, name, stat.st_size))
+        found.sort()
+        self.entries = OrderedDict((name, size) for _, name, size in found)
+        self.total = sum(self.entries.values())
+
+    def added(self, digest, size):
+        with self.lock:
+            if self.entries is None:
+                self.scan()
+            self.total += size - self.entries.pop(digest, 0)
+            self.entries[digest] = size
+            if self.total <= self.max_bytes:
+                return
+            # Other workers fill the same folder, so it decides what is really there
+            self.scan()
+            for victim in list(self.entries):
+                if self.total <= self.max_bytes * IMAGE_CACHE_LOW_WATER:
+                    break
+                if victim == digest:
+                    continue
+                self.total -= self.entries.pop(victim)
+                try:
+                    os.remove(self.path(victim))
+                except FileNotFoundError:
+                    pass
+
+REMOTE_IMAGES = RemoteImageCache()
+
+def log_prefetch_failure(future):
+    if future.exception() is not None:
+        app.logger.warning('Image prefetch failed: %s', future.exception())
+
+def prefetch_image(url):
+    """Start caching a product image in the background, so its first viewer gets a hit"""
+    if isinstance(url, str) and proxy_allowed(url) and REMOTE_IMAGES.cached(url) is None:
+        REMOTE_IMAGES.fetch(url).add_done_callback(log_prefetch_failure)
+
+# Fingerprinted static assets
+STATIC_FOLDER = 'static'
+EXTRA_ASSETS = {
+    'js/shop.js': os.path.join(app.root_path, 'shop.js'),
+    'js/product-grid.js': os.path.join(app.root_path, 'product-grid.js'),
+    'js/cart.js': os.path.join(app.root_path, 'cart.js'),
+}
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+STATIC_MAX_AGE = 300
+CONTENT_ADDRESSED = re.compile(r'images/[0-9a-f]{2}/[0-9a-f]{64}/')
+PRECOMPRESSED = (('br', '.br'), ('gzip', '.gz'))
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class AssetManifest:
+    """Maps static files to content-hashed URLs that can be cached forever
+
+    Uploaded images already live under their content hash, so they are
+    served as immutable without being hashed again.
+    """
+
+    def __init__(self):
+        self.urls = {}
+        self.files = {}
+
+    def build(self, folder=STATIC_FOLDER, extra=EXTRA_ASSETS):
+        sources = {}
+        for root, _, names in os.walk(folder):
+            for name in names:
+                if name.endswith(('.gz', '.br', '.tmp')):
+                    continue
+                path = os.path.join(root, name)
+                logical = os.path.relpath(path, folder).replace(os.sep, '/')
+                if not CONTENT_ADDRESSED.match(logical):
+                    sources[logical] = os.path.abspath(path)
+        sources.update({logical: path for logical, path in extra.items() if os.path.isfile(path)})
+
+        urls, files = {}, {}
+        for logical, path in sources.items():
+            stem, extension = os.path.splitext(logical)
+            hashed = f'{stem}.{file_digest(path)[:12]}{extension}'
+            urls[logical] = hashed
+            files[hashed] = files[logical] = path
+        self.urls, self.files = urls, files
+
+ASSETS = AssetManifest()
+
+def asset_url(logical):
+    """URL of a static file, fingerprinted when it is in the manifest"""
+    return '/static/' + ASSETS.urls.get(logical, logical)
+
+app.add_template_global(asset_url)
+
+def rewrite_asset_urls(text):
+    """Point every /static/ reference in a page at its fingerprinted URL"""
+    return re.sub(r'/static/([\w./-]+)', lambda m: asset_url(m.group(1)), text)
+
+def send_asset(path, immutable):
+    """Send a static file, preferring a precompressed sibling the client accepts"""
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    max_age = IMMUTABLE_MAX_AGE if immutable else STATIC_MAX_AGE
+    for encoding, suffix in PRECOMPRESSED:
+        if request.accept_encodings[encoding] and os.path.isfile(path + suffix):
+            response = send_file(path + suffix, mimetype=mimetype, conditional=True, max_age=max_age)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_file(path, mimetype=mimetype, conditional=True, max_age=max_age)
+    response.vary.add('Accept-Encoding')
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.cache_control.public = True
+    if immutable:
+        response.cache_control.immutable = True
+    return response
+
+# Pages minified and compressed once, then served from memory
+SPLIT_PAGE_ASSETS = os.environ.get('SPLIT_PAGE_ASSETS', '1') == '1'
+PAGE_ASSETS = {}
+
+class CompressedBody:
+    """A response body encoded up front in every encoding we can serve"""
+
+    def __init__(self, raw, mimetype):
+        self.mimetype = mimetype
+        self.etag = hashlib.sha256(raw).hexdigest()[:20]
+        self.bodies = {'identity': raw, 'gzip': gzip.compress(raw, 9)}
+        if brotli is not None:
+            self.bodies['br'] = brotli.compress(raw, quality=11)
+
+    def response(self, immutable=False):
+        if request.if_none_match.contains(self.etag):
+            response = make_response('', 304)
+        else:
+            encoding = next((e for e in ('br', 'gzip') if e in self.bodies and request.accept_encodings[e]),
+                            'identity')
+            response = make_response(self.bodies[encoding])
+            response.mimetype = self.mimetype
+            if encoding != 'identity':
+                response.headers['Content-Encoding'] = encoding
+        response.set_etag(self.etag)
+        response.vary.add('Accept-Encoding')
+        if immutable:
+            response.cache_control.public = True
+            response.cache_control.max_age = IMMUTABLE_MAX_AGE
+            response.cache_control.immutable = True
+        else:
+            response.cache_control.no_cache = True
+        return response
+
+def minify_css(css):
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{};,>])\s*', r'\1', css)
+    return re.sub(r':\s+', ':', css).replace(';}', '}').strip()
+
+def minify_js(js):
+    """Strip indentation, blank lines and // comments, keeping line breaks for ASI"""
+    lines = []
+    for line in js.splitlines():
+        line = line.strip()
+        if not line or line.startswith('//'):
+            continue
+        lines.append(re.sub(r';\s*//[^\'"`]*$', ';', line))
+    return '\n'.join(lines)
+
+def minify_html(html):
+    html = re.sub(r'<!--.*?-->', '', html, flags=re.S)
+    return '\n'.join(line.strip() for line in html.splitlines() if line.strip())
+
+def publish_page_asset(page, extension, text):
+    """Serve split-out CSS or JS at a fingerprinted URL"""
+    body = CompressedBody(text.encode('utf-8'), mimetypes.types_map['.' + extension])
+    name = f'{page}.{body.etag[:12]}.{extension}'
+    PAGE_ASSETS[name] = body
+    return f'/assets/{name}'
+
+def build_page(html, page):
+    """Minify a page, optionally splitting inline CSS and JS into cacheable assets"""
+    html = rewrite_asset_urls(html)
+
+    def style(match):
+        css = minify_css(match.group(1))
+        if SPLIT_PAGE_ASSETS:
+            return f'<link rel="stylesheet" href="{publish_page_asset(page, "css", css)}">'
+        return f'<style>{css}</style>'
+
+    def script(match):
+        js = minify_js(match.group(1))
+        if SPLIT_PAGE_ASSETS:
+            return f'<script src="{publish_page_asset(page, "js", js)}"></script>'
+        return f'<script>{js}</script>'
+
+    html = re.sub(r'<style>(.*?)</style>', style, html, flags=re.S)
+    html = re.sub(r'<script>(.*?)</script>', script, html, flags=re.S)
+    return CompressedBody(minify_html(html).encode('utf-8'), 'text/html')
 
 # Main HTML Page with updated image handling
 HTML_PAGE = '''
@@ -204,6 +3042,7 @@ HTML_PAGE = '''
             background: #f8f9fa; margin-bottom: 1rem; overflow: hidden;
         }
         
+        .product-image picture { display: contents; }
         .product-image img {
             width: 100%; height: 100%; object-fit: cover; transition: transform 0.3s;
         }
@@ -253,6 +3092,21 @@ HTML_PAGE = '''
             margin-bottom: 1rem;
         }
         
+        .facet-bar { display: flex; flex-wrap: wrap; gap: 1rem 2rem; }
+        .facet-group { display: flex; flex-wrap: wrap; align-items: center; gap: 0.25rem 0.75rem; }
+        .facet-option { font-size: 0.9rem; cursor: pointer; }
+        .facet-count { color: #7f8c8d; }
+        
+        .virtual-grid { position: relative; height: 75vh; overflow-y: auto; contain: content; }
+        .virtual-grid-spacer { position: relative; }
+        .virtual-card { position: absolute; box-sizing: border-box; overflow: hidden; }
+        .virtual-card .product-description {
+            display: -webkit-box; -webkit-line-clamp: 2; -webkit-box-orient: vertical; overflow: hidden;
+        }
+        .virtual-grid-loading {
+            height: 100%; display: flex; align-items: center; justify-content: center; color: #7f8c8d;
+        }
+        
         .search-icon {
             position: absolute;
             right: 15px;
@@ -280,6 +3134,9 @@ HTML_PAGE = '''
         .status-pending { background: #fff3cd; color: #856404; }
         .status-completed { background: #d4edda; color: #155724; }
         .status-in-progress { background: #cce5ff; color: #004085; }
+        .status-processing, .status-scheduled { background: #fff3cd; color: #856404; }
+        .status-shipped { background: #cce5ff; color: #004085; }
+        .status-cancelled { background: #f8d7da; color: #721c24; }
         
         .image-upload-container {
             margin: 1rem 0;
@@ -407,6 +3264,7 @@ HTML_PAGE = '''
                         <label>Phone</label>
                         <input type="tel" id="contactPhone" class="form-control" required>
                     </div>
+                    <div id="serviceQuote" class="form-group" style="grid-column: 1 / -1;"></div>
                     <div class="form-group" style="grid-column: 1 / -1;">
                         <button type="submit" class="btn btn-success">Submit Service Request</button>
                     </div>
@@ -425,17 +3283,20 @@ HTML_PAGE = '''
                     <input type="text" id="productSearch" placeholder="Search pipes, tools, equipment..." class="form-control">
                     <i class="fas fa-search search-icon"></i>
                 </div>
+                <div id="productFacets" class="facet-bar"></div>
             </div>
-            <div id="productsContainer" class="grid"></div>
+            <div id="productsContainer" class="virtual-grid"></div>
         </div>
         
         <!-- Cart Tab -->
         <div id="cart" class="tab-content">
             <h2>Shopping Cart</h2>
             <div id="cartContainer"></div>
+            <div id="cartSuggestions"></div>
             <div class="card">
                 <h3>Order Summary</h3>
                 <div id="cartSummary"></div>
+                <input type="email" id="orderEmail" class="form-control" placeholder="Email for an order confirmation (optional)">
                 <button class="btn btn-success" onclick="checkout()">Proceed to Checkout</button>
             </div>
         </div>
@@ -497,23 +3358,66 @@ HTML_PAGE = '''
                         <label>Product Image URL</label>
                         <input type="url" id="productImage" class="form-control" placeholder="https://example.com/image.jpg">
                     </div>
+                    <div class="form-group" style="grid-column: 1 / -1;">
+                        <label>Or Upload Image</label>
+                        <input type="file" id="productImageFile" class="form-control" accept="image/jpeg,image/png,image/gif,image/webp">
+                    </div>
                     <div class="form-group" style="grid-column: 1 / -1;">
                         <button type="submit" class="btn btn-success">Add Product</button>
                     </div>
                 </form>
             </div>
             
+            <div class="grid-2">
+                <div class="card">
+                    <h3>Latest Orders</h3>
+                    <div id="adminOrders"></div>
+                </div>
+                <div class="card">
+                    <h3>Latest Service Requests</h3>
+                    <div id="adminRequests"></div>
+                </div>
+                <div class="card">
+                    <h3>Low Stock</h3>
+                    <div id="adminLowStock"></div>
+                </div>
+            </div>
+            
             <h3>Existing Products</h3>
             <div id="adminProducts" class="grid"></div>
         </div>
     </div>
 
+    <script src="/static/js/product-grid.js"></script>
+    <script src="/static/js/cart.js"></script>
     <script>
         // Global variables
-        let shoppingCart = JSON.parse(localStorage.getItem('pipeDrillCart')) || [];
+        const serverCart = new ServerCart({
+            onChange: () => {
+                updateCartCount();
+                if (document.getElementById('cart').classList.contains('active')) updateCartDisplay();
+            },
+            onError: message => showNotification(message, 'error')
+        });
         let serviceRequests = JSON.parse(localStorage.getItem('pipeDrillServiceRequests')) || [];
         let productOrders = JSON.parse(localStorage.getItem('pipeDrillProductOrders')) || [];
         
+        // Idempotency keys, reused when the same submission is retried
+        const pendingSubmissions = {};
+        
+        function newIdempotencyKey() {
+            if (window.crypto && crypto.randomUUID) return crypto.randomUUID();
+            return Date.now().toString(36) + '-' + Math.random().toString(36).slice(2);
+        }
+        
+        function submissionKey(name, body) {
+            const pending = pendingSubmissions[name];
+            if (!pending || pending.body !== body) {
+                pendingSubmissions[name] = {body: body, key: newIdempotencyKey()};
+            }
+            return pendingSubmissions[name].key;
+        }
+        
         function switchTab(tabName) {
             // Hide all tabs
             document.querySelectorAll('.tab-content').forEach(tab => {
@@ -546,11 +3450,11 @@ HTML_PAGE = '''
             if (tabName === 'orders') loadOrders();
             if (tabName === 'products') loadProducts();
             if (tabName === 'services') loadServices();
-            if (tabName === 'admin') loadAdminProducts();
+            if (tabName === 'admin') openAdminPanel();
         }
         
         function updateCartCount() {
-            const count = shoppingCart.reduce((total, item) => total + item.quantity, 0);
+            const count = serverCart.count();
             document.getElementById('cartCount').textContent = count;
         }
         
@@ -565,6 +3469,44 @@ HTML_PAGE = '''
             }, 3000);
         }
         
+        // Live price estimate for the booking form
+        let quoteTimer = null;
+        
+        function updateServiceQuote() {
+            clearTimeout(quoteTimer);
+            quoteTimer = setTimeout(async () => {
+                const quote = document.getElementById('serviceQuote');
+                const booking = {
+                    service_type: document.getElementById('serviceType').value,
+                    material: document.getElementById('pipeMaterial').value,
+                    diameter: document.getElementById('pipeDiameter').value,
+                    hours: document.getElementById('estimatedHours').value
+                };
+                if (!booking.service_type || !booking.hours) {
+                    quote.innerHTML = '';
+                    return;
+                }
+                try {
+                    const response = await fetch('/api/quotes', {
+                        method: 'POST',
+                        headers: {'Content-Type': 'application/json'},
+                        body: JSON.stringify(booking)
+                    });
+                    const result = await response.json();
+                    quote.innerHTML = result.success ?
+                        `<strong>Estimated price: $${result.total.toFixed(2)}</strong>
+                         (${result.lines[0].hours} hours at $${result.lines[0].rate.toFixed(2)}/hour, tax included)` :
+                        `<span style="color: #e74c3c;">${result.error}</span>`;
+                } catch (error) {
+                    quote.innerHTML = '';
+                }
+            }, 250);
+        }
+        
+        ['serviceType', 'pipeMaterial', 'pipeDiameter', 'estimatedHours'].forEach(id => {
+            document.getElementById(id).addEventListener('input', updateServiceQuote);
+        });
+        
         // Service request form handler
         document.getElementById('serviceForm').addEventListener('submit', async (e) => {
             e.preventDefault();
@@ -581,13 +3523,18 @@ HTML_PAGE = '''
             };
             
             try {
+                const body = JSON.stringify(formData);
                 const response = await fetch('/api/service-request', {
                     method: 'POST',
-                    headers: {'Content-Type': 'application/json'},
-                    body: JSON.stringify(formData)
+                    headers: {
+                        'Content-Type': 'application/json',
+                        'Idempotency-Key': submissionKey('serviceRequest', body)
+                    },
+                    body: body
                 });
                 
                 const result = await response.json();
+                if (response.status !== 409) delete pendingSubmissions['serviceRequest'];
                 if (result.success) {
                     // Also save to localStorage for demo
                     const serviceRequest = {
@@ -601,6 +3548,7 @@ HTML_PAGE = '''
                     
                     showNotification('Service request submitted successfully!');
                     e.target.reset();
+                    document.getElementById('serviceQuote').innerHTML = '';
                 } else {
                     showNotification('Error: ' + result.error, 'error');
                 }
@@ -625,6 +3573,20 @@ HTML_PAGE = '''
             };
             
             try {
+                const imageFile = document.getElementById('productImageFile').files[0];
+                if (imageFile) {
+                    const upload = new FormData();
+                    upload.append('image', imageFile);
+                    const uploadResponse = await fetch('/api/upload-image', {method: 'POST', body: upload});
+                    const uploaded = await uploadResponse.json();
+                    if (!uploaded.success) {
+                        showNotification('Error uploading image: ' + uploaded.error, 'error');
+                        return;
+                    }
+                    formData.images = uploaded.images;
+                    formData.image = uploaded.images.card.jpeg;
+                }
+                
                 const response = await fetch('/api/add-product', {
                     method: 'POST',
                     headers: {'Content-Type': 'application/json'},
@@ -635,7 +3597,7 @@ HTML_PAGE = '''
                 if (result.success) {
                     showNotification('Product added successfully!');
                     e.target.reset();
-                    loadAdminProducts();
+                    if (!adminFeed) loadAdminProducts();
                     loadProducts(); // Refresh products tab
                 } else {
                     showNotification('Error: ' + result.error, 'error');
@@ -645,117 +3607,340 @@ HTML_PAGE = '''
             }
         });
         
-        // Load products from API with image support
+        // Products are paged into a virtualized grid, filtered by the selected facets
+        const productFilters = {category: new Set(), material: new Set(), price_band: new Set()};
+        const FACET_LABELS = {category: 'Category', material: 'Material', price_band: 'Price'};
+        let inStockOnly = false;
+        let productGrid = null;
+        let productSearchTimer = null;
+        
+        async function fetchProductPage(offset, limit) {
+            const params = new URLSearchParams({offset: offset, limit: limit});
+            Object.entries(productFilters).forEach(([facet, values]) =>
+                values.forEach(value => params.append(facet, value)));
+            if (inStockOnly) params.set('in_stock', '1');
+            const searchTerm = document.getElementById('productSearch').value.trim();
+            if (searchTerm) params.set('q', searchTerm);
+            const response = await fetch('/api/products?' + params);
+            const data = await response.json();
+            if (!data.success) throw new Error(data.error);
+            return data;
+        }
+        
         async function loadProducts() {
+            if (!productGrid) {
+                productGrid = new ProductGrid(document.getElementById('productsContainer'), {
+                    fetchPage: fetchProductPage,
+                    renderCard: productCardHtml,
+                    onPage: (data, page) => { if (page === 0) renderFacets(data.facets); }
+                });
+            }
+            try {
+                await productGrid.reset();
+            } catch (error) {
+                console.error('Error loading products:', error);
+                // Fallback to demo data
+                productGrid = null;
+                loadDemoProducts();
+            }
+        }
+        
+        function productCardHtml(product) {
+            return `
+                <div class="product-image">
+                    ${productImageHtml(product, 'thumb')}
+                </div>
+                <h3>${product.name}</h3>
+                <p class="product-description">${product.description}</p>
+                <p class="price">$${product.price.toFixed(2)}/${product.unit}</p>
+                <p>Stock: ${product.stock}</p>
+                <div style="margin: 10px 0;">
+                    ${(product.features || []).map(feature => 
+                        `<span class="feature-tag">${feature}</span>`
+                    ).join('')}
+                </div>
+                <button class="btn btn-primary" onclick="addToCart(${product.id})">
+                    Add to Cart
+                </button>
+            `;
+        }
+        
+        function facetLabel(facet, value) {
+            if (facet !== 'price_band') return value;
+            const [low, high] = value.split('-');
+            if (low === 'under') return `Under $${high}`;
+            if (high === 'plus') return `$${low}+`;
+            return `$${low} - $${high}`;
+        }
+        
+        function renderFacets(facets) {
+            const groups = Object.entries(facets).map(([facet, values]) => `
+                <div class="facet-group">
+                    <strong>${FACET_LABELS[facet] || facet}</strong>
+                    ${Object.entries(values).map(([value, counts]) => {
+                        const selected = productFilters[facet].has(value);
+                        return `<label class="facet-option">
+                            <input type="checkbox" data-facet="${facet}" value="${value.replace(/"/g, '&quot;')}"
+                                ${selected ? 'checked' : ''} ${counts.count === 0 && !selected ? 'disabled' : ''}>
+                            ${facetLabel(facet, value)}
+                            <span class="facet-count">(${counts.count}, ${counts.in_stock} in stock)</span>
+                        </label>`;
+                    }).join('')}
+                </div>
+            `).join('');
+            document.getElementById('productFacets').innerHTML = groups + `
+                <label class="facet-option">
+                    <input type="checkbox" id="inStockOnly" ${inStockOnly ? 'checked' : ''}> In stock only
+                </label>
+            `;
+        }
+        
+        document.addEventListener('change', function(e) {
+            if (!e.target.closest('#productFacets')) return;
+            if (e.target.id === 'inStockOnly') {
+                inStockOnly = e.target.checked;
+            } else {
+                const values = productFilters[e.target.dataset.facet];
+                e.target.checked ? values.add(e.target.value) : values.delete(e.target.value);
+            }
+            loadProducts();
+        });
+        
+        document.addEventListener('input', function(e) {
+            if (e.target.id !== 'productSearch') return;
+            clearTimeout(productSearchTimer);
+            productSearchTimer = setTimeout(loadProducts, 200);
+        });
+        
+        // Prefer uploaded, pre-sized variants over the full-size image URL
+        const FALLBACK_IMAGE = 'https://images.unsplash.com/photo-1581093458799-108dc8c4511a?w=400';
+        
+        // Remote images come through our cache; the original URL, then the fallback, are retried on error
+        function remoteImageHtml(url, alt, fallback, attrs = '') {
+            const src = /^https?:/.test(url) ? '/images/remote?url=' + encodeURIComponent(url) : url;
+            const retries = [url, fallback].filter(next => next && next !== src).join(' ');
+            return `<img src="${src}" alt="${alt}" ${attrs} data-retries="${retries}" onerror="retryImage(this)">`;
+        }
+        
+        function retryImage(img) {
+            const [next, ...rest] = img.dataset.retries.split(' ').filter(Boolean);
+            if (!next) {
+                img.onerror = null;
+                return;
+            }
+            img.dataset.retries = rest.join(' ');
+            img.src = next;
+        }
+        
+        function productImageHtml(product, variant) {
+            const images = product.images;
+            if (images && images[variant] && !images[variant].width) {
+                // Stored without Pillow: every variant is the original upload
+                return `<img src="${images[variant].jpeg}" alt="${product.name}" loading="lazy">`;
+            }
+            if (images && images[variant]) {
+                const larger = variant === 'thumb' ? images.card : images.detail;
+                const srcset = fmt => larger ?
+                    `${images[variant][fmt]} ${images[variant].width}w, ${larger[fmt]} ${larger.width}w` :
+                    images[variant][fmt];
+                return `<picture>
+                    <source type="image/webp" srcset="${srcset('webp')}" sizes="(max-width: 700px) 100vw, 400px">
+                    <img src="${images[variant].jpeg}" srcset="${srcset('jpeg')}" sizes="(max-width: 700px) 100vw, 400px" alt="${product.name}" loading="lazy" onerror="this.onerror=null; this.srcset=''; this.src='${images.original}'">
+                </picture>`;
+            }
+            if (product.image) {
+                return remoteImageHtml(product.image, product.name, FALLBACK_IMAGE, 'loading="lazy"');
+            }
+            return `<div class="image-placeholder"><i class="fas fa-box"></i></div>`;
+        }
+        
+        // Admin product card, shared by the initial load and live updates
+        function adminProductCard(product) {
+            return `
+                <div class="product-card" data-product-id="${product.id}">
+                    <div class="product-image">
+                        ${productImageHtml(product, 'thumb')}
+                    </div>
+                    <h3>${product.name}</h3>
+                    <p>${product.description}</p>
+                    <p class="price">$${product.price.toFixed(2)}/${product.unit}</p>
+                    <p>Stock: ${product.stock}</p>
+                    <div style="margin: 10px 0;">
+                        ${(product.features || []).map(feature => 
+                            `<span class="feature-tag">${feature}</span>`
+                        ).join('')}
+                    </div>
+                    <button class="btn btn-danger" onclick="deleteProduct(${product.id})">
+                        Delete Product
+                    </button>
+                </div>
+            `;
+        }
+        
+        // Load admin products
+        async function loadAdminProducts() {
             try {
                 const response = await fetch('/api/products');
                 const data = await response.json();
                 
                 if (data.success) {
-                    const container = document.getElementById('productsContainer');
-                    container.innerHTML = data.products.map(product => `
-                        <div class="product-card">
-                            <div class="product-image">
-                                ${product.image ? 
-                                    `<img src="${product.image}" alt="${product.name}" onerror="this.src='https://images.unsplash.com/photo-1581093458799-108dc8c4511a?w=400'">` :
-                                    `<div class="image-placeholder">
-                                        <i class="fas fa-box"></i>
-                                    </div>`
-                                }
-                            </div>
-                            <h3>${product.name}</h3>
-                            <p>${product.description}</p>
-                            <p class="price">$${product.price.toFixed(2)}/${product.unit}</p>
-                            <p>Stock: ${product.stock}</p>
-                            <div style="margin: 10px 0;">
-                                ${product.features.map(feature => 
-                                    `<span class="feature-tag">${feature}</span>`
-                                ).join('')}
-                            </div>
-                            <button class="btn btn-primary" onclick="addToCart(${product.id})">
-                                Add to Cart
-                            </button>
-                        </div>
-                    `).join('');
-                    
-                    // Add search functionality
-                    document.getElementById('productSearch').addEventListener('input', function(e) {
-                        const searchTerm = e.target.value.toLowerCase();
-                        const filteredProducts = data.products.filter(product => 
-                            product.name.toLowerCase().includes(searchTerm) || 
-                            product.description.toLowerCase().includes(searchTerm) ||
-                            product.category.toLowerCase().includes(searchTerm)
-                        );
-                        
-                        container.innerHTML = filteredProducts.map(product => `
-                            <div class="product-card">
-                                <div class="product-image">
-                                    ${product.image ? 
-                                        `<img src="${product.image}" alt="${product.name}" onerror="this.src='https://images.unsplash.com/photo-1581093458799-108dc8c4511a?w=400'">` :
-                                        `<div class="image-placeholder">
-                                            <i class="fas fa-box"></i>
-                                        </div>`
-                                    }
-                                </div>
-                                <h3>${product.name}</h3>
-                                <p>${product.description}</p>
-                                <p class="price">$${product.price.toFixed(2)}/${product.unit}</p>
-                                <p>Stock: ${product.stock}</p>
-                                <div style="margin: 10px 0;">
-                                    ${product.features.map(feature => 
-                                        `<span class="feature-tag">${feature}</span>`
-                                    ).join('')}
-                                </div>
-                                <button class="btn btn-primary" onclick="addToCart(${product.id})">
-                                    Add to Cart
-                                </button>
-                            </div>
-                        `).join('');
-                    });
+                    const container = document.getElementById('adminProducts');
+                    container.innerHTML = data.products.map(adminProductCard).join('');
                 }
             } catch (error) {
-                console.error('Error loading products:', error);
-                // Fallback to demo data
-                loadDemoProducts();
+                console.error('Error loading admin products:', error);
+            }
+        }
+        
+        // Admin activity cards for orders and service requests
+        const ADMIN_ACTIVITY_LIMIT = 20;
+        
+        function adminOrderCard(order) {
+            return `
+                <div class="order-card" data-record="order-${order.id}">
+                    <h4>Order #${order.id}</h4>
+                    <p>Items: ${order.items.length} | Total: $${Number(order.total).toFixed(2)}</p>
+                    <p>Date: ${new Date(order.timestamp).toLocaleString()}</p>
+                    <span class="order-status status-${order.status.toLowerCase()}">${order.status.toUpperCase()}</span>
+                </div>
+            `;
+        }
+        
+        function adminRequestCard(request) {
+            return `
+                <div class="order-card" data-record="service_request-${request.id}">
+                    <h4>${(request.service_type || '').replace('-', ' ').toUpperCase()} - ${request.pipe_material}</h4>
+                    <p>Contact: ${request.contact_name} (${request.contact_phone})</p>
+                    <p>Date: ${new Date(request.timestamp).toLocaleString()}</p>
+                    <span class="order-status status-${request.status.toLowerCase()}">${request.status.toUpperCase()}</span>
+                </div>
+            `;
+        }
+        
+        function prependCard(containerId, record, html) {
+            const container = document.getElementById(containerId);
+            const existing = container.querySelector(`[data-record="${record}"]`);
+            if (existing) {
+                // Already listed by the initial load or an earlier delivery
+                existing.outerHTML = html;
+                return;
+            }
+            if (!container.querySelector('[data-record], [data-product-id]')) container.innerHTML = '';
+            container.insertAdjacentHTML('afterbegin', html);
+            while (container.children.length > ADMIN_ACTIVITY_LIMIT) container.lastElementChild.remove();
+        }
+        
+        function setRecordStatus(record, status) {
+            const badge = document.querySelector(`[data-record="${record}"] .order-status`);
+            if (!badge) return;
+            badge.className = `order-status status-${status.toLowerCase()}`;
+            badge.textContent = status.toUpperCase();
+        }
+        
+        async function loadAdminActivity() {
+            try {
+                const [orderData, requestData] = await Promise.all([
+                    fetch('/api/product-orders').then(r => r.json()),
+                    fetch('/api/service-requests').then(r => r.json())
+                ]);
+                const latest = records => records.slice(-ADMIN_ACTIVITY_LIMIT).reverse();
+                document.getElementById('adminOrders').innerHTML = orderData.success && orderData.orders.length ?
+                    latest(orderData.orders).map(adminOrderCard).join('') : '<p>No orders yet.</p>';
+                document.getElementById('adminRequests').innerHTML = requestData.success && requestData.requests.length ?
+                    latest(requestData.requests).map(adminRequestCard).join('') : '<p>No service requests yet.</p>';
+            } catch (error) {
+                console.error('Error loading admin activity:', error);
             }
         }
         
-        // Load admin products
-        async function loadAdminProducts() {
+        async function loadLowStock() {
             try {
-                const response = await fetch('/api/products');
+                const response = await fetch('/api/low-stock?limit=50');
                 const data = await response.json();
-                
-                if (data.success) {
-                    const container = document.getElementById('adminProducts');
-                    container.innerHTML = data.products.map(product => `
-                        <div class="product-card">
-                            <div class="product-image">
-                                ${product.image ? 
-                                    `<img src="${product.image}" alt="${product.name}" onerror="this.src='https://images.unsplash.com/photo-1581093458799-108dc8c4511a?w=400'">` :
-                                    `<div class="image-placeholder">
-                                        <i class="fas fa-box"></i>
-                                    </div>`
-                                }
-                            </div>
-                            <h3>${product.name}</h3>
-                            <p>${product.description}</p>
-                            <p class="price">$${product.price.toFixed(2)}/${product.unit}</p>
-                            <p>Stock: ${product.stock}</p>
-                            <div style="margin: 10px 0;">
-                                ${product.features.map(feature => 
-                                    `<span class="feature-tag">${feature}</span>`
-                                ).join('')}
-                            </div>
-                            <button class="btn btn-danger" onclick="deleteProduct(${product.id})">
-                                Delete Product
-                            </button>
-                        </div>
-                    `).join('');
-                }
+                const container = document.getElementById('adminLowStock');
+                container.innerHTML = data.success && data.items.length ? data.items.map(item => `
+                    <div class="order-card">
+                        <h4>${item.name}</h4>
+                        <p>Stock: ${item.stock} | Reorder at: ${item.reorder_threshold}</p>
+                    </div>
+                `).join('') : '<p>Everything is above its reorder threshold.</p>';
             } catch (error) {
-                console.error('Error loading admin products:', error);
+                console.error('Error loading low stock:', error);
+            }
+        }
+        
+        // The admin panel opens the event stream first, then loads the listings,
+        // so nothing committed in between is missed. Events that arrive while the
+        // listings load are held back and applied on top of them.
+        let adminFeed = null;
+        let adminBacklog = null;
+        
+        function loadAdminListings() {
+            return Promise.all([loadAdminProducts(), loadAdminActivity(), loadLowStock()]);
+        }
+        
+        function onAdminEvent(type, handler) {
+            adminFeed.addEventListener(type, e => {
+                if (adminBacklog) adminBacklog.push(() => handler(e));
+                else handler(e);
+            });
+        }
+        
+        function openAdminPanel() {
+            if (adminFeed) return;
+            if (!window.EventSource) {
+                loadAdminListings();
+                return;
             }
+            
+            adminFeed = new EventSource('/api/events');
+            adminBacklog = [];
+            let loading = null;
+            const startListings = () => {
+                // On open, or on error if the stream never connects
+                if (loading) return;
+                loading = loadAdminListings().then(() => {
+                    const backlog = adminBacklog;
+                    adminBacklog = null;
+                    backlog.forEach(apply => apply());
+                });
+            };
+            adminFeed.addEventListener('open', startListings);
+            adminFeed.addEventListener('error', startListings);
+            onAdminEvent('order.created', e => {
+                const order = JSON.parse(e.data);
+                prependCard('adminOrders', `order-${order.id}`, adminOrderCard(order));
+            });
+            onAdminEvent('order.updated', e => {
+                const order = JSON.parse(e.data);
+                setRecordStatus(`order-${order.id}`, order.status);
+            });
+            onAdminEvent('service_request.created', e => {
+                const request = JSON.parse(e.data);
+                prependCard('adminRequests', `service_request-${request.id}`, adminRequestCard(request));
+            });
+            onAdminEvent('service_request.updated', e => {
+                const request = JSON.parse(e.data);
+                setRecordStatus(`service_request-${request.id}`, request.status);
+            });
+            onAdminEvent('product.created', e => {
+                const product = JSON.parse(e.data);
+                const card = document.querySelector(`#adminProducts [data-product-id="${product.id}"]`);
+                if (card) card.outerHTML = adminProductCard(product);
+                else document.getElementById('adminProducts').insertAdjacentHTML('beforeend', adminProductCard(product));
+            });
+            onAdminEvent('product.updated', e => {
+                const product = JSON.parse(e.data);
+                const card = document.querySelector(`#adminProducts [data-product-id="${product.id}"]`);
+                if (card) card.outerHTML = adminProductCard(product);
+            });
+            onAdminEvent('product.low_stock', loadLowStock);
+            onAdminEvent('product.restocked', loadLowStock);
+            onAdminEvent('product.deleted', e => {
+                const product = JSON.parse(e.data);
+                const card = document.querySelector(`#adminProducts [data-product-id="${product.id}"]`);
+                if (card) card.remove();
+            });
         }
         
         // Delete product function
@@ -770,7 +3955,7 @@ HTML_PAGE = '''
                 const result = await response.json();
                 if (result.success) {
                     showNotification('Product deleted successfully!');
-                    loadAdminProducts();
+                    if (!adminFeed) loadAdminProducts();
                     loadProducts();
                 } else {
                     showNotification('Error: ' + result.error, 'error');
@@ -826,7 +4011,7 @@ HTML_PAGE = '''
                         <div class="service-card">
                             <div class="product-image">
                                 ${service.image ? 
-                                    `<img src="${service.image}" alt="${service.name}" onerror="this.src='https://images.unsplash.com/photo-1581094794322-3a6e3c8aa330?w=400'">` :
+                                    remoteImageHtml(service.image, service.name, 'https://images.unsplash.com/photo-1581094794322-3a6e3c8aa330?w=400') :
                                     `<div class="image-placeholder">
                                         <i class="fas fa-cogs"></i>
                                     </div>`
@@ -887,77 +4072,91 @@ HTML_PAGE = '''
         }
         
         // Shopping cart functions
-        async function addToCart(productId) {
+        function addToCart(productId) {
+            const product = (productGrid && productGrid.get(productId)) || suggestedProducts.get(productId);
+            
+            if (!product) {
+                showNotification('Product not found', 'error');
+                return;
+            }
+            
+            const line = serverCart.get(productId);
+            if (line && line.quantity >= product.stock) {
+                showNotification(`Only ${product.stock} ${product.name} in stock`, 'error');
+                return;
+            }
+            
+            serverCart.add(product);
+            showNotification(`${product.name} added to cart!`);
+            loadSuggestions(productId);
+        }
+        
+        // Products often bought with the last one added, offered under the cart
+        const suggestedProducts = new Map();
+        
+        async function loadSuggestions(productId) {
             try {
-                const response = await fetch('/api/products');
+                const response = await fetch(`/api/products/${productId}/recommendations?limit=4`);
                 const data = await response.json();
-                const product = data.products.find(p => p.id === productId);
-                
-                if (!product) {
-                    showNotification('Product not found', 'error');
-                    return;
-                }
-                
-                const existingItem = shoppingCart.find(item => item.id === productId);
-                if (existingItem) {
-                    existingItem.quantity += 1;
-                } else {
-                    shoppingCart.push({
-                        id: product.id,
-                        name: product.name,
-                        price: product.price,
-                        quantity: 1,
-                        unit: product.unit,
-                        image: product.image
-                    });
-                }
-                
-                localStorage.setItem('pipeDrillCart', JSON.stringify(shoppingCart));
-                updateCartCount();
-                showNotification(`${product.name} added to cart!`);
+                if (!data.success) return;
+                const picks = data.recommendations.filter(product => !serverCart.get(product.id));
+                picks.forEach(product => suggestedProducts.set(product.id, product));
+                document.getElementById('cartSuggestions').innerHTML = picks.length ? `
+                    <div class="card">
+                        <h3>Frequently bought together</h3>
+                        ${picks.map(product => `
+                            <div class="cart-item">
+                                <span>${product.name} - $${Number(product.price).toFixed(2)}/${product.unit}</span>
+                                <button class="btn btn-outline" onclick="addToCart(${product.id})"><i class="fas fa-cart-plus"></i> Add</button>
+                            </div>
+                        `).join('')}
+                    </div>` : '';
             } catch (error) {
-                showNotification('Error adding product to cart', 'error');
+                console.error('Error loading suggestions:', error);
             }
         }
         
         function updateCartDisplay() {
             const container = document.getElementById('cartContainer');
             const summary = document.getElementById('cartSummary');
+            const items = serverCart.items();
             
-            if (shoppingCart.length === 0) {
+            if (items.length === 0) {
                 container.innerHTML = '<div class="card"><p>Your cart is empty</p></div>';
                 summary.innerHTML = '<p>Total: $0.00</p>';
                 return;
             }
             
-            container.innerHTML = shoppingCart.map(item => `
+            container.innerHTML = items.map(item => `
                 <div class="cart-item card">
                     <div style="display: flex; align-items: center; gap: 15px;">
                         ${item.image ? 
-                            `<img src="${item.image}" alt="${item.name}" style="width: 60px; height: 60px; object-fit: cover; border-radius: 8px;">` :
+                            remoteImageHtml(item.image, item.name, '', 'style="width: 60px; height: 60px; object-fit: cover; border-radius: 8px;"') :
                             `<div style="width: 60px; height: 60px; background: #3498db; display: flex; align-items: center; justify-content: center; border-radius: 8px; color: white;">
                                 <i class="fas fa-box"></i>
                             </div>`
                         }
                         <div>
                             <h4>${item.name}</h4>
-                            <p>$${item.price.toFixed(2)}/${item.unit}</p>
+                            <p>$${Number(item.price).toFixed(2)}/${item.unit}</p>
+                            ${item.available === false ? '<p style="color: #e74c3c;">No longer available</p>' : ''}
                         </div>
                     </div>
                     <div class="quantity-controls">
-                        <button class="btn btn-outline" onclick="updateQuantity(${item.id}, ${item.quantity - 1})">-</button>
+                        <button class="btn btn-outline" onclick="updateQuantity(${item.product_id}, ${item.quantity - 1})">-</button>
                         <span>${item.quantity}</span>
-                        <button class="btn btn-outline" onclick="updateQuantity(${item.id}, ${item.quantity + 1})">+</button>
-                        <button class="btn btn-danger" onclick="removeFromCart(${item.id})"><i class="fas fa-trash"></i></button>
+                        <button class="btn btn-outline" onclick="updateQuantity(${item.product_id}, ${item.quantity + 1})">+</button>
+                        <button class="btn btn-danger" onclick="removeFromCart(${item.product_id})"><i class="fas fa-trash"></i></button>
                     </div>
                 </div>
             `).join('');
             
-            const total = shoppingCart.reduce((sum, item) => sum + (item.price * item.quantity), 0);
+            const totals = serverCart.totals;
             summary.innerHTML = `
-                <p>Subtotal: $${total.toFixed(2)}</p>
-                <p>Tax (8%): $${(total * 0.08).toFixed(2)}</p>
-                <p><strong>Total: $${(total * 1.08).toFixed(2)}</strong></p>
+                <p>Subtotal: $${Number(totals.subtotal).toFixed(2)}</p>
+                <p>Tax: $${Number(totals.tax).toFixed(2)}</p>
+                <p><strong>Total: $${Number(totals.total).toFixed(2)}</strong></p>
+                <button class="btn btn-outline" onclick="shareCart()"><i class="fas fa-link"></i> Share cart</button>
             `;
         }
         
@@ -966,65 +4165,67 @@ HTML_PAGE = '''
                 removeFromCart(productId);
                 return;
             }
-            
-            const item = shoppingCart.find(item => item.id === productId);
-            if (item) {
-                item.quantity = newQuantity;
-                localStorage.setItem('pipeDrillCart', JSON.stringify(shoppingCart));
-                updateCartDisplay();
-                updateCartCount();
-            }
+            serverCart.setQuantity(productId, newQuantity);
         }
         
         function removeFromCart(productId) {
-            shoppingCart = shoppingCart.filter(item => item.id !== productId);
-            localStorage.setItem('pipeDrillCart', JSON.stringify(shoppingCart));
-            updateCartDisplay();
-            updateCartCount();
+            serverCart.remove(productId);
             showNotification('Item removed from cart');
         }
         
-        async function checkout() {
-            if (shoppingCart.length === 0) {
-                showNotification('Your cart is empty', 'error');
-                return;
+        async function shareCart() {
+            await serverCart.flush();
+            const url = serverCart.shareUrl();
+            if (!url) return;
+            try {
+                await navigator.clipboard.writeText(url);
+                showNotification('Cart link copied to clipboard');
+            } catch (error) {
+                showNotification(`Share this link: ${url}`);
             }
-            
+        }
+        
+        async function checkout() {
             try {
-                const orderData = {
-                    items: shoppingCart,
-                    total: shoppingCart.reduce((sum, item) => sum + (item.price * item.quantity), 0) * 1.08
-                };
+                const orderData = await serverCart.checkoutBody();
+                if (!orderData) {
+                    showNotification('Your cart is empty', 'error');
+                    return;
+                }
+                const email = document.getElementById('orderEmail').value.trim();
+                if (email) orderData.email = email;
                 
+                const body = JSON.stringify(orderData);
                 const response = await fetch('/api/place-order', {
                     method: 'POST',
-                    headers: {'Content-Type': 'application/json'},
-                    body: JSON.stringify(orderData)
+                    headers: {
+                        'Content-Type': 'application/json',
+                        'Idempotency-Key': submissionKey('order', body)
+                    },
+                    body: body
                 });
                 
                 const result = await response.json();
+                if (response.status !== 409) delete pendingSubmissions['order'];
                 if (result.success) {
                     // Also save to localStorage for demo
                     const order = {
                         id: Date.now(),
-                        items: [...shoppingCart],
+                        items: serverCart.items(),
                         date: new Date().toLocaleDateString(),
                         status: 'pending',
-                        total: orderData.total
+                        total: serverCart.totals.total
                     };
                     productOrders.push(order);
                     localStorage.setItem('pipeDrillProductOrders', JSON.stringify(productOrders));
                     
-                    shoppingCart = [];
-                    localStorage.setItem('pipeDrillCart', JSON.stringify(shoppingCart));
-                    
-                    updateCartDisplay();
-                    updateCartCount();
+                    serverCart.forget();
                     
                     showNotification('Order placed successfully!');
                     switchTab('orders');
                 } else {
                     showNotification('Error placing order: ' + result.error, 'error');
+                    serverCart.refresh(true);
                 }
             } catch (error) {
                 showNotification('Network error. Please try again.', 'error');
@@ -1115,74 +4316,261 @@ HTML_PAGE = '''
         
         // Initialize when page loads
         document.addEventListener('DOMContentLoaded', () => {
+            serverCart.open().catch(error => console.error('Error opening cart:', error));
             updateCartCount();
             loadProducts();
             loadServices();
         });
+        
+        // Pick up changes made to a shared cart while this tab was in the background
+        document.addEventListener('visibilitychange', () => {
+            if (!document.hidden) serverCart.refresh();
+        });
     </script>
 </body>
 </html>
 '''
 
+ASSETS.build()
+HOME_PAGE = build_page(HTML_PAGE, 'home')
+with open(os.path.join(app.root_path, 'index1.html'), encoding='utf-8') as f:
+    INDEX1_PAGE = build_page(f.read(), 'index1')
+
 # API Routes
 @app.route('/')
 def home():
-    return HTML_PAGE
+    return HOME_PAGE.response()
+
+@app.route('/index1.html')
+def index1():
+    return INDEX1_PAGE.response()
+
+@app.route('/assets/<name>')
+def serve_page_asset(name):
+    body = PAGE_ASSETS.get(name)
+    if body is None:
+        abort(404)
+    return body.response(immutable=True)
 
 @app.route('/static/<path:filename>')
 def serve_static(filename):
-    return send_from_directory('static', filename)
+    path = ASSETS.files.get(filename)
+    if path is not None:
+        return send_asset(path, immutable=filename not in ASSETS.urls)
+    path = safe_join(os.path.abspath(STATIC_FOLDER), filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    return send_asset(path, immutable=bool(CONTENT_ADDRESSED.match(filename)))
 
 @app.route('/api/products')
 def get_products():
-    data = load_data(PRODUCTS_FILE)
-    return jsonify({'success': True, 'products': data.get('products', [])})
+    filters = {facet: request.args.getlist(facet) for facet in FACET_NAMES if request.args.getlist(facet)}
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    limit = request.args.get('limit', type=int)
+    FACETS.refresh()
+    result = FACETS.query(filters, in_stock=request.args.get('in_stock') == '1',
+                          search=request.args.get('q', '').strip(), offset=offset,
+                          limit=None if limit is None else max(limit, 0))
+    return jsonify({'success': True, **result})
+
+@app.route('/api/products/<int:product_id>/recommendations')
+def get_recommendations(product_id):
+    """Products most often bought with this one, skipping any no longer sold or in stock"""
+    catalog = current_catalog()
+    if product_id not in catalog.products_by_id:
+        return jsonify({'success': False, 'error': 'Product not found'}), 404
+    limit = min(max(request.args.get('limit', 4, type=int), 0), MAX_RECOMMENDATIONS)
+    RECOMMENDATIONS.refresh(shared_db())
+    recommendations = []
+    for other_id, orders in RECOMMENDATIONS.neighbors_of(product_id):
+        if len(recommendations) == limit:
+            break
+        product = catalog.products_by_id.get(other_id)
+        if product is not None and product.get('stock', 0) > 0:
+            recommendations.append({**product, 'bought_together': orders})
+    return jsonify({'success': True, 'product_id': product_id, 'recommendations': recommendations})
 
 @app.route('/api/services')
 def get_services():
-    data = load_data(PRODUCTS_FILE)
-    return jsonify({'success': True, 'services': data.get('services', [])})
+    return jsonify({'success': True, 'services': current_catalog().services})
+
+@app.route('/api/quotes', methods=['POST'])
+def create_quote():
+    """Price one booking, or a job of many under bookings"""
+    try:
+        data = request.get_json() or {}
+        bookings = data.get('bookings', [data]) if isinstance(data, dict) else None
+        if not isinstance(bookings, list) or not bookings:
+            raise ValueError('bookings must be a non-empty list')
+        if len(bookings) > MAX_QUOTE_LINES:
+            raise ValueError(f'At most {MAX_QUOTE_LINES} bookings can be quoted at once')
+        return jsonify({'success': True, **price_quote(bookings, current_catalog())})
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
 
 @app.route('/api/service-request', methods=['POST'])
+@idempotent
 def submit_service_request():
     try:
         data = request.get_json()
-        requests = load_data(REQUESTS_FILE) or []
-        
-        new_request = {
-            'id': len(requests) + 1,
-            **data,
-            'timestamp': datetime.now().isoformat(),
-            'status': 'Pending',
-            'type': 'service'
-        }
-        
-        requests.append(new_request)
-        save_data(REQUESTS_FILE, requests)
+        with data_lock(REQUESTS_FILE):
+            requests = load_data(REQUESTS_FILE) or []
+            
+            new_request = {
+                'id': len(requests) + 1,
+                **data,
+                'timestamp': datetime.now().isoformat(),
+                'status': 'Pending',
+                'type': 'service'
+            }
+            
+            requests.append(new_request)
+            save_data(REQUESTS_FILE, requests)
+        after_commit(publish_event, 'service_request.created', new_request)
+        after_commit(notify, 'booking_acknowledgement', new_request.get('contact_email'), request=new_request)
+        after_commit(notify_admin, f"New service request #{new_request['id']}",
+                     service=new_request.get('service_type'), contact=new_request.get('contact_name'),
+                     phone=new_request.get('contact_phone'), hours=new_request.get('estimated_hours'))
         
         return jsonify({'success': True, 'request_id': new_request['id']})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
 @app.route('/api/place-order', methods=['POST'])
+@idempotent
 def place_order():
     try:
         data = request.get_json()
-        orders = load_data(ORDERS_FILE) or []
-        
-        new_order = {
-            'id': len(orders) + 1,
-            'items': data.get('items', []),
-            'total': data.get('total', 0),
-            'timestamp': datetime.now().isoformat(),
-            'status': 'Processing',
-            'type': 'product'
-        }
-        
-        orders.append(new_order)
-        save_data(ORDERS_FILE, orders)
+        cart_id = data.get('cart_id')
+        destination, strategy = fulfillment_request(data)
+        cart = None
+        if cart_id:
+            cart, items, total = checkout_cart(cart_id)
+        else:
+            items, total = data.get('items', []), data.get('total', 0)
+        try:
+            # Stock is taken and the order saved under both locks, so two checkouts
+            # can never both take the last units
+            with data_locks(ORDERS_FILE, PRODUCTS_FILE):
+                STOCK_INDEX.refresh()
+                FACETS.refresh()
+                LOCATION_STOCK.refresh()
+                products_data = load_data(PRODUCTS_FILE)
+                products_by_id = {p['id']: p for p in products_data.get('products', [])}
+                allocations = allocate(order_lines(items, products_by_id), products_by_id,
+                                       catalog_locations(products_data), destination, strategy)
+                changed = apply_allocations(products_data, allocations, -1)
+                if changed:
+                    save_catalog(products_data)
+                try:
+                    orders = load_data(ORDERS_FILE) or []
+                    
+                    new_order = {
+                        'id': len(orders) + 1,
+                        'items': items,
+                        'total': total,
+                        'timestamp': datetime.now().isoformat(),
+                        'status': 'Processing',
+                        'type': 'product'
+                    }
+                    if data.get('email'):
+                        new_order['email'] = data['email']
+                    if allocations:
+                        new_order['allocations'] = allocations
+                    if destination is not None:
+                        new_order['ship_to'] = data['ship_to']
+                    
+                    orders.append(new_order)
+                    save_data(ORDERS_FILE, orders)
+                except Exception:
+                    if changed:
+                        apply_allocations(products_data, allocations, 1)
+                        save_catalog(products_data)
+                    raise
+                after_commit(fold_new_order, new_order)
+                if changed:
+                    after_commit(inventory_changed, products_data, changed)
+        except Exception:
+            if cart is not None:
+                return_cart(cart)
+            raise
+        if changed:
+            after_commit(publish_events, 'product.updated', changed)
+        after_commit(publish_event, 'order.created', new_order)
+        after_commit(notify, 'order_confirmation', new_order.get('email'), order=new_order)
+        after_commit(notify_admin, f"New order #{new_order['id']}", items=len(new_order['items']),
+                     total=new_order['total'])
         
-        return jsonify({'success': True, 'order_id': new_order['id']})
+        return jsonify({'success': True, 'order_id': new_order['id'], 'allocations': allocations})
+    except CartConflict as e:
+        return jsonify({'success': False, 'error': str(e), 'product_id': e.product_id, 'available': e.available}), 409
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/carts', methods=['POST'])
+def create_cart():
+    try:
+        data = request.get_json(silent=True) or {}
+        db = shared_db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            evict_carts(db)
+            now = time.time()
+            cart = {'id': secrets.token_urlsafe(16), 'version': 0, 'lines': {}, 'changes': []}
+            db.execute('INSERT INTO carts VALUES (?, 0, ?, ?, ?, ?)', (cart['id'], '{}', '[]', now, now + CART_TTL))
+            # A browser moving its local cart to the server sends it as ops
+            save_cart(db, cart, apply_cart_ops(db, cart, data.get('ops', [])))
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        return jsonify({'success': True, **cart_response(cart)})
+    except CartConflict as e:
+        return jsonify({'success': False, 'error': str(e), 'product_id': e.product_id, 'available': e.available}), 409
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/carts/<cart_id>')
+def get_cart(cart_id):
+    cart = load_cart(shared_db(), cart_id)
+    if cart is None:
+        return jsonify({'success': False, 'error': 'Cart not found or expired'}), 404
+    return jsonify({'success': True, **cart_response(cart, request.args.get('since', type=int))})
+
+@app.route('/api/carts/<cart_id>', methods=['PATCH'])
+def update_cart(cart_id):
+    try:
+        data = request.get_json() or {}
+        since = data.get('since')
+        db = shared_db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            cart = load_cart(db, cart_id)
+            if cart is None:
+                db.execute('ROLLBACK')
+                return jsonify({'success': False, 'error': 'Cart not found or expired'}), 404
+            try:
+                touched = apply_cart_ops(db, cart, data.get('ops', []))
+            except CartConflict as e:
+                db.execute('ROLLBACK')
+                # Send what the cart really holds so the client can drop its optimistic change
+                return jsonify({'success': False, 'error': str(e), 'product_id': e.product_id,
+                                'available': e.available, **cart_response(load_cart(shared_db(), cart_id), since)}), 409
+            save_cart(db, cart, touched)
+            db.execute('COMMIT')
+        except Exception:
+            if db.in_transaction:
+                db.execute('ROLLBACK')
+            raise
+        return jsonify({'success': True, **cart_response(cart, since)})
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
@@ -1202,36 +4590,1159 @@ def get_product_orders():
 def add_product():
     try:
         data = request.get_json()
-        products_data = load_data(PRODUCTS_FILE)
-        products = products_data.get('products', [])
-        
-        new_product = {
-            'id': max([p['id'] for p in products], default=0) + 1,
-            **data
-        }
-        
-        products.append(new_product)
-        products_data['products'] = products
-        save_data(PRODUCTS_FILE, products_data)
+        with data_lock(PRODUCTS_FILE):
+            STOCK_INDEX.refresh()
+            FACETS.refresh()
+            LOCATION_STOCK.refresh()
+            products_data = load_data(PRODUCTS_FILE)
+            products = products_data.get('products', [])
+            
+            # The generated id wins over any id in the body
+            new_product = {
+                **data,
+                'id': max([p['id'] for p in products], default=0) + 1
+            }
+            
+            products.append(new_product)
+            products_data['products'] = products
+            save_catalog(products_data)
+            CATALOG.publish(products_data)
+            stock_changed(new_product)
+            FACETS.update(new_product)
+        publish_event('product.created', new_product)
+        prefetch_image(new_product.get('image'))
         
         return jsonify({'success': True, 'product_id': new_product['id']})
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
+@app.route('/api/events')
+def stream_events():
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('since', '')
+    subscriber = EVENT_BROKER.subscribe(int(last_event_id) if last_event_id.isdigit() else None)
+
+    def stream():
+        try:
+            yield 'retry: 3000\n\n'
+            while not subscriber.dropped:
+                try:
+                    event_id, event_type, data = subscriber.get(timeout=EVENT_HEARTBEAT)
+                except queue.Empty:
+                    yield ': keep-alive\n\n'
+                    continue
+                yield f'id: {event_id}\nevent: {event_type}\ndata: {data}\n\n'
+        finally:
+            EVENT_BROKER.unsubscribe(subscriber)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/metrics/rate-limits')
+def get_rate_limit_metrics():
+    db = shared_db()
+    endpoints = [
+        {'scope': scope, 'endpoint': endpoint, 'throttled': throttled,
+         'last_throttled_at': datetime.fromtimestamp(last).isoformat() if last else None}
+        for scope, endpoint, throttled, last in db.execute(
+            'SELECT scope, endpoint, throttled, last_throttled_at FROM rate_limit_stats ORDER BY throttled DESC')
+    ]
+    clients = [
+        {'bucket': key, 'throttled': throttled}
+        for key, throttled in db.execute(
+            'SELECT key, throttled FROM rate_buckets WHERE throttled > 0 ORDER BY throttled DESC LIMIT 20')
+    ]
+    return jsonify({'success': True, 'limits': RATE_LIMITS, 'endpoints': endpoints, 'top_clients': clients})
+
 @app.route('/api/delete-product/<int:product_id>', methods=['DELETE'])
 def delete_product(product_id):
     try:
-        products_data = load_data(PRODUCTS_FILE)
-        products = products_data.get('products', [])
-        
-        products = [p for p in products if p['id'] != product_id]
-        products_data['products'] = products
-        save_data(PRODUCTS_FILE, products_data)
+        with data_lock(PRODUCTS_FILE):
+            STOCK_INDEX.refresh()
+            FACETS.refresh()
+            LOCATION_STOCK.refresh()
+            products_data = load_data(PRODUCTS_FILE)
+            products = products_data.get('products', [])
+            
+            products = [p for p in products if p['id'] != product_id]
+            products_data['products'] = products
+            save_catalog(products_data)
+            CATALOG.publish(products_data)
+            STOCK_INDEX.remove(product_id)
+            LOCATION_STOCK.remove(product_id)
+            FACETS.remove(product_id)
+        publish_event('product.deleted', {'id': product_id})
         
         return jsonify({'success': True})
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/products/<int:product_id>/inventory', methods=['PATCH'])
+def update_inventory(product_id):
+    try:
+        data = request.get_json() or {}
+        for field in ('stock', 'adjust', 'reorder_threshold'):
+            if field in data and not isinstance(data[field], int):
+                raise ValueError(f'{field} must be an integer')
+        location_id = data.get('location')
+        if location_id is not None and not isinstance(location_id, str):
+            raise ValueError('location must be a string')
+        with data_lock(PRODUCTS_FILE):
+            STOCK_INDEX.refresh()
+            FACETS.refresh()
+            LOCATION_STOCK.refresh()
+            products_data = load_data(PRODUCTS_FILE)
+            product = next((p for p in products_data.get('products', []) if p['id'] == product_id), None)
+            if product is None:
+                return jsonify({'success': False, 'error': 'Product not found'}), 404
+            stocks = stock_by_location(product)
+            if location_id is None:
+                # Without a location only a product held at one yard can be set
+                if len(stocks) > 1:
+                    raise ValueError('location is required for a product stocked at several locations')
+                location_id = next(iter(stocks), catalog_locations(products_data)[0]['id'])
+            elif location_id not in {l['id'] for l in catalog_locations(products_data)}:
+                raise ValueError(f'Unknown location {location_id!r}')
+            stock = data.get('stock', stocks.get(location_id, 0)) + data.get('adjust', 0)
+            if stock < 0:
+                raise ValueError('Stock cannot go below zero')
+            set_location_stock(product, location_id, stock)
+            if 'reorder_threshold' in data:
+                product['reorder_threshold'] = data['reorder_threshold']
+            save_catalog(products_data)
+            CATALOG.publish(products_data)
+            stock_changed(product)
+            FACETS.update(product)
+        publish_event('product.updated', product)
+        return jsonify({'success': True, 'product': product})
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/locations')
+def get_locations():
+    LOCATION_STOCK.refresh()
+    locations = [{**location, **LOCATION_STOCK.totals(location['id'])} for location in current_catalog().locations]
+    return jsonify({'success': True, 'locations': locations})
+
+@app.route('/api/locations', methods=['POST'])
+def save_location():
+    """Add a location, or update the fields given for an existing one"""
+    try:
+        data = request.get_json() or {}
+        with data_lock(PRODUCTS_FILE):
+            products_data = load_data(PRODUCTS_FILE)
+            locations = list(catalog_locations(products_data))
+            position = next((i for i, l in enumerate(locations) if l['id'] == data.get('id')), len(locations))
+            location = {**(locations[position] if position < len(locations) else {}),
+                        **{field: data[field] for field in LOCATION_FIELDS if field in data}}
+            locations[position:position + 1] = [location]
+            products_data['locations'] = locations
+            save_catalog(products_data)
+            CATALOG.publish(products_data)
+        publish_event('location.updated', location)
+        return jsonify({'success': True, 'location': location})
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/locations/<location_id>/stock')
+def get_location_stock(location_id):
+    LOCATION_STOCK.refresh()
+    catalog = current_catalog()
+    if location_id not in catalog.locations_by_id:
+        return jsonify({'success': False, 'error': 'Location not found'}), 404
+    items = [{'id': product_id, 'name': catalog.products_by_id[product_id].get('name'), 'stock': units}
+             for product_id, units in sorted(LOCATION_STOCK.at(location_id).items())
+             if product_id in catalog.products_by_id]
+    return jsonify({'success': True, 'location': location_id, 'items': items})
+
+@app.route('/api/allocations', methods=['POST'])
+def preview_allocation():
+    """Where an order would ship from, without taking any stock"""
+    try:
+        data = request.get_json() or {}
+        destination, strategy = fulfillment_request(data)
+        catalog = current_catalog()
+        allocations = allocate(order_lines(data.get('items', []), catalog.products_by_id),
+                               catalog.products_by_id, catalog.locations, destination, strategy)
+        return jsonify({'success': True, 'allocations': allocations})
+    except CartConflict as e:
+        return jsonify({'success': False, 'error': str(e), 'product_id': e.product_id, 'available': e.available}), 409
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/catalog/status')
+def get_catalog_status():
+    catalog = current_catalog()
+    return jsonify({'success': CATALOG.error is None, 'products': len(catalog.products),
+                    'services': len(catalog.services),
+                    'loaded_at': datetime.fromtimestamp(catalog.loaded_at).isoformat(),
+                    'error': CATALOG.error})
+
+@app.route('/api/ready')
+def get_readiness():
+    """200 once create_app has warmed this process up, 503 until then"""
+    return jsonify({'success': STARTUP.ready, 'ready': STARTUP.ready, 'phase': STARTUP.phase,
+                    'phases': STARTUP.completed, 'pid': os.getpid(),
+                    'preloaded': STARTUP.ready and STARTUP.pid != os.getpid(),
+                    'catalog_error': CATALOG.error, 'data_problems': INTEGRITY.current()}), 200 if STARTUP.ready else 503
+
+@app.route('/api/low-stock')
+def get_low_stock():
+    STOCK_INDEX.refresh()
+    items = STOCK_INDEX.low(request.args.get('limit', type=int))
+    return jsonify({'success': True, 'items': items})
+
+@app.route('/api/orders/<int:order_id>/status', methods=['PATCH'])
+def update_order_status(order_id):
+    return update_status(ORDERS_FILE, 'order', ORDER_TRANSITIONS, order_id)
+
+@app.route('/api/service-requests/<int:request_id>/status', methods=['PATCH'])
+def update_service_request_status(request_id):
+    return update_status(REQUESTS_FILE, 'service_request', SERVICE_REQUEST_TRANSITIONS, request_id)
+
+@app.route('/api/orders/status', methods=['PATCH'])
+def bulk_update_order_status():
+    return bulk_update_status(ORDERS_FILE, 'order', ORDER_TRANSITIONS)
+
+@app.route('/api/service-requests/status', methods=['PATCH'])
+def bulk_update_service_request_status():
+    return bulk_update_status(REQUESTS_FILE, 'service_request', SERVICE_REQUEST_TRANSITIONS)
+
+def update_status(filename, kind, transitions, record_id):
+    try:
+        data, status = status_change_request()
+        updated, errors = transition_status(filename, kind, transitions, [record_id], status,
+                                            data.get('actor'), data.get('note'))
+        if errors:
+            error = errors[record_id]
+            return jsonify({'success': False, 'error': error}), 404 if error == 'Not found' else 409
+        return jsonify({'success': True, kind: updated[0]})
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+def bulk_update_status(filename, kind, transitions):
+    try:
+        data, status = status_change_request()
+        ids = data.get('ids')
+        if not isinstance(ids, list) or not all(isinstance(i, int) for i in ids):
+            raise ValueError('ids must be a list of integer ids')
+        if len(ids) > MAX_BULK_TRANSITION:
+            raise ValueError(f'At most {MAX_BULK_TRANSITION} ids can be updated at once')
+        updated, errors = transition_status(filename, kind, transitions, ids, status,
+                                            data.get('actor'), data.get('note'))
+        return jsonify({'success': not errors, 'updated': [r['id'] for r in updated],
+                        'errors': {str(i): error for i, error in errors.items()}})
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/status-audit')
+def get_status_audit():
+    kind = request.args.get('kind')
+    record_id = request.args.get('id', type=int)
+    entries = []
+    raw = STORAGE.read(STATUS_AUDIT_FILE) or b''
+    # A last line without its newline is an append torn by a crash, and is
+    # left out; a torn line the next append has since ended is skipped
+    for line in raw[:raw.rfind(b'\n') + 1].splitlines():
+        if not line.strip():
+            continue
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue
+        if not isinstance(entry, dict):
+            continue
+        if (kind is None or entry.get('kind') == kind) and (record_id is None or entry.get('id') == record_id):
+            entries.append(entry)
+    return jsonify({'success': True, 'entries': entries[-500:]})
+
+@app.route('/api/technicians')
+def get_technicians():
+    rows = shared_db().execute('SELECT id, name, skills, materials FROM technicians WHERE active = 1 ORDER BY id')
+    return jsonify({'success': True, 'technicians': [technician_from_row(row) for row in rows]})
+
+@app.route('/api/technicians', methods=['POST'])
+def add_technician():
+    try:
+        name, skills, materials = validate_technician(request.get_json() or {}, current_catalog())
+        db = shared_db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            cursor = db.execute('INSERT INTO technicians (name, skills, materials, created_at) VALUES (?, ?, ?, ?)',
+                                (name, json.dumps(skills), json.dumps(materials), time.time()))
+            bump_schedule_version(db)
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        technician = {'id': cursor.lastrowid, 'name': name, 'skills': skills, 'materials': materials}
+        return jsonify({'success': True, 'technician': technician})
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/technicians/<int:technician_id>/schedule')
+def get_technician_schedule(technician_id):
+    rows = shared_db().execute(
+        'SELECT request_id, start_slot, end_slot FROM technician_bookings '
+        'WHERE technician_id = ? AND end_slot > ? ORDER BY start_slot',
+        (technician_id, slot_at(datetime.now())))
+    return jsonify({'success': True, 'bookings': [{'request_id': request_id, **booking_times(start, end)}
+                                                  for request_id, start, end in rows]})
+
+@app.route('/api/schedule/earliest')
+def get_earliest_slot():
+    """Earliest opening for hours of a service type on a material"""
+    try:
+        category, material, count = booking_needs({'service_type': request.args.get('service_type'),
+                                                   'pipe_material': request.args.get('material'),
+                                                   'estimated_hours': request.args.get('hours')},
+                                                  current_catalog())
+        SCHEDULE.refresh(shared_db())
+        opening = SCHEDULE.earliest(category, material, count)
+        if opening is None:
+            return jsonify({'success': False, 'error': no_opening(category, material)}), 404
+        technician_id, start = opening
+        return jsonify({'success': True, 'technician': SCHEDULE.technicians[technician_id],
+                        'hours': count, **booking_times(start, start + count)})
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+@app.route('/api/service-requests/schedule', methods=['POST'])
+def schedule_service_requests():
+    """Assign technicians to the given pending requests, or to all of them"""
+    try:
+        data = request.get_json(silent=True) or {}
+        ids = data.get('ids')
+        if ids is not None:
+            if not isinstance(ids, list) or not all(isinstance(i, int) for i in ids):
+                raise ValueError('ids must be a list of integer ids')
+            if len(ids) > MAX_SCHEDULE_BATCH:
+                raise ValueError(f'At most {MAX_SCHEDULE_BATCH} requests can be scheduled at once')
+        updated, errors = schedule_requests(ids, data.get('actor'))
+        return jsonify({'success': not errors, 'scheduled': updated,
+                        'errors': {str(i): error for i, error in errors.items()}})
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/upload-image', methods=['POST'])
+def upload_image():
+    try:
+        upload = request.files.get('image')
+        if upload is None:
+            return jsonify({'success': False, 'error': 'No image file in the upload'}), 400
+        images, pending = store_image(upload.read())
+
+        product_id = request.form.get('product_id', type=int)
+        if product_id is not None:
+            with data_lock(PRODUCTS_FILE):
+                products_data = load_data(PRODUCTS_FILE)
+                product = next((p for p in products_data.get('products', []) if p['id'] == product_id), None)
+                if product is None:
+                    return jsonify({'success': False, 'error': 'Product not found'}), 404
+                product['images'] = images
+                save_catalog(products_data)
+                CATALOG.publish(products_data)
+            publish_event('product.updated', product)
+
+        return jsonify({'success': True, 'images': images, 'pending': pending}), 202 if pending else 200
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
+@app.route('/api/images/<digest>')
+def get_image_status(digest):
+    if not re.fullmatch('[0-9a-f]{64}', digest) or not os.path.isdir(image_dir(digest)):
+        return jsonify({'success': False, 'error': 'Image not found'}), 404
+    directory = image_dir(digest)
+    ready = sorted(name for name in os.listdir(directory) if not name.endswith('.tmp'))
+    return jsonify({'success': True, 'files': ready})
+
+@app.route('/images/remote')
+def serve_remote_image():
+    url = request.args.get('url', '')
+    if not proxy_allowed(url):
+        return jsonify({'success': False, 'error': 'Images are only proxied from: '
+                        + ', '.join(sorted(IMAGE_PROXY_HOSTS))}), 403
+    try:
+        # Stream from one open handle, so another worker evicting the file
+        # mid-response cannot unlink it out from under send_file
+        try:
+            f = open(REMOTE_IMAGES.get(url), 'rb')
+        except FileNotFoundError:
+            # Evicted between the cache lookup and the open
+            f = open(REMOTE_IMAGES.fetch(url).result(), 'rb')
+        extension = image_extension(f.read(16))
+        f.seek(0)
+    except ImageFetchError as e:
+        return jsonify({'success': False, 'error': str(e)}), 502
+    # The URL hash is the ETag: hits refresh the file's mtime for the LRU
+    response = send_file(f, mimetype=mimetypes.guess_type(f'image.{extension}')[0],
+                         etag=url_digest(url), conditional=True, max_age=IMMUTABLE_MAX_AGE)
+    response.cache_control.public = True
+    return response
+
+@app.route('/api/notifications/outbox')
+def get_outbox_status():
+    counts = dict(shared_db().execute('SELECT status, COUNT(*) FROM outbox GROUP BY status').fetchall())
+    failed = [
+        {'id': message_id, 'template': template, 'recipient': recipient, 'attempts': attempts, 'error': error}
+        for message_id, template, recipient, attempts, error in shared_db().execute(
+            "SELECT id, template, recipient, attempts, last_error FROM outbox WHERE status = 'failed' "
+            'ORDER BY id DESC LIMIT 20')
+    ]
+    return jsonify({'success': True, 'counts': counts, 'recent_failures': failed})
+
+@app.cli.command('send-notifications')
+def send_notifications_command():
+    """Send every notification that is due, then exit"""
+    db = shared_db()
+    total = 0
+    while True:
+        sent = send_notifications(db)
+        if not sent:
+            break
+        total += sent
+    click.echo(f'Sent {total} notifications')
+
+@app.cli.command('prefetch-images')
+def prefetch_images_command():
+    """Cache every remote product and service image that is not cached yet"""
+    catalog = current_catalog()
+    urls = {item.get('image') for item in catalog.products + catalog.services}
+    pending = {url: REMOTE_IMAGES.fetch(url) for url in urls
+               if isinstance(url, str) and proxy_allowed(url) and REMOTE_IMAGES.cached(url) is None}
+    failed = 0
+    for url, future in pending.items():
+        if future.exception() is not None:
+            failed += 1
+            click.echo(f'Failed: {future.exception()}', err=True)
+    click.echo(f'Cached {len(pending) - failed} images, {failed} failed')
+
+@app.cli.command('update-recommendations')
+def update_recommendations_command():
+    """Fold every order not yet counted into the frequently-bought-together lists"""
+    click.echo(f'Folded in {update_recommendations()} orders')
+
+@app.cli.command('schedule-requests')
+def schedule_requests_command():
+    """Assign technicians to every pending service request"""
+    updated, errors = schedule_requests(actor='scheduler')
+    for record in updated:
+        click.echo(f"#{record['id']}: {record['technician']} from {record['scheduled_start']}")
+    for request_id, error in errors.items():
+        click.echo(f'#{request_id}: {error}')
+    click.echo(f'Scheduled {len(updated)} requests')
+
+@app.cli.command('compress-static')
+def compress_static():
+    """Write .gz (and .br when brotli is installed) siblings for text assets"""
+    for path in set(ASSETS.files.values()):
+        mimetype = mimetypes.guess_type(path)[0] or ''
+        if not mimetype.startswith(COMPRESSIBLE_TYPES):
+            continue
+        with open(path, 'rb') as f:
+            raw = f.read()
+        write_atomic(path + '.gz', gzip.compress(raw, 9))
+        if brotli is not None:
+            write_atomic(path + '.br', brotli.compress(raw))
+        click.echo(f'{path}: {len(raw)} bytes -> {os.path.getsize(path + ".gz")} gzip')
+
+# Online, incremental backups of the data directory. Files are staged as hard
+# links inside data/, so BACKUP_DIR may be on another filesystem.
+BACKUP_DIR = os.environ.get('BACKUP_DIR', 'backups')
+BACKUP_STAGING = os.path.join('data', '.backup-staging')
+BACKUP_CHUNK_SIZE = 4 * 1024 * 1024
+
+def backup_lock():
+    """Lock taken by backup create and prune, so a prune never deletes chunks a running backup reused"""
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    return FileLock(os.path.join(BACKUP_DIR, 'backup'))
+
+def clear_staging():
+    if os.path.isdir(BACKUP_STAGING):
+        for entry in os.listdir(BACKUP_STAGING):
+            os.remove(os.path.join(BACKUP_STAGING, entry))
+        os.rmdir(BACKUP_STAGING)
+
+def data_files():
+    """Data files in data/, by codec extension"""
+    return sorted(os.path.join('data', entry) for entry in os.listdir('data')
+                  if any(entry.endswith(codec.extension) for codec in CODECS.values()))
+
+def snapshot_data_dir(staging):
+    """Take a consistent cut of the data directory into staging
+
+    Every data file's lock is held only while its current version is
+    hard-linked (base files are replaced atomically, so the link freezes
+    them) and the length of its append-only journal is noted. Copying and
+    compressing happen afterwards without blocking writers. staging must
+    be on data/'s filesystem, as hard links cannot cross filesystems.
+    """
+    cut = {}
+    with data_locks(*data_files()):
+        for filename in data_files():
+            for path in (filename, journal_file(filename)):
+                if os.path.exists(path):
+                    link = os.path.join(staging, os.path.basename(path))
+                    os.link(path, link)
+                    cut[os.path.basename(path)] = (link, os.path.getsize(path))
+        if os.path.exists(STATUS_AUDIT_FILE):
+            link = os.path.join(staging, os.path.basename(STATUS_AUDIT_FILE))
+            os.link(STATUS_AUDIT_FILE, link)
+            cut[os.path.basename(STATUS_AUDIT_FILE)] = (link, os.path.getsize(STATUS_AUDIT_FILE))
+    return cut
+
+def store_chunks(path, size):
+    """Store a file as gzip chunks named by their hash, skipping chunks already stored"""
+    chunks, digest = [], hashlib.sha256()
+    with open(path, 'rb') as f:
+        remaining = size
+        while remaining > 0:
+            chunk = f.read(min(BACKUP_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            digest.update(chunk)
+            chunk_hash = hashlib.sha256(chunk).hexdigest()
+            blob = os.path.join(BACKUP_DIR, 'chunks', chunk_hash[:2], chunk_hash + '.gz')
+            if not os.path.exists(blob):
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                write_atomic(blob, gzip.compress(chunk, 6))
+            chunks.append(chunk_hash)
+    return {'size': size, 'sha256': digest.hexdigest(), 'chunks': chunks}
+
+def create_backup():
+    """Back up the data directory, returning the manifest path"""
+    with backup_lock():
+        # Backups run one at a time, so anything left in staging is from one that crashed
+        clear_staging()
+        os.makedirs(BACKUP_STAGING)
+        try:
+            taken_at = time.time()
+            cut = snapshot_data_dir(BACKUP_STAGING)
+            files = {name: store_chunks(link, size) for name, (link, size) in cut.items()}
+        finally:
+            clear_staging()
+        manifest = {'taken_at': datetime.fromtimestamp(taken_at).isoformat(), 'timestamp': taken_at, 'files': files}
+        path = os.path.join(BACKUP_DIR, 'manifests',
+                            datetime.fromtimestamp(taken_at).strftime('%Y%m%dT%H%M%S%f') + '.json')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_atomic(path, json.dumps(manifest, indent=2).encode('utf-8'))
+    return path
+
+def backup_manifests():
+    """All backup manifests, oldest first"""
+    directory = os.path.join(BACKUP_DIR, 'manifests')
+    if not os.path.isdir(directory):
+        return []
+    manifests = []
+    for entry in sorted(os.listdir(directory)):
+        if entry.endswith('.json'):
+            with open(os.path.join(directory, entry)) as f:
+                manifests.append((os.path.join(directory, entry), json.load(f)))
+    return manifests
+
+def restore_file(entry, destination):
+    """Reassemble a backed-up file and verify it against its recorded hash"""
+    digest = hashlib.sha256()
+    tmp = f'{destination}.{os.getpid()}.restore.tmp'
+    with open(tmp, 'wb') as out:
+        for chunk_hash in entry['chunks']:
+            with open(os.path.join(BACKUP_DIR, 'chunks', chunk_hash[:2], chunk_hash + '.gz'), 'rb') as f:
+                chunk = gzip.decompress(f.read())
+            digest.update(chunk)
+            out.write(chunk)
+        out.flush()
+        os.fsync(out.fileno())
+    if digest.hexdigest() != entry['sha256']:
+        os.remove(tmp)
+        raise ValueError(f'{destination} does not match its backup checksum')
+    os.replace(tmp, destination)
+
+def restore_backup(manifest, target_dir='data'):
+    """Put the data directory back to the state recorded in manifest"""
+    os.makedirs(target_dir, exist_ok=True)
+    names = set(manifest['files'])
+    bases = sorted({name[:-len('.journal')] if name.endswith('.journal') else name for name in names})
+    with data_locks(*(os.path.join(target_dir, base) for base in bases)):
+        for base in bases:
+            # A journal written after the backup would replay onto the restored file
+            journal = journal_file(os.path.join(target_dir, base))
+            if os.path.exists(journal) and os.path.basename(journal) not in names:
+                os.remove(journal)
+        for name, entry in manifest['files'].items():
+            restore_file(entry, os.path.join(target_dir, name))
+
+@app.cli.group('backup')
+def backup_group():
+    """Online backups and point-in-time restore of data/"""
+
+@backup_group.command('create')
+def backup_create():
+    """Take an incremental backup without stopping the app"""
+    require_local_storage()
+    if hasattr(os, 'nice'):
+        os.nice(10)
+    path = create_backup()
+    click.echo(f'Backup written to {path}')
+
+@backup_group.command('list')
+def backup_list():
+    """List backups, oldest first"""
+    for path, manifest in backup_manifests():
+        size = sum(entry['size'] for entry in manifest['files'].values())
+        click.echo(f"{manifest['taken_at']}  {len(manifest['files'])} files  {size} bytes  {path}")
+
+@backup_group.command('restore')
+@click.option('--at', 'at', required=True, help='ISO timestamp; the latest backup taken at or before it is restored.')
+@click.option('--target-dir', default='data', help='Directory to restore into.')
+def backup_restore(at, target_dir):
+    """Restore the data files as of a point in time"""
+    require_local_storage()
+    target = datetime.fromisoformat(at).timestamp()
+    candidates = [(path, m) for path, m in backup_manifests() if m['timestamp'] <= target]
+    if not candidates:
+        raise click.ClickException(f'No backup was taken at or before {at}')
+    path, manifest = candidates[-1]
+    restore_backup(manifest, target_dir)
+    click.echo(f"Restored {len(manifest['files'])} files from the backup taken at {manifest['taken_at']}")
+
+@backup_group.command('prune')
+@click.option('--keep-days', type=int, default=30, help='Delete backups older than this many days.')
+def backup_prune(keep_days):
+    """Delete old backups and the chunks no remaining backup uses"""
+    cutoff = time.time() - keep_days * 24 * 3600
+    with backup_lock():
+        manifests = backup_manifests()
+        keep = manifests[-1:] + [(p, m) for p, m in manifests[:-1] if m['timestamp'] >= cutoff]
+        for path, manifest in manifests:
+            if (path, manifest) not in keep:
+                os.remove(path)
+        used = {chunk for _, m in keep for entry in m['files'].values() for chunk in entry['chunks']}
+        removed = 0
+        chunk_dir = os.path.join(BACKUP_DIR, 'chunks')
+        for root, _, names in os.walk(chunk_dir):
+            for name in names:
+                if name[:-len('.gz')] not in used:
+                    os.remove(os.path.join(root, name))
+                    removed += 1
+    click.echo(f'Kept {len(keep)} backups, removed {len(manifests) - len(keep)} backups and {removed} chunks')
+
+@app.cli.command('migrate-data')
+@click.option('--to', 'target', type=click.Choice(sorted(CODECS)), default=DATA_CODEC,
+              help='Storage format to convert the data files to.')
+@click.option('--keep/--no-keep', default=False, help='Keep the original files after converting.')
+def migrate_data(target, keep):
+    """Convert the files in data/ to another storage format"""
+    require_local_storage()
+    target_codec = CODECS[target]
+    for entry in sorted(os.listdir('data')):
+        source = os.path.join('data', entry)
+        name, extension = os.path.splitext(entry)
+        codec = codec_for(source)
+        if codec.extension != extension or codec is target_codec:
+            continue
+        with open(source, 'rb') as f:
+            data = codec.loads(f.read())
+        if isinstance(data, list):
+            apply_journal(data, read_journal(source)[0])
+        destination = data_file(name, target)
+        save_data(destination, data)
+        if not keep:
+            os.remove(source)
+            if os.path.exists(journal_file(source)):
+                os.remove(journal_file(source))
+        click.echo(f'{source} -> {destination} '
+                   f'({os.path.getsize(destination)} bytes)')
+
+# Integrity checks and crash recovery for the data files
+INTEGRITY_WORKERS = int(os.environ.get('INTEGRITY_WORKERS', os.cpu_count() or 1))
+INTEGRITY_READ_SIZE = 8 * 1024 * 1024
+INTEGRITY_PARALLEL_BYTES = 64 * 1024 * 1024
+MAX_RECORD_BYTES = 64 * 1024 * 1024
+DATA_AUTO_REPAIR = os.environ.get('DATA_AUTO_REPAIR', '0') == '1'
+JSON_SPACE = re.compile(r'[ \t\n\r]*')
+
+def scan_json_records(f):
+    """Yield the records of a JSON array file, reading it a chunk at a time
+
+    Memory stays at one chunk plus one record however long the history is.
+    Raises CorruptDataError at the first thing that is not a well-formed
+    array of records, after yielding every record before it.
+    """
+    decode = codecs.getincrementaldecoder('utf-8')().decode
+    decoder = json.JSONDecoder()
+    text, pos, eof, expect = '', 0, False, '['
+    while True:
+        pos = JSON_SPACE.match(text, pos).end()
+        if pos == len(text):
+            if eof:
+                break
+            chunk = f.read(INTEGRITY_READ_SIZE)
+            eof = not chunk
+            text, pos = text[pos:] + decode(chunk, final=eof), 0
+            continue
+        if expect == '[':
+            if text[pos] != '[':
+                raise CorruptDataError('does not start with a JSON array')
+            pos, expect = pos + 1, 'first'
+        elif expect == 'first' and text[pos] == ']':
+            pos, expect = pos + 1, 'end'
+        elif expect in ('first', 'record'):
+            try:
+                record, end = decoder.raw_decode(text, pos)
+            except ValueError as e:
+                if eof or len(text) - pos > MAX_RECORD_BYTES:
+                    raise CorruptDataError(f'unreadable record: {e}') from e
+                chunk = f.read(INTEGRITY_READ_SIZE)
+                eof = not chunk
+                text, pos = text[pos:] + decode(chunk, final=eof), 0
+                continue
+            if not isinstance(record, dict) or 'id' not in record:
+                raise CorruptDataError('a record is not an object with an id')
+            yield record
+            pos, expect = end, ','
+        elif expect == ',':
+            if text[pos] not in ',]':
+                raise CorruptDataError(f'expected , or ] but found {text[pos]!r}')
+            pos, expect = pos + 1, 'record' if text[pos] == ',' else 'end'
+        else:
+            raise CorruptDataError('unexpected data after the end of the array')
+    if expect != 'end':
+        raise CorruptDataError('ends before the array is closed, the file was truncated')
+
+def scan_msgpack_records(f):
+    """Yield the records of a columnar msgpack file, unpacking one row at a time"""
+    if f.read(1) == b'\x90':
+        # An empty list is stored as a plain empty array
+        if f.read(1):
+            raise CorruptDataError('unexpected data after the end of the array')
+        return
+    f.seek(0)
+    unpacker = msgpack.Unpacker(f, raw=False, strict_map_key=False, read_size=INTEGRITY_READ_SIZE,
+                                max_buffer_size=MAX_RECORD_BYTES)
+    codec = CODECS['msgpack']
+    try:
+        columns = None
+        for _ in range(unpacker.read_map_header()):
+            key = unpacker.unpack()
+            if key == '__columns__':
+                columns = unpacker.unpack()
+            elif key == '__rows__' and isinstance(columns, list) and 'id' in columns:
+                for _ in range(unpacker.read_array_header()):
+                    row = unpacker.unpack()
+                    if not isinstance(row, list) or len(row) != len(columns):
+                        raise CorruptDataError('a row does not match the column list')
+                    yield codec._from_columnar({'__columns__': columns, '__rows__': [row]})[0]
+            else:
+                raise CorruptDataError(f'unexpected key {key!r} in a list of records')
+        if columns is None:
+            raise CorruptDataError('no column list')
+    except msgpack.OutOfData as e:
+        raise CorruptDataError('ends before the last record, the file was truncated') from e
+    except CORRUPTION_ERRORS as e:
+        raise CorruptDataError(f'unreadable record: {e}') from e
+    try:
+        unpacker.unpack()
+    except msgpack.OutOfData:
+        return
+    raise CorruptDataError('unexpected data after the last record')
+
+def list_file(path):
+    """Whether a data file holds a list of records rather than a document"""
+    with open(path, 'rb') as f:
+        head = f.read(64)
+    if codec_for(path) is CODECS['msgpack']:
+        return head == b'\x90' or head.startswith(b'\x82\xab__columns__')
+    return head.lstrip().startswith(b'[')
+
+def scan_records(path):
+    """Yield the records of a list data file as they are read"""
+    with open(path, 'rb') as f:
+        if codec_for(path) is CODECS['msgpack']:
+            if msgpack is None:
+                raise RuntimeError('msgpack is not installed')
+            yield from scan_msgpack_records(f)
+        else:
+            yield from scan_json_records(f)
+
+TORN_ENTRY = 'torn last entry'
+
+def scan_journal(path, offset=0):
+    """(valid entries, bytes they span, problem) for a journal read from offset
+
+    A last line without its newline is a write torn by a crash; it was
+    never applied, and cutting it off loses nothing.
+    """
+    entries, valid = [], offset
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return entries, valid, None
+    with f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b'\n'):
+                return entries, valid, TORN_ENTRY
+            if line.strip():
+                try:
+                    entry = parse_journal_entry(line)
+                except ValueError as e:
+                    return entries, valid, f'unreadable entry at byte {valid}: {e}'
+                entries.append(entry)
+            valid += len(line)
+    return entries, valid, None
+
+def check_data_file(filename, checked=None):
+    """Validate a data file and its journal, returning a report
+
+    checked is the report of an earlier clean pass. When the file has not
+    been replaced since, only journal entries appended after it are read.
+    """
+    report = {'file': filename, 'stamp': file_stamp(filename), 'records': None, 'problem': None,
+              'journal_entries': 0, 'journal_bytes': 0, 'journal_problem': None}
+    offset = 0
+    if checked and checked['stamp'] == report['stamp'] and not checked['problem']:
+        report['records'] = checked['records']
+        report['journal_entries'] = checked['journal_entries']
+        offset = checked['journal_bytes']
+    elif report['stamp'] is not None:
+        try:
+            if list_file(filename):
+                report['records'] = sum(1 for _ in scan_records(filename))
+            else:
+                with open(filename, 'rb') as f:
+                    data = codec_for(filename).loads(f.read())
+                if not isinstance(data, dict):
+                    raise CorruptDataError('is not a document')
+                report['records'] = len(data)
+        except CorruptDataError as e:
+            report['problem'] = str(e)
+        except CORRUPTION_ERRORS as e:
+            report['problem'] = f'unreadable: {e}'
+    journal = journal_file(filename)
+    if (file_stamp(journal) or (0, 0, 0))[2] < offset:
+        # The journal was dropped or cut since the last pass
+        offset, report['journal_entries'] = 0, 0
+    entries, report['journal_bytes'], report['journal_problem'] = scan_journal(journal, offset)
+    report['journal_entries'] += len(entries)
+    return report
+
+def check_data_files(full=False):
+    """Reports for every data file, checking large ones in parallel processes
+
+    Results of clean passes are kept in the shared database, so unless
+    full is set a restart only reads what was written since the last one.
+    """
+    db = shared_db()
+    previous = {} if full else {
+        filename: json.loads(report) for filename, report in db.execute('SELECT file, report FROM integrity_checks')}
+    for report in previous.values():
+        report['stamp'] = tuple(report['stamp']) if report['stamp'] else None
+    filenames = data_files()
+    sizes = sum(os.path.getsize(filename) for filename in filenames)
+    if len(filenames) > 1 and sizes > INTEGRITY_PARALLEL_BYTES and INTEGRITY_WORKERS > 1 and not green():
+        with ProcessPoolExecutor(min(INTEGRITY_WORKERS, len(filenames))) as pool:
+            reports = list(pool.map(check_data_file, filenames, [previous.get(f) for f in filenames]))
+    else:
+        reports = [check_data_file(filename, previous.get(filename)) for filename in filenames]
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        db.execute('DELETE FROM integrity_checks')
+        db.executemany('INSERT INTO integrity_checks (file, report, checked_at) VALUES (?, ?, ?)',
+                       [(r['file'], json.dumps(r), time.time()) for r in reports
+                        if not r['problem'] and not r['journal_problem']])
+        db.execute('COMMIT')
+    except Exception:
+        db.execute('ROLLBACK')
+        raise
+    return reports
+
+def report_problems(report):
+    problems = []
+    if report['problem']:
+        problems.append(f"{report['file']}: {report['problem']}")
+    if report['journal_problem']:
+        problems.append(f"{journal_file(report['file'])}: {report['journal_problem']}")
+    return problems
+
+def keep_corrupt_copy(path):
+    """Hard-link a damaged file aside before it is repaired, for later inspection"""
+    aside = f'{path}.corrupt-{datetime.now().strftime("%Y%m%dT%H%M%S%f")}'
+    os.link(path, aside)
+    return aside
+
+def readable_records(path):
+    """The records of a damaged list file up to the first one that cannot be read"""
+    records = []
+    try:
+        for record in scan_records(path):
+            records.append(record)
+    except CorruptDataError:
+        pass
+    return records
+
+def restore_from_backups(filename, at_least=0):
+    """Put back the newest backed-up copy of filename that passes its check
+
+    A list file's copy must hold at least at_least records, so a restore
+    never drops records still readable in the damaged file. The copy's
+    own journal comes back with it. Entries of the current journal are
+    newer field updates and are replayed after it. Returns when the
+    restored backup was taken and how many records it holds, or None
+    when no backup holds a good enough copy.
+    """
+    base = os.path.basename(filename)
+    journal = journal_file(filename)
+    current, _, _ = scan_journal(journal)
+    for _, manifest in reversed(backup_manifests()):
+        if base not in manifest['files']:
+            continue
+        candidate = f'{filename}.{os.getpid()}.candidate'
+        try:
+            restore_file(manifest['files'][base], candidate)
+            if list_file(candidate):
+                records = sum(1 for _ in scan_records(candidate))
+                if records < at_least:
+                    raise CorruptDataError(f'holds {records} of the {at_least} readable records')
+            else:
+                with open(candidate, 'rb') as f:
+                    records = len(codec_for(candidate).loads(f.read()))
+            backed_up = []
+            if journal_file(base) in manifest['files']:
+                restore_file(manifest['files'][journal_file(base)], candidate + '.journal')
+                backed_up, _, _ = scan_journal(candidate + '.journal')
+                os.remove(candidate + '.journal')
+        except (OSError, CorruptDataError, *CORRUPTION_ERRORS):
+            if os.path.exists(candidate):
+                os.remove(candidate)
+            continue
+        os.replace(candidate, filename)
+        entries = backed_up + current
+        if entries:
+            write_atomic(journal, b''.join(json.dumps(e, separators=(',', ':')).encode('utf-8') + b'\n'
+                                           for e in entries))
+        elif os.path.exists(journal):
+            os.remove(journal)
+        return manifest['taken_at'], records
+    return None
+
+def repair_data_file(report, salvage=False):
+    """Bring one data file back to its last good state, describing each step taken
+
+    A journal is cut back to its last whole entry. A damaged base file is
+    set aside and replaced by the newest good backup holding at least the
+    records still readable in it, or with salvage by those records. When
+    neither applies the file is left alone, so nothing is dropped unasked.
+    """
+    filename, journal = report['file'], journal_file(report['file'])
+    actions = []
+    with data_lock(filename):
+        # Another process may have repaired it while we waited for the lock
+        report = check_data_file(filename)
+        if report['journal_problem']:
+            keep_corrupt_copy(journal)
+            with open(journal, 'rb') as f:
+                write_atomic(journal, f.read(report['journal_bytes']))
+            actions.append(f"cut {journal} back to its {report['journal_entries']} whole entries")
+        if report['problem']:
+            aside = keep_corrupt_copy(filename)
+            records = readable_records(filename) if list_file(filename) else []
+            restored = restore_from_backups(filename, at_least=len(records))
+            if restored is not None:
+                taken_at, count = restored
+                actions.append(f'restored {filename} from the backup taken at {taken_at} '
+                               f'({count} records, {len(records)} readable in the damaged file)')
+            elif salvage and list_file(filename):
+                apply_journal(records, scan_journal(journal)[0])
+                save_data(filename, records)
+                actions.append(f'kept the {len(records)} readable records of {filename}')
+            else:
+                os.remove(aside)
+                if records:
+                    actions.append(f'left {filename} as it is: no backup holds all {len(records)} records '
+                                   'still readable in it, rerun with --salvage to keep them')
+                else:
+                    actions.append(f'left {filename} as it is: no backup holds a good copy'
+                                   + (', rerun with --salvage to keep its readable records' if list_file(filename) else ''))
+    return actions
+
+class DataIntegrity:
+    """Data files found damaged in this process, and writes paused until they are repaired
+
+    Each file is listed with the stamps it had when the problem was seen.
+    Once either changes, as after `flask check-data --repair` in another
+    process, the file is checked again and dropped from the list if clean.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.problems = {}
+
+    def stamps(self, filename):
+        return file_stamp(filename), file_stamp(journal_file(filename))
+
+    def flag(self, filename, problem):
+        with self.lock:
+            self.problems[filename] = (self.stamps(filename), problem)
+
+    def record(self, report):
+        problems = report_problems(report)
+        with self.lock:
+            if problems:
+                self.problems[report['file']] = (self.stamps(report['file']), '; '.join(problems))
+            else:
+                self.problems.pop(report['file'], None)
+
+    def current(self):
+        """Problems that still stand, rechecking files that changed since they were seen"""
+        with self.lock:
+            flagged = list(self.problems.items())
+        for filename, (stamps, _) in flagged:
+            if self.stamps(filename) != stamps:
+                self.record(check_data_file(filename))
+        with self.lock:
+            return [problem for _, problem in self.problems.values()]
+
+INTEGRITY = DataIntegrity()
+
+def verify_data_files():
+    """Startup check: cut off torn journal writes, flag anything else damaged
+
+    Other repairs can lose data, so they wait for `flask check-data
+    --repair` unless DATA_AUTO_REPAIR is set. On a storage server's
+    clients there is nothing local to check; run check-data on its machine.
+    """
+    if not isinstance(STORAGE, LocalStorage):
+        return
+    for report in check_data_files():
+        lossless = not report['problem'] and report['journal_problem'] == TORN_ENTRY
+        if report_problems(report) and (DATA_AUTO_REPAIR or lossless):
+            for action in repair_data_file(report):
+                app.logger.warning('Repair: %s', action)
+            report = check_data_file(report['file'])
+        INTEGRITY.record(report)
+        for problem in report_problems(report):
+            app.logger.error('Data integrity: %s', problem)
+
+@app.before_request
+def refuse_writes_on_corrupt_data():
+    """Answer writes with 503 while a data file is damaged, so nothing is saved over it"""
+    if request.method not in WRITE_METHODS or not INTEGRITY.problems:
+        return None
+    problems = INTEGRITY.current()
+    if not problems:
+        return None
+    response = jsonify({'success': False, 'error': 'Writes are paused until the data files are repaired',
+                        'problems': problems})
+    response.status_code = 503
+    return response
+
+@app.cli.command('check-data')
+@click.option('--repair', is_flag=True, help='Recover damaged files from their journal or a backup.')
+@click.option('--salvage', is_flag=True, help='With --repair, keep the readable records of a file no backup holds.')
+@click.option('--full', is_flag=True, help='Read every file in full, even those unchanged since the last clean check.')
+def check_data_command(repair, salvage, full):
+    """Validate every data file and journal, optionally repairing them"""
+    require_local_storage()
+    start = time.perf_counter()
+    reports = check_data_files(full=full)
+    damaged = [report for report in reports if report_problems(report)]
+    for report in reports:
+        status = '; '.join(report_problems(report)) or 'ok'
+        records = '?' if report['records'] is None else report['records']
+        click.echo(f"{report['file']}: {records} records, "
+                   f"{report['journal_entries']} journal entries, {status}")
+    click.echo(f'Checked {len(reports)} files in {time.perf_counter() - start:.2f}s')
+    if damaged and repair:
+        for report in damaged:
+            for action in repair_data_file(report, salvage):
+                click.echo(f'Repair: {action}')
+        damaged = [report for report in check_data_files() if report_problems(report)]
+    if damaged:
+        raise click.ClickException(f'{len(damaged)} damaged files' + ('' if repair else ', rerun with --repair'))
+
+# Application factory; gunicorn --preload 'app:create_app()' runs it once in the master
+def check_config():
+    """Fail at startup on settings that would otherwise only break on first use"""
+    problems = []
+    if DATA_CODEC not in CODECS:
+        problems.append(f'DATA_CODEC must be one of {sorted(CODECS)}')
+    elif DATA_CODEC == 'msgpack' and msgpack is None:
+        problems.append('DATA_CODEC is msgpack but msgpack is not installed')
+    if app.config['MAIL_USE_TLS'] and app.config['MAIL_USE_SSL']:
+        problems.append('MAIL_USE_TLS and MAIL_USE_SSL cannot both be set')
+    if STORAGE_URL and not STORAGE_URL.startswith(('http://', 'https://')):
+        problems.append('STORAGE_URL must be an http:// or https:// URL')
+    if STORAGE_URL and not STORAGE_SECRET:
+        problems.append("STORAGE_SECRET must be set to the storage server's secret with STORAGE_URL")
+    if problems:
+        raise RuntimeError('; '.join(problems))
+
+def close_shared_db():
+    """Close this thread's shared state connection, which must not cross a fork"""
+    conn = getattr(_shared_state, 'conn', None)
+    if conn is not None:
+        conn.close()
+        _shared_state.conn = None
+
+def create_app():
+    """Run the startup phases and return the app, warmed up
+
+    Under gunicorn --preload this runs once in the master, so the parsed
+    catalog, product indexes and rate tables are inherited copy-on-write
+    by every worker instead of being built by each on its first requests.
+    Threads and database connections do not survive a fork, so none are
+    left behind here; workers start their own on first use.
+    """
+    if STARTUP.ready:
+        return app
+    STARTUP.running = True
+    try:
+        with STARTUP.step('config'):
+            check_config()
+        with STARTUP.step('storage'):
+            init_data()
+            shared_db()
+            if STORAGE_URL:
+                app.logger.warning('Carts and stock holds are kept on this node only; a cart '
+                                   'works only while its requests all reach this node')
+        with STARTUP.step('integrity'):
+            verify_data_files()
+        with STARTUP.step('catalog'):
+            catalog = current_catalog()
+        with STARTUP.step('indexes'):
+            STOCK_INDEX.refresh()
+            FACETS.refresh()
+            LOCATION_STOCK.refresh()
+            catalog.memo('rate_tables', lambda: build_rate_tables(catalog))
+            SCHEDULE.refresh(shared_db())
+    finally:
+        close_shared_db()
+        STARTUP.running = False
+    # Keep the collector from touching, and so copying, the inherited pages
+    gc.freeze()
+    STARTUP.ready = True
+    STARTUP.pid = os.getpid()
+    return app
+
 if __name__ == '__main__':
-    init_data()
-    app.run(debug=True, port=5000)
\ No newline at end of file
+    create_app().run(debug=True, port=5000)
\ No newline at end of file
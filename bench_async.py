@@ -0,0 +1,114 @@
+"""Time ordinary requests while many event streams are held open, sync vs async workers
+
+Usage: python bench_async.py [--streams N] [--requests N] [--concurrency N] [--workers N]
+
+Starts gunicorn on this directory's data twice, with sync workers and with
+ASYNC_WORKERS=1 (needs gevent), opens --streams event streams that stay
+connected like idle dashboards, then times product queries against each.
+Rate limiting is turned off for the run. Raise `ulimit -n` above twice
+--streams first.
+"""
+import argparse
+import http.client
+import os
+import selectors
+import socket
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+PORT = 5180
+
+
+def wait_ready(port, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=2)
+            conn.request('GET', '/api/ready')
+            if conn.getresponse().status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f'gunicorn on port {port} did not become ready')
+
+
+def open_streams(port, count, timeout):
+    """Open count event streams, returning the sockets and how many were answered"""
+    streams = []
+    selector = selectors.DefaultSelector()
+    for _ in range(count):
+        sock = socket.create_connection(('127.0.0.1', port))
+        sock.sendall(b'GET /api/events HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ)
+        streams.append(sock)
+    answered = 0
+    deadline = time.monotonic() + timeout
+    while answered < count and time.monotonic() < deadline:
+        for key, _ in selector.select(max(deadline - time.monotonic(), 0)):
+            selector.unregister(key.fileobj)
+            if key.fileobj.recv(4096).startswith(b'HTTP/1.1 200'):
+                answered += 1
+    selector.close()
+    return streams, answered
+
+
+def timed_get(port, path, timeout):
+    start = time.perf_counter()
+    try:
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+        conn.request('GET', path)
+        response = conn.getresponse()
+        response.read()
+        conn.close()
+        return time.perf_counter() - start if response.status == 200 else None
+    except OSError:
+        return None
+
+
+def run(mode, args):
+    env = dict(os.environ, RATE_LIMIT_ENABLED='0', ASYNC_WORKERS='1' if mode == 'async' else '0')
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-w', str(args.workers),
+                               '-b', f'127.0.0.1:{PORT}', 'app:create_app()'],
+                              cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_ready(PORT)
+        streams, answered = open_streams(PORT, args.streams, args.timeout)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(args.concurrency) as pool:
+            timings = list(pool.map(lambda _: timed_get(PORT, '/api/products?limit=48', args.timeout),
+                                    range(args.requests)))
+        elapsed = time.perf_counter() - start
+        for sock in streams:
+            sock.close()
+    finally:
+        server.terminate()
+        server.wait()
+    done = sorted(t for t in timings if t is not None)
+    p50 = done[len(done) // 2] * 1000 if done else float('nan')
+    p99 = done[min(len(done) - 1, len(done) * 99 // 100)] * 1000 if done else float('nan')
+    print(f'{mode:<8}{answered:>8}/{args.streams:<8}{len(done) / elapsed:>10.1f}'
+          f'{p50:>10.1f}{p99:>10.1f}{len(timings) - len(done):>8}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--streams', type=int, default=2000)
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--timeout', type=float, default=5)
+    args = parser.parse_args()
+
+    print(f'{args.workers} workers, {args.requests} product queries, {args.concurrency} at a time')
+    print(f'{"mode":<8}{"streams served":>16}{"req/s":>10}{"p50 ms":>10}{"p99 ms":>10}{"failed":>8}')
+    for mode in ('sync', 'async'):
+        run(mode, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""Compare encode/decode time and on-disk size of the storage codecs
+
+Usage: python bench_storage.py [--orders N] [--repeat N]
+"""
+import argparse
+import json
+import random
+import time
+from datetime import datetime
+
+from app import CODECS, msgpack, orjson
+
+
+def sample_orders(count):
+    """Build order records shaped like the ones place_order writes"""
+    rng = random.Random(42)
+    orders = []
+    for order_id in range(1, count + 1):
+        items = [{
+            'id': rng.randint(1, 6),
+            'name': rng.choice(['Stainless Steel Pipe 2-inch', 'Carbon Steel Pipe 3-inch',
+                                'Carbide Drill Bit Set', 'Pipe Clamping System']),
+            'price': round(rng.uniform(5, 500), 2),
+            'quantity': rng.randint(1, 20),
+            'unit': rng.choice(['foot', 'set', 'unit']),
+            'image': 'https://images.unsplash.com/photo-1581093458799-108dc8c4511a?w=400'
+        } for _ in range(rng.randint(1, 5))]
+        orders.append({
+            'id': order_id,
+            'items': items,
+            'total': round(sum(i['price'] * i['quantity'] for i in items) * 1.08, 2),
+            'timestamp': datetime(2024, 1, 1).isoformat(),
+            'status': 'Processing',
+            'type': 'product'
+        })
+    return orders
+
+
+class IndentedJSON:
+    """The previous save_data format, kept as the baseline"""
+    name = 'json (indent=2, stdlib)'
+
+    def dumps(self, data):
+        return json.dumps(data, indent=2).encode('utf-8')
+
+    def loads(self, raw):
+        return json.loads(raw)
+
+
+def best_of(repeat, fn):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--orders', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    orders = sample_orders(args.orders)
+    codecs = [IndentedJSON(), CODECS['json']]
+    if msgpack is not None:
+        codecs.append(CODECS['msgpack'])
+
+    print(f'{args.orders} orders, best of {args.repeat} '
+          f'(orjson {"available" if orjson else "missing"}, '
+          f'msgpack {"available" if msgpack else "missing"})')
+    print(f'{"codec":<26}{"encode ms":>12}{"decode ms":>12}{"bytes":>14}')
+    for codec in codecs:
+        raw = codec.dumps(orders)
+        assert codec.loads(raw) == orders
+        encode = best_of(args.repeat, lambda: codec.dumps(orders))
+        decode = best_of(args.repeat, lambda: codec.loads(raw))
+        print(f'{codec.name:<26}{encode * 1000:>12.1f}{decode * 1000:>12.1f}{len(raw):>14,}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+// PipeDrill Pro - Server-side cart
+// Mirrors a cart stored on the server: changes are shown at once, sent as
+// small add/set/remove ops, and reconciled with the versioned deltas the
+// server answers with. Anyone holding the cart link shares the same cart.
+class ServerCart {
+    constructor(options = {}) {
+        this.onChange = options.onChange || (() => {});
+        this.onError = options.onError || (() => {});
+        this.flushDelay = options.flushDelay || 150;
+        this.id = null;
+        this.version = 0;
+        this.lines = new Map();
+        this.totals = { items: 0, subtotal: 0, tax: 0, total: 0 };
+        this.queued = [];
+        this.sending = null;
+        this.timer = null;
+        this.retryDelay = 0;
+    }
+
+    // Open the cart from a shared ?cart= link, or the one this browser used last
+    async open() {
+        const shared = new URLSearchParams(location.search).get('cart');
+        const id = shared || localStorage.getItem('pipeDrillCartId');
+        if (id) {
+            this.id = id;
+            await this.refresh(true);
+            if (this.id) localStorage.setItem('pipeDrillCartId', this.id);
+        }
+        // Move a cart kept by the old localStorage-only version to the server,
+        // one item at a time so a product dropped from the catalog is skipped alone
+        const legacy = JSON.parse(localStorage.getItem('pipeDrillCart') || '[]');
+        localStorage.removeItem('pipeDrillCart');
+        for (const item of legacy) {
+            if (item.itemType === 'service' || !Number.isInteger(item.id)) continue;
+            this.change({ op: 'add', product_id: item.id, quantity: item.quantity }, item);
+            await this.flush();
+        }
+    }
+
+    items() {
+        return [...this.lines.values()];
+    }
+
+    get(productId) {
+        return this.lines.get(productId);
+    }
+
+    count() {
+        return this.items().reduce((total, line) => total + line.quantity, 0);
+    }
+
+    shareUrl() {
+        return this.id ? `${location.origin}${location.pathname}?cart=${encodeURIComponent(this.id)}` : null;
+    }
+
+    add(product, quantity = 1) {
+        this.change({ op: 'add', product_id: product.id, quantity }, product);
+    }
+
+    setQuantity(productId, quantity) {
+        this.change({ op: 'set', product_id: productId, quantity });
+    }
+
+    remove(productId) {
+        this.change({ op: 'remove', product_id: productId });
+    }
+
+    change(op, product) {
+        this.applyLocal(op, product);
+        this.queued.push(op);
+        this.onChange();
+        // While retrying, the pending retry sends this change too
+        if (!this.retryDelay) this.schedule(this.flushDelay);
+    }
+
+    schedule(delay) {
+        clearTimeout(this.timer);
+        this.timer = setTimeout(() => this.flush().catch(error => console.error('Error saving cart:', error)), delay);
+    }
+
+    // Put ops the server did not take back in front of the queue and try again later,
+    // backing off while the server keeps failing
+    retry(ops, response) {
+        this.queued = ops.concat(this.queued);
+        const retryAfter = response && Number(response.headers.get('Retry-After'));
+        this.retryDelay = retryAfter > 0 ? retryAfter * 1000 : Math.min(Math.max(this.retryDelay * 2, 2000), 30000);
+        this.schedule(this.retryDelay);
+    }
+
+    applyLocal(op, product) {
+        const line = this.lines.get(op.product_id);
+        const current = line ? line.quantity : 0;
+        const quantity = op.op === 'add' ? current + op.quantity : op.op === 'set' ? op.quantity : 0;
+        if (quantity > 0) {
+            const base = line || {
+                product_id: op.product_id, name: product && product.name, price: product && product.price,
+                unit: product && product.unit, image: product && product.image,
+                images: product && product.images, stock: product && product.stock, available: true
+            };
+            this.lines.set(op.product_id, { ...base, quantity });
+        } else {
+            this.lines.delete(op.product_id);
+        }
+        const subtotal = this.items().reduce((sum, item) => sum + (item.price || 0) * item.quantity, 0);
+        const taxRate = this.totals.subtotal ? this.totals.tax / this.totals.subtotal : 0.08;
+        this.totals = { items: this.count(), subtotal, tax: subtotal * taxRate, total: subtotal * (1 + taxRate) };
+    }
+
+    // Send queued ops, one request at a time, until nothing is left
+    async flush() {
+        clearTimeout(this.timer);
+        while (this.sending) await this.sending;
+        if (!this.queued.length) return;
+        const ops = this.queued;
+        this.queued = [];
+        this.sending = this.send(ops);
+        try {
+            await this.sending;
+        } finally {
+            this.sending = null;
+        }
+        // Ops put back by a failed send wait for their retry
+        if (this.queued.length && !this.retryDelay) await this.flush();
+    }
+
+    async send(ops) {
+        let response;
+        try {
+            response = await fetch(this.id ? `/api/carts/${encodeURIComponent(this.id)}` : '/api/carts', {
+                method: this.id ? 'PATCH' : 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ since: this.version, ops })
+            });
+        } catch (error) {
+            this.retry(ops);
+            this.onError('Network error, your cart will sync when the connection is back');
+            return;
+        }
+        // A proxy's error page is not JSON
+        const data = await response.json().catch(() => null);
+        const answered = [400, 404, 409].includes(response.status);
+        if (!answered && (!response.ok || !data || !data.success)) {
+            // Throttled, paused or failing: the ops were not applied, so keep them
+            this.retry(ops, response);
+            this.onError('Your cart could not be saved yet, retrying');
+            return;
+        }
+        this.retryDelay = 0;
+        if (response.status === 404) {
+            // The cart expired; start a new one with what this page still shows
+            this.id = null;
+            this.version = 0;
+            this.queued = this.items().map(line => ({ op: 'set', product_id: line.product_id, quantity: line.quantity }));
+            return;
+        }
+        if (response.status === 409 || response.status === 400) {
+            // The server rejected the change itself, for lack of stock or as invalid;
+            // show what the cart really holds instead of the optimistic edit
+            this.onError(data ? data.error : 'Your cart could not be updated');
+            await this.reload(true);
+            return;
+        }
+        if (data.cart_id !== this.id) {
+            this.id = data.cart_id;
+            this.version = 0;
+            localStorage.setItem('pipeDrillCartId', this.id);
+        }
+        this.apply(data);
+    }
+
+    // Catch up with changes made elsewhere, such as by a sales rep sharing the cart
+    async refresh(full = false) {
+        if (this.sending || this.queued.length) return;
+        await this.reload(full);
+    }
+
+    async reload(full) {
+        if (!this.id) {
+            if (full) this.forget();
+            return;
+        }
+        const query = full ? '' : `?since=${this.version}`;
+        try {
+            const response = await fetch(`/api/carts/${encodeURIComponent(this.id)}${query}`);
+            if (response.status === 404) {
+                this.forget();
+                return;
+            }
+            const data = await response.json();
+            if (data.success) this.apply(data);
+        } catch (error) {
+            console.error('Error refreshing cart:', error);
+        }
+    }
+
+    apply(data) {
+        if (data.version < this.version) return;
+        if (data.full) this.lines.clear();
+        data.lines.forEach(line => this.lines.set(line.product_id, line));
+        data.removed.forEach(productId => this.lines.delete(productId));
+        this.version = data.version;
+        this.totals = data.totals;
+        this.queued.forEach(op => this.applyLocal(op));
+        this.onChange();
+    }
+
+    // Everything checkout needs once pending changes have reached the server
+    async checkoutBody() {
+        await this.flush();
+        if (this.queued.length) throw new Error('Cart changes are not saved yet');
+        return this.id && this.lines.size ? { cart_id: this.id } : null;
+    }
+
+    forget() {
+        clearTimeout(this.timer);
+        this.id = null;
+        this.version = 0;
+        this.lines.clear();
+        this.queued = [];
+        this.retryDelay = 0;
+        this.totals = { items: 0, subtotal: 0, tax: 0, total: 0 };
+        localStorage.removeItem('pipeDrillCartId');
+        this.onChange();
+    }
+}
@@ -0,0 +1,18 @@
+"""gunicorn settings; set ASYNC_WORKERS=1 to serve from gevent workers
+
+Async workers hold up to WORKER_CONNECTIONS connections each on
+greenlets, so slow clients and open event streams no longer tie up a
+whole worker. Blocking disk and SQLite calls are moved onto
+STORAGE_THREADS real threads per worker. Needs `pip install gevent`.
+"""
+import os
+
+preload_app = True
+
+if os.environ.get('ASYNC_WORKERS') == '1':
+    # Patch before the preloaded app imports socket, threading and queue
+    from gevent import monkey
+    monkey.patch_all()
+
+    worker_class = 'gevent'
+    worker_connections = int(os.environ.get('WORKER_CONNECTIONS', 2000))
@@ -0,0 +1,158 @@
+// PipeDrill Pro - Virtualized product grid
+// Renders only the cards in view, reusing their DOM nodes as the user
+// scrolls, and fetches the catalog from the server one page at a time.
+class ProductGrid {
+    constructor(container, options) {
+        this.container = container;
+        this.fetchPage = options.fetchPage;
+        this.renderCard = options.renderCard;
+        this.onPage = options.onPage || (() => {});
+        this.pageSize = options.pageSize || 48;
+        this.rowHeight = options.rowHeight || 480;
+        this.minColumnWidth = options.minColumnWidth || 300;
+        this.gap = options.gap || 32;
+        this.overscanRows = options.overscanRows || 2;
+
+        this.items = [];
+        this.byId = new Map();
+        this.total = 0;
+        this.pages = new Map();
+        this.generation = 0;
+        this.nodes = new Map();
+        this.pool = [];
+        this.columns = 1;
+        this.columnWidth = 0;
+        this.frame = null;
+
+        container.classList.add('virtual-grid');
+        this.spacer = document.createElement('div');
+        this.spacer.className = 'virtual-grid-spacer';
+        container.replaceChildren(this.spacer);
+        container.addEventListener('scroll', () => this.schedule(), { passive: true });
+        if (window.ResizeObserver) {
+            new ResizeObserver(() => this.relayout()).observe(container);
+        } else {
+            window.addEventListener('resize', () => this.relayout());
+        }
+    }
+
+    get(productId) {
+        return this.byId.get(productId);
+    }
+
+    // Drop everything loaded so far and start again from the first page
+    async reset() {
+        this.generation += 1;
+        this.items = [];
+        this.byId.clear();
+        this.pages.clear();
+        this.total = 0;
+        this.nodes.forEach(node => this.release(node));
+        this.nodes.clear();
+        this.container.scrollTop = 0;
+        await this.load(0);
+        this.relayout();
+    }
+
+    load(page) {
+        if (!this.pages.has(page)) {
+            const generation = this.generation;
+            const request = this.fetchPage(page * this.pageSize, this.pageSize).then(data => {
+                if (generation !== this.generation) return;
+                this.total = data.total;
+                data.products.forEach((product, i) => {
+                    this.items[page * this.pageSize + i] = product;
+                    this.byId.set(product.id, product);
+                });
+                this.onPage(data, page);
+                this.relayout();
+            }).catch(error => {
+                // Let a later scroll retry the page once the server had a moment
+                setTimeout(() => this.pages.delete(page), 2000);
+                throw error;
+            });
+            this.pages.set(page, request);
+        }
+        return this.pages.get(page);
+    }
+
+    relayout() {
+        const width = this.container.clientWidth;
+        if (!width) return;
+        this.columns = Math.max(1, Math.floor((width + this.gap) / (this.minColumnWidth + this.gap)));
+        this.columnWidth = (width - this.gap * (this.columns - 1)) / this.columns;
+        const rows = Math.ceil(this.total / this.columns);
+        this.spacer.style.height = `${Math.max(0, rows * this.rowHeight - this.gap)}px`;
+        this.nodes.forEach((node, index) => this.place(node, index));
+        this.schedule();
+    }
+
+    schedule() {
+        if (this.frame === null) {
+            this.frame = requestAnimationFrame(() => {
+                this.frame = null;
+                this.render();
+            });
+        }
+    }
+
+    render() {
+        const top = this.container.scrollTop;
+        const firstRow = Math.max(0, Math.floor(top / this.rowHeight) - this.overscanRows);
+        const lastRow = Math.ceil((top + this.container.clientHeight) / this.rowHeight) + this.overscanRows;
+        const start = firstRow * this.columns;
+        const end = Math.min(this.total, lastRow * this.columns);
+
+        this.nodes.forEach((node, index) => {
+            if (index < start || index >= end) {
+                this.release(node);
+                this.nodes.delete(index);
+            }
+        });
+        for (let index = start; index < end; index++) {
+            const product = this.items[index];
+            if (!product) {
+                this.load(Math.floor(index / this.pageSize)).catch(error =>
+                    console.error('Error loading products:', error));
+            }
+            let node = this.nodes.get(index);
+            if (!node) {
+                node = this.acquire();
+                this.nodes.set(index, node);
+                this.place(node, index);
+            }
+            if (node.product !== product) {
+                node.product = product;
+                node.dataset.productId = product ? product.id : '';
+                node.innerHTML = product ? this.renderCard(product) :
+                    '<div class="virtual-grid-loading"><i class="fas fa-spinner fa-spin"></i></div>';
+            }
+        }
+    }
+
+    place(node, index) {
+        const row = Math.floor(index / this.columns);
+        const column = index % this.columns;
+        node.style.top = `${row * this.rowHeight}px`;
+        node.style.left = `${column * (this.columnWidth + this.gap)}px`;
+        node.style.width = `${this.columnWidth}px`;
+        node.style.height = `${this.rowHeight - this.gap}px`;
+    }
+
+    acquire() {
+        const node = this.pool.pop();
+        if (node) {
+            node.style.display = '';
+            return node;
+        }
+        const created = document.createElement('div');
+        created.className = 'product-card virtual-card';
+        this.spacer.appendChild(created);
+        return created;
+    }
+
+    release(node) {
+        node.style.display = 'none';
+        this.pool.push(node);
+    }
+}
@@ -1,16 +1,27 @@
 // PipeDrill Pro - Complete Shopping and Service System
 class PipeDrillSystem {
     constructor() {
-        this.cart = JSON.parse(localStorage.getItem('pipeDrillCart')) || [];
-        this.products = [];
+        this.cart = new ServerCart({
+            onChange: () => {
+                this.updateCartDisplay();
+                this.updateCartCount();
+            },
+            onError: message => this.showNotification(message, 'error')
+        });
+        this.productGrid = null;
+        this.searchTimer = null;
+        this.quoteTimer = null;
         this.services = [];
         this.orders = [];
         this.serviceRequests = [];
+        this.pendingSubmissions = {};
+        this.suggestedProducts = new Map();
         
         this.init();
     }
 
     async init() {
+        await this.cart.open().catch(error => console.error('Error opening cart:', error));
         await this.loadProducts();
         await this.loadServices();
         await this.loadOrders();
@@ -22,18 +33,36 @@ class PipeDrillSystem {
     }
 
     async loadProducts() {
+        const container = document.getElementById('productsContainer');
+        if (!container) return;
+        if (!this.productGrid) {
+            this.productGrid = new ProductGrid(container, {
+                fetchPage: (offset, limit) => this.fetchProductPage(offset, limit),
+                renderCard: product => this.productCardHtml(product)
+            });
+        }
         try {
-            const response = await fetch('/api/products');
-            const data = await response.json();
-            if (data.success) {
-                this.products = data.products;
-                this.displayProducts(this.products);
-            }
+            await this.productGrid.reset();
         } catch (error) {
             console.error('Error loading products:', error);
         }
     }
 
+    async fetchProductPage(offset, limit) {
+        const params = new URLSearchParams({ offset, limit });
+        const searchInput = document.getElementById('productSearch');
+        const term = searchInput ? searchInput.value.trim() : '';
+        if (term) params.set('q', term);
+        const response = await fetch(`/api/products?${params}`);
+        const data = await response.json();
+        if (!data.success) throw new Error(data.error);
+        return data;
+    }
+
+    getProduct(productId) {
+        return (this.productGrid && this.productGrid.get(productId)) || this.suggestedProducts.get(productId);
+    }
+
     async loadServices() {
         try {
             const response = await fetch('/api/services');
@@ -71,42 +100,37 @@ class PipeDrillSystem {
         }
     }
 
-    displayProducts(products) {
-        const container = document.getElementById('productsContainer');
-        if (!container) return;
-
-        container.innerHTML = products.map(product => `
-            <div class="product-card" data-product-id="${product.id}">
-                <div class="product-image">
-                    <i class="fas fa-${this.getProductIcon(product.category)} fa-3x"></i>
-                </div>
-                <h3>${product.name}</h3>
-                <p class="product-description">${product.description}</p>
-                
-                <div class="product-specs">
-                    ${Object.entries(product.specs || {}).map(([key, value]) => `
-                        <div class="spec-item">
-                            <strong>${this.formatSpecKey(key)}:</strong> ${value}
-                        </div>
-                    `).join('')}
-                </div>
-
-                <div class="product-features">
-                    ${product.features.map(feature => 
-                        `<span class="feature-tag">${feature}</span>`
-                    ).join('')}
-                </div>
+    productCardHtml(product) {
+        return `
+            <div class="product-image">
+                ${this.productThumbnail(product)}
+            </div>
+            <h3>${product.name}</h3>
+            <p class="product-description">${product.description}</p>
+            
+            <div class="product-specs">
+                ${Object.entries(product.specs || {}).map(([key, value]) => `
+                    <div class="spec-item">
+                        <strong>${this.formatSpecKey(key)}:</strong> ${value}
+                    </div>
+                `).join('')}
+            </div>
 
-                <div class="product-pricing">
-                    <span class="price">$${product.price.toFixed(2)}/${product.unit}</span>
-                    <span class="stock">In Stock: ${product.stock}</span>
-                </div>
+            <div class="product-features">
+                ${(product.features || []).map(feature => 
+                    `<span class="feature-tag">${feature}</span>`
+                ).join('')}
+            </div>
 
-                <button class="btn btn-primary" onclick="pipeSystem.addToCart(${product.id})">
-                    <i class="fas fa-cart-plus"></i> Add to Cart
-                </button>
+            <div class="product-pricing">
+                <span class="price">$${product.price.toFixed(2)}/${product.unit}</span>
+                <span class="stock">In Stock: ${product.stock}</span>
             </div>
-        `).join('');
+
+            <button class="btn btn-primary" onclick="pipeSystem.addToCart(${product.id})">
+                <i class="fas fa-cart-plus"></i> Add to Cart
+            </button>
+        `;
     }
 
     displayServices(services) {
@@ -140,6 +164,24 @@ class PipeDrillSystem {
         `).join('');
     }
 
+    // Uploaded products carry pre-sized variants; others keep the category icon
+    productThumbnail(product) {
+        const thumb = product.images && product.images.thumb;
+        if (!thumb) {
+            return `<i class="fas fa-${this.getProductIcon(product.category)} fa-3x"></i>`;
+        }
+        if (!thumb.width) {
+            // Stored without Pillow: the variant is the original upload, in whatever format it came
+            return `<img src="${thumb.jpeg}" alt="${product.name}" loading="lazy">`;
+        }
+        return `
+            <picture>
+                <source type="image/webp" srcset="${thumb.webp}">
+                <img src="${thumb.jpeg}" alt="${product.name}" loading="lazy">
+            </picture>
+        `;
+    }
+
     getProductIcon(category) {
         const icons = {
             'pipes': 'pipe',
@@ -155,7 +197,7 @@ class PipeDrillSystem {
     }
 
     addToCart(productId) {
-        const product = this.products.find(p => p.id === productId);
+        const product = this.getProduct(productId);
         if (!product) return;
 
         if (product.stock <= 0) {
@@ -163,37 +205,53 @@ class PipeDrillSystem {
             return;
         }
 
-        const existingItem = this.cart.find(item => item.id === productId);
-        if (existingItem) {
-            if (existingItem.quantity < product.stock) {
-                existingItem.quantity++;
-            } else {
-                this.showNotification('Maximum stock reached for this item', 'error');
-                return;
-            }
-        } else {
-            this.cart.push({
-                ...product,
-                quantity: 1,
-                itemType: 'product'
-            });
+        const existingItem = this.cart.get(productId);
+        if (existingItem && existingItem.quantity >= product.stock) {
+            this.showNotification('Maximum stock reached for this item', 'error');
+            return;
         }
 
-        this.saveCart();
-        this.updateCartDisplay();
-        this.updateCartCount();
+        this.cart.add(product);
         this.showNotification(`${product.name} added to cart`);
+        this.loadSuggestions(productId);
+    }
+
+    // Products often bought with the last one added, offered under the cart
+    async loadSuggestions(productId) {
+        const container = document.getElementById('cartSuggestions');
+        if (!container) return;
+
+        try {
+            const response = await fetch(`/api/products/${productId}/recommendations?limit=4`);
+            const data = await response.json();
+            if (!data.success) return;
+            const picks = data.recommendations.filter(product => !this.cart.get(product.id));
+            picks.forEach(product => this.suggestedProducts.set(product.id, product));
+            container.innerHTML = picks.length ? `
+                <h3>Frequently bought together</h3>
+                ${picks.map(product => `
+                    <div class="cart-item">
+                        <div class="item-info">
+                            <h4>${product.name}</h4>
+                            <p>$${product.price}/${product.unit}</p>
+                        </div>
+                        <button class="btn btn-outline" onclick="pipeSystem.addToCart(${product.id})">
+                            <i class="fas fa-cart-plus"></i> Add
+                        </button>
+                    </div>
+                `).join('')}
+            ` : '';
+        } catch (error) {
+            console.error('Error loading suggestions:', error);
+        }
     }
 
     removeFromCart(itemId) {
-        this.cart = this.cart.filter(item => item.id !== itemId);
-        this.saveCart();
-        this.updateCartDisplay();
-        this.updateCartCount();
+        this.cart.remove(itemId);
     }
 
     updateQuantity(itemId, change) {
-        const item = this.cart.find(item => item.id === itemId);
+        const item = this.cart.get(itemId);
         if (!item) return;
 
         const newQuantity = item.quantity + change;
@@ -203,17 +261,12 @@ class PipeDrillSystem {
             return;
         }
         
-        if (item.itemType === 'product') {
-            const product = this.products.find(p => p.id === itemId);
-            if (newQuantity > product.stock) {
-                this.showNotification(`Only ${product.stock} items available in stock`, 'error');
-                return;
-            }
+        if (newQuantity > item.stock) {
+            this.showNotification(`Only ${item.stock} items available in stock`, 'error');
+            return;
         }
         
-        item.quantity = newQuantity;
-        this.saveCart();
-        this.updateCartDisplay();
+        this.cart.setQuantity(itemId, newQuantity);
     }
 
     updateCartDisplay() {
@@ -222,56 +275,38 @@ class PipeDrillSystem {
         
         if (!container || !summary) return;
 
-        if (this.cart.length === 0) {
+        const items = this.cart.items();
+        if (items.length === 0) {
             container.innerHTML = `
                 <div class="empty-cart">
                     <i class="fas fa-shopping-cart fa-3x"></i>
                     <h3>Your cart is empty</h3>
-                    <p>Add some products or services to get started</p>
+                    <p>Add some products to get started</p>
                 </div>
             `;
             summary.innerHTML = '<p class="total">Total: $0.00</p>';
             return;
         }
 
-        let subtotal = 0;
-        container.innerHTML = this.cart.map(item => {
-            let itemTotal = 0;
-            
-            if (item.itemType === 'product') {
-                itemTotal = item.price * item.quantity;
-            } else if (item.itemType === 'service') {
-                itemTotal = item.hourly_rate * item.estimated_hours;
-            }
-            
-            subtotal += itemTotal;
-
-            return `
+        container.innerHTML = items.map(item => `
                 <div class="cart-item">
                     <div class="item-info">
                         <h4>${item.name}</h4>
-                        <p>${item.itemType === 'product' ? 
-                            `$${item.price}/${item.unit}` : 
-                            `Service (${item.estimated_hours} hours)`}
-                        </p>
+                        <p>${item.available === false ? 'No longer available' : `$${item.price}/${item.unit}`}</p>
                     </div>
                     <div class="quantity-controls">
-                        ${item.itemType === 'product' ? `
-                            <button onclick="pipeSystem.updateQuantity(${item.id}, -1)">-</button>
-                            <span>${item.quantity}</span>
-                            <button onclick="pipeSystem.updateQuantity(${item.id}, 1)">+</button>
-                        ` : ''}
+                        <button onclick="pipeSystem.updateQuantity(${item.product_id}, -1)">-</button>
+                        <span>${item.quantity}</span>
+                        <button onclick="pipeSystem.updateQuantity(${item.product_id}, 1)">+</button>
                     </div>
-                    <div class="item-total">$${itemTotal.toFixed(2)}</div>
-                    <button class="btn btn-danger" onclick="pipeSystem.removeFromCart(${item.id})">
+                    <div class="item-total">$${((item.price || 0) * item.quantity).toFixed(2)}</div>
+                    <button class="btn btn-danger" onclick="pipeSystem.removeFromCart(${item.product_id})">
                         <i class="fas fa-trash"></i>
                     </button>
                 </div>
-            `;
-        }).join('');
+            `).join('');
 
-        const tax = subtotal * 0.08; // 8% tax
-        const total = subtotal + tax;
+        const { subtotal, tax, total } = this.cart.totals;
 
         summary.innerHTML = `
             <div class="summary-item">
@@ -279,21 +314,39 @@ class PipeDrillSystem {
                 <span>$${subtotal.toFixed(2)}</span>
             </div>
             <div class="summary-item">
-                <span>Tax (8%):</span>
+                <span>Tax:</span>
                 <span>$${tax.toFixed(2)}</span>
             </div>
             <div class="summary-item total">
                 <span>Total:</span>
                 <span>$${total.toFixed(2)}</span>
             </div>
+            <input type="email" id="orderEmail" class="form-control" placeholder="Email for an order confirmation (optional)"
+                   oninput="pipeSystem.orderEmail = this.value">
+            <button class="btn btn-outline" onclick="pipeSystem.shareCart()">
+                <i class="fas fa-link"></i> Share Cart
+            </button>
             <button class="btn btn-success checkout-btn" onclick="pipeSystem.checkout()">
                 <i class="fas fa-credit-card"></i> Proceed to Checkout
             </button>
         `;
+        summary.querySelector('#orderEmail').value = this.orderEmail || '';
+    }
+
+    async shareCart() {
+        await this.cart.flush();
+        const url = this.cart.shareUrl();
+        if (!url) return;
+        try {
+            await navigator.clipboard.writeText(url);
+            this.showNotification('Cart link copied to clipboard');
+        } catch (error) {
+            this.showNotification(`Share this link: ${url}`);
+        }
     }
 
     updateCartCount() {
-        const count = this.cart.reduce((total, item) => total + item.quantity, 0);
+        const count = this.cart.count();
         const countElement = document.getElementById('cartCount');
         if (countElement) {
             countElement.textContent = count;
@@ -301,53 +354,36 @@ class PipeDrillSystem {
     }
 
     async checkout() {
-        if (this.cart.length === 0) {
-            this.showNotification('Your cart is empty!', 'error');
-            return;
-        }
-
         try {
+            const order = await this.cart.checkoutBody();
+            if (!order) {
+                this.showNotification('Your cart is empty!', 'error');
+                return;
+            }
+            const email = (this.orderEmail || '').trim();
+            if (email) order.email = email;
+
+            const body = JSON.stringify(order);
             const response = await fetch('/api/place-order', {
                 method: 'POST',
-                headers: {'Content-Type': 'application/json'},
-                body: JSON.stringify({
-                    items: this.cart,
-                    subtotal: this.cart.reduce((sum, item) => {
-                        if (item.itemType === 'product') {
-                            return sum + (item.price * item.quantity);
-                        } else {
-                            return sum + (item.hourly_rate * item.estimated_hours);
-                        }
-                    }, 0),
-                    tax: this.cart.reduce((sum, item) => {
-                        if (item.itemType === 'product') {
-                            return sum + (item.price * item.quantity);
-                        } else {
-                            return sum + (item.hourly_rate * item.estimated_hours);
-                        }
-                    }, 0) * 0.08,
-                    total: this.cart.reduce((sum, item) => {
-                        if (item.itemType === 'product') {
-                            return sum + (item.price * item.quantity);
-                        } else {
-                            return sum + (item.hourly_rate * item.estimated_hours);
-                        }
-                    }, 0) * 1.08
-                })
+                headers: {
+                    'Content-Type': 'application/json',
+                    'Idempotency-Key': this.submissionKey('order', body)
+                },
+                body: body
             });
 
             const result = await response.json();
+            if (response.status !== 409) delete this.pendingSubmissions.order;
             if (result.success) {
                 this.showNotification('Order placed successfully!', 'success');
-                this.cart = [];
-                this.saveCart();
-                this.updateCartDisplay();
-                this.updateCartCount();
+                this.cart.forget();
                 
                 // Reload orders
                 await this.loadOrders();
             } else {
                 this.showNotification('Error placing order: ' + result.error, 'error');
+                this.cart.refresh(true);
             }
         } catch (error) {
             this.showNotification('Network error. Please try again.', 'error');
@@ -375,17 +411,12 @@ class PipeDrillSystem {
     }
 
     setupEventListeners() {
-        // Product search
+        // Product search runs on the server, once typing pauses
         const searchInput = document.getElementById('productSearch');
         if (searchInput) {
-            searchInput.addEventListener('input', (e) => {
-                const term = e.target.value.toLowerCase();
-                const filtered = this.products.filter(product =>
-                    product.name.toLowerCase().includes(term) ||
-                    product.description.toLowerCase().includes(term) ||
-                    product.category.toLowerCase().includes(term)
-                );
-                this.displayProducts(filtered);
+            searchInput.addEventListener('input', () => {
+                clearTimeout(this.searchTimer);
+                this.searchTimer = setTimeout(() => this.loadProducts(), 200);
             });
         }
 
@@ -397,6 +428,51 @@ class PipeDrillSystem {
                 await this.submitServiceRequest();
             });
         }
+
+        // Price estimate for the booking being filled in
+        ['serviceType', 'pipeMaterial', 'pipeDiameter', 'estimatedHours'].forEach(id => {
+            const field = document.getElementById(id);
+            if (field) {
+                field.addEventListener('input', () => {
+                    clearTimeout(this.quoteTimer);
+                    this.quoteTimer = setTimeout(() => this.updateQuote(), 250);
+                });
+            }
+        });
+
+        // Pick up changes made to a shared cart while this tab was in the background
+        document.addEventListener('visibilitychange', () => {
+            if (!document.hidden) this.cart.refresh();
+        });
+    }
+
+    async updateQuote() {
+        const quote = document.getElementById('serviceQuote');
+        if (!quote) return;
+        const booking = {
+            service_type: document.getElementById('serviceType').value,
+            material: document.getElementById('pipeMaterial').value,
+            diameter: document.getElementById('pipeDiameter').value,
+            hours: document.getElementById('estimatedHours').value
+        };
+        if (!booking.service_type || !booking.hours) {
+            quote.innerHTML = '';
+            return;
+        }
+        try {
+            const response = await fetch('/api/quotes', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify(booking)
+            });
+            const result = await response.json();
+            quote.innerHTML = result.success ?
+                `<strong>Estimated price: $${result.total.toFixed(2)}</strong>
+                 (${result.lines[0].hours} hours at $${result.lines[0].rate.toFixed(2)}/hour, tax included)` :
+                `<span class="error">${result.error}</span>`;
+        } catch (error) {
+            quote.innerHTML = '';
+        }
     }
 
     async submitServiceRequest() {
@@ -412,33 +488,22 @@ class PipeDrillSystem {
         };
 
         try {
+            const body = JSON.stringify(formData);
             const response = await fetch('/api/service-request', {
                 method: 'POST',
-                headers: {'Content-Type': 'application/json'},
-                body: JSON.stringify(formData)
+                headers: {
+                    'Content-Type': 'application/json',
+                    'Idempotency-Key': this.submissionKey('serviceRequest', body)
+                },
+                body: body
             });
 
             const result = await response.json();
+            if (response.status !== 409) delete this.pendingSubmissions.serviceRequest;
             if (result.success) {
                 this.showNotification('Service request submitted successfully!', 'success');
                 document.getElementById('serviceForm').reset();
-                
-                // Add to cart as service item
-                const service = this.services.find(s => 
-                    s.name.toLowerCase().replace(/\s+/g, '-') === formData.service_type
-                );
-                
-                if (service) {
-                    this.cart.push({
-                        ...service,
-                        ...formData,
-                        itemType: 'service',
-                        id: Date.now() // Temporary ID for cart
-                    });
-                    this.saveCart();
-                    this.updateCartCount();
-                }
-                
+                await this.loadServiceRequests();
             } else {
                 this.showNotification('Error: ' + result.error, 'error');
             }
@@ -464,8 +529,16 @@ class PipeDrillSystem {
         }, 3000);
     }
 
-    saveCart() {
-        localStorage.setItem('pipeDrillCart', JSON.stringify(this.cart));
+    // Reuse the same Idempotency-Key while a submission is being retried
+    submissionKey(name, body) {
+        const pending = this.pendingSubmissions[name];
+        if (!pending || pending.body !== body) {
+            const key = (window.crypto && crypto.randomUUID) ?
+                crypto.randomUUID() :
+                Date.now().toString(36) + '-' + Math.random().toString(36).slice(2);
+            this.pendingSubmissions[name] = {body: body, key: key};
+        }
+        return this.pendingSubmissions[name].key;
     }
 }
 
@@ -0,0 +1,428 @@
+"""Storage primitives shared by app.py and storage_server.py
+
+Data files live under a directory on this machine (LocalStorage) or on a
+storage server shared by every app node (RemoteStorage). Nothing here
+touches Flask, so the storage server imports it without starting an app.
+"""
+import ctypes
+import ctypes.util
+import fcntl
+import logging
+import os
+import queue
+import struct
+import threading
+import time
+from functools import wraps
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# Async serving: gevent workers (ASYNC_WORKERS=1, see gunicorn.conf.py) run each
+# request on a greenlet, so calls that block on disk are moved onto real threads.
+try:
+    from gevent import monkey as gevent_monkey
+    from gevent.threadpool import ThreadPool as NativeThreadPool
+    from gevent.threadpool import ThreadPoolExecutor as NativeThreadPoolExecutor
+except ImportError:
+    gevent_monkey = NativeThreadPool = NativeThreadPoolExecutor = None
+
+STORAGE_THREADS = int(os.environ.get('STORAGE_THREADS', 8))
+_io_pools = {}
+
+def green():
+    """Whether this process serves from gevent's patched sockets and threads"""
+    return gevent_monkey is not None and gevent_monkey.is_module_patched('socket')
+
+def io_pool():
+    """Bounded pool of real threads for blocking disk calls, one per process"""
+    pid = os.getpid()
+    if pid not in _io_pools:
+        _io_pools[pid] = NativeThreadPool(STORAGE_THREADS)
+    return _io_pools[pid]
+
+def offloaded(fn):
+    """Run a blocking call on the I/O pool when serving from greenlets
+
+    Greenlets share one OS thread, so a read waiting on disk would stall
+    every connection in the process. Without gevent the call runs inline.
+    """
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not green():
+            return fn(*args, **kwargs)
+        return io_pool().apply(fn, args, kwargs)
+    return wrapper
+
+@offloaded
+def lock_file(fd):
+    fcntl.flock(fd, fcntl.LOCK_EX)
+
+# Storage backends: data files on local disk, or on a storage server shared by every node
+STORAGE_TIMEOUT = float(os.environ.get('STORAGE_TIMEOUT', 10))
+STORAGE_LOCK_WAIT = float(os.environ.get('STORAGE_LOCK_WAIT', 30))
+STORAGE_CHANGES_WAIT = 20
+# Held locks renew their lease this often, well inside the server's LEASE_SECONDS
+STORAGE_LEASE_RENEW = float(os.environ.get('STORAGE_LEASE_RENEW', 10))
+# Shared with the storage server, which refuses every request without it
+STORAGE_SECRET = os.environ.get('STORAGE_SECRET', '')
+SECRET_HEADER = 'Storage-Secret'
+MISSING_VERSION = '-'
+
+class StorageError(OSError):
+    """The storage server could not be reached or refused a request"""
+
+def file_stamp(filename):
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+def journal_file(filename):
+    return filename + '.journal'
+
+class FileLock:
+    """Exclusive lock on a data file, held across processes while writing"""
+
+    def __init__(self, filename):
+        self.path = filename + '.lock'
+
+    def __enter__(self):
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        lock_file(self.fd)
+        return self
+
+    def __exit__(self, *exc_info):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+
+class LocalStorage:
+    """Data files under root on this machine, shared by its worker processes"""
+    name = 'local'
+
+    def __init__(self, root='.'):
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    @offloaded
+    def read_versioned(self, key):
+        """Contents of a file and the stamp they were read at, or (None, None)"""
+        try:
+            with open(self.path(key), 'rb') as f:
+                stat = os.fstat(f.fileno())
+                return (stat.st_ino, stat.st_mtime_ns, stat.st_size), f.read(stat.st_size)
+        except FileNotFoundError:
+            return None, None
+
+    def read(self, key):
+        return self.read_versioned(key)[1]
+
+    @offloaded
+    def read_from(self, key, offset):
+        try:
+            with open(self.path(key), 'rb') as f:
+                f.seek(offset)
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    @offloaded
+    def stamp(self, key):
+        return file_stamp(self.path(key))
+
+    @offloaded
+    def write(self, key, raw):
+        """Replace a file atomically, so readers and backups never see it half-written"""
+        path = self.path(key)
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(raw)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    @offloaded
+    def append(self, key, raw):
+        """Append with a single O_APPEND write, so concurrent appends never interleave"""
+        fd = os.open(self.path(key), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, raw)
+        finally:
+            os.close(fd)
+
+    @offloaded
+    def remove(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def lock(self, key):
+        return FileLock(self.path(key))
+
+    def watch(self, key):
+        """Iterator that yields whenever key is rewritten; raises OSError without inotify"""
+        if green():
+            # Reading inotify would block the hub; callers fall back to polling
+            raise OSError('inotify is not used under gevent')
+        fd = inotify_watch(os.path.dirname(self.path(key)) or '.')
+        name = os.path.basename(key)
+        return (None for changed in inotify_names(fd) if changed == name)
+
+class RemoteStorage:
+    """Data files kept by storage_server.py, shared by every app node
+
+    Reads are served from a per-process cache that the server's change
+    feed invalidates, so a node only goes over the network for data that
+    changed. Taking a lock revalidates the locked file and its journal, so
+    a write made under the lock never starts from a copy that the feed
+    has not caught up with yet. While the feed is down, every read is
+    revalidated with the server.
+
+    may_start_threads says whether this process may start the change feed
+    and lease renewal threads yet; a gunicorn master preloading the app
+    must not, as they would not survive the fork.
+    """
+    name = 'remote'
+
+    def __init__(self, url, secret=STORAGE_SECRET, timeout=STORAGE_TIMEOUT, may_start_threads=lambda: True):
+        self.url = url.rstrip('/')
+        self.secret = secret
+        self.timeout = timeout
+        self.may_start_threads = may_start_threads
+        self.cache = {}
+        self.generations = {}
+        self.epoch = 0
+        self.cache_lock = threading.Lock()
+        self.subscribers = []
+        self.watching = False
+        self.watcher_pid = None
+        self.local = threading.local()
+
+    def session(self):
+        if getattr(self.local, 'pid', None) != os.getpid():
+            self.local.session = requests.Session()
+            self.local.session.headers[SECRET_HEADER] = self.secret
+            self.local.tokens = {}
+            self.local.pid = os.getpid()
+        return self.local.session
+
+    def call(self, method, path, timeout=None, **kwargs):
+        try:
+            response = self.session().request(method, f'{self.url}{path}',
+                                              timeout=timeout or self.timeout, **kwargs)
+        except requests.RequestException as e:
+            raise StorageError(f'Storage server unreachable: {e}') from e
+        if response.status_code >= 400 and response.status_code != 404:
+            raise StorageError(f'Storage server refused {method} {path}: '
+                               f'{response.status_code} {response.text[:200]}')
+        return response
+
+    def fence(self, key):
+        """Header proving this thread holds the lock that guards key"""
+        self.session()
+        base = key[:-len('.journal')] if key.endswith('.journal') else key
+        token = self.local.tokens.get(base)
+        return {'Storage-Lock': token} if token else {}
+
+    def generation(self, key):
+        return (self.epoch, self.generations.get(key, 0))
+
+    def remember(self, key, entry, generation):
+        """Cache entry unless key was invalidated while it was being fetched"""
+        with self.cache_lock:
+            if self.generation(key) == generation:
+                self.cache[key] = entry
+
+    def invalidate(self, key, version=None):
+        with self.cache_lock:
+            entry = self.cache.get(key)
+            if entry is not None and (version is None or entry[0] != version):
+                del self.cache[key]
+                self.generations[key] = self.generations.get(key, 0) + 1
+
+    def forget(self):
+        with self.cache_lock:
+            self.cache.clear()
+            self.epoch += 1
+
+    def fetch(self, key):
+        """(version, contents) of key, from the cache while the change feed is live"""
+        if self.watcher_pid != os.getpid() and self.may_start_threads():
+            self.start_watcher()
+        with self.cache_lock:
+            entry = self.cache.get(key)
+            if entry is not None and self.watching:
+                return entry
+            generation = self.generation(key)
+        headers = {'Storage-If-Version': entry[0] or MISSING_VERSION} if entry else {}
+        response = self.call('GET', f'/kv/{key}', headers=headers)
+        if response.status_code == 304:
+            fetched = entry
+        elif response.status_code == 404:
+            fetched = (None, None)
+        else:
+            fetched = (response.headers['Storage-Version'], response.content)
+        self.remember(key, fetched, generation)
+        return fetched
+
+    def read(self, key):
+        return self.fetch(key)[1]
+
+    def read_from(self, key, offset):
+        raw = self.read(key)
+        return None if raw is None else raw[offset:]
+
+    def stamp(self, key):
+        return self.fetch(key)[0]
+
+    def write(self, key, raw):
+        with self.cache_lock:
+            generation = self.generation(key)
+        response = self.call('PUT', f'/kv/{key}', data=raw, headers=self.fence(key))
+        self.remember(key, (response.headers['Storage-Version'], raw), generation)
+
+    def append(self, key, raw):
+        response = self.call('POST', f'/kv/{key}', data=raw, headers=self.fence(key))
+        previous = response.headers['Storage-Previous-Version']
+        with self.cache_lock:
+            entry = self.cache.get(key)
+            if entry is not None and (entry[0] or MISSING_VERSION) == previous:
+                # Nothing else was appended in between, so extend the cached copy
+                self.cache[key] = (response.headers['Storage-Version'], (entry[1] or b'') + raw)
+            elif entry is not None:
+                del self.cache[key]
+
+    def remove(self, key):
+        with self.cache_lock:
+            generation = self.generation(key)
+        self.call('DELETE', f'/kv/{key}', headers=self.fence(key))
+        self.remember(key, (None, None), generation)
+
+    def lock(self, key):
+        return RemoteLock(self, key)
+
+    def watch(self, key):
+        """Iterator that yields whenever the change feed reports key"""
+        if self.watcher_pid != os.getpid():
+            self.start_watcher()
+        changes = queue.Queue()
+        with self.cache_lock:
+            self.subscribers.append((key, changes))
+        return iter(changes.get, None)
+
+    def notify(self, key):
+        with self.cache_lock:
+            subscribers = list(self.subscribers)
+        for subscribed, changes in subscribers:
+            if key is None or subscribed == key:
+                changes.put(key)
+
+    def start_watcher(self):
+        with self.cache_lock:
+            if self.watcher_pid == os.getpid():
+                return
+            self.watcher_pid = os.getpid()
+            self.watching = False
+            self.cache.clear()
+            self.subscribers = []
+        threading.Thread(target=self.follow_changes, name='storage-changes', daemon=True).start()
+
+    def follow_changes(self):
+        """Long-poll the server's change feed and invalidate cached files"""
+        seq = server = None
+        while True:
+            try:
+                body = self.call('GET', '/changes', timeout=self.timeout + STORAGE_CHANGES_WAIT,
+                                 params={'since': -1 if seq is None else seq,
+                                         'wait': STORAGE_CHANGES_WAIT}).json()
+            except (StorageError, ValueError) as e:
+                if self.watching:
+                    logger.warning('Storage change feed lost, revalidating every read: %s', e)
+                self.watching = False
+                seq = None
+                time.sleep(1)
+                continue
+            if seq is None or body['reset'] or body['server'] != server:
+                # Changes may have been missed, so nothing cached can be trusted
+                self.forget()
+                self.watching = True
+                self.notify(None)
+            else:
+                for change in body['changes']:
+                    self.invalidate(change['key'], change['version'])
+                    self.notify(change['key'])
+            seq, server = body['seq'], body['server']
+
+class RemoteLock:
+    """Lease on a key held by the storage server, renewed while held and released on exit"""
+
+    def __init__(self, storage, key):
+        self.storage = storage
+        self.key = key
+
+    def __enter__(self):
+        response = self.storage.call('POST', f'/locks/{self.key}', params={'wait': STORAGE_LOCK_WAIT},
+                                     timeout=self.storage.timeout + STORAGE_LOCK_WAIT)
+        lease = response.json()
+        self.token = lease['token']
+        self.storage.session()
+        self.storage.local.tokens[self.key] = self.token
+        for key, version in lease['versions'].items():
+            self.storage.invalidate(key, None if version == MISSING_VERSION else version)
+        self.released = threading.Event()
+        if self.storage.may_start_threads():
+            threading.Thread(target=self.renew, name='storage-lease', daemon=True).start()
+        return self
+
+    def renew(self):
+        """Keep the lease alive however long the work under the lock takes"""
+        while not self.released.wait(STORAGE_LEASE_RENEW):
+            try:
+                self.storage.call('POST', f'/locks/{self.token}/renew')
+            except StorageError as e:
+                # The server now refuses this holder's writes, so they fail loudly
+                logger.warning('Lost the lease on %s: %s', self.key, e)
+                return
+
+    def __exit__(self, exc_type, exc, tb):
+        self.released.set()
+        self.storage.local.tokens.pop(self.key, None)
+        try:
+            self.storage.call('DELETE', f'/locks/{self.token}')
+        except StorageError as e:
+            # Never hide the error that is already propagating out of the lock
+            if exc_type is None:
+                raise
+            logger.warning('Could not release the lock on %s: %s', self.key, e)
+
+# inotify, for watching data files without polling (Linux only)
+IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE = 0x08, 0x80, 0x100
+def inotify_watch(directory):
+    """inotify descriptor reporting files written or moved into directory (Linux only)"""
+    libc_name = ctypes.util.find_library('c')
+    if not libc_name or not hasattr(ctypes.CDLL(libc_name), 'inotify_init1'):
+        raise OSError('inotify is not supported on this platform')
+    libc = ctypes.CDLL(libc_name, use_errno=True)
+    fd = libc.inotify_init1(os.O_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+    if libc.inotify_add_watch(fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE) < 0:
+        os.close(fd)
+        raise OSError(ctypes.get_errno(), f'cannot watch {directory}')
+    return fd
+
+def inotify_names(fd):
+    """Yield the file name of every event read from an inotify descriptor"""
+    while True:
+        buffer = os.read(fd, 64 * 1024)
+        offset = 0
+        while offset < len(buffer):
+            _, _, _, length = struct.unpack_from('iIII', buffer, offset)
+            name = buffer[offset + 16:offset + 16 + length].rstrip(b'\0')
+            offset += 16 + length
+            yield os.fsdecode(name)
@@ -0,0 +1,229 @@
+"""Storage server for running several app nodes against one set of data files
+
+Usage: STORAGE_SECRET=... python storage_server.py [--root DIR] [--host HOST] [--port N]
+
+That runs Flask's development server, which is for trying it out. Serve
+it to other machines with a real WSGI server, as a single process with
+a thread for every node's change feed and every waiting lock request:
+
+    gunicorn --workers 1 --threads 64 --bind 0.0.0.0:5100 storage_server:server
+
+with STORAGE_ROOT set to the directory holding data/.
+
+Point every node at it with STORAGE_URL=http://HOST:PORT and the same
+STORAGE_SECRET; a request without it is refused, since anyone who can
+reach the port could otherwise rewrite data/. Files are kept under
+--root exactly as a single node keeps them in data/, so the backup and
+migrate-data commands still work on this machine. Run one process:
+lock leases and the change feed live in its memory.
+
+Only the data files are shared. Each node keeps its own SQLite state,
+so idempotency keys, rate buckets, events, and server-side carts with
+their stock holds stay per node. Carts only work on a single node.
+"""
+import argparse
+import collections
+import hmac
+import os
+import threading
+import time
+import uuid
+
+from flask import Flask, Response, jsonify, request
+from werkzeug.security import safe_join
+
+from storage import MISSING_VERSION, SECRET_HEADER, STORAGE_SECRET, LocalStorage, journal_file
+
+LEASE_SECONDS = 30
+CHANGE_LOG_SIZE = 10000
+
+server = Flask(__name__)
+storage = LocalStorage(os.environ.get('STORAGE_ROOT', '.'))
+os.makedirs(os.path.join(storage.root, 'data'), exist_ok=True)
+server_id = uuid.uuid4().hex
+
+# Every write and the change it records happen under one lock, so versions
+# reported to clients always describe the bytes they just wrote
+write_lock = threading.Lock()
+changes = collections.deque(maxlen=CHANGE_LOG_SIZE)
+changes_cond = threading.Condition()
+last_seq = 0
+
+leases_cond = threading.Condition()
+leases = {}
+holders = {}
+
+
+@server.before_request
+def authenticate():
+    """Every route needs the secret the app nodes share with this server"""
+    sent = request.headers.get(SECRET_HEADER, '').encode('utf-8')
+    if not STORAGE_SECRET or not hmac.compare_digest(sent, STORAGE_SECRET.encode('utf-8')):
+        return jsonify({'error': f'Missing or wrong {SECRET_HEADER} header'}), 401
+    return None
+
+
+def version_of(stamp):
+    return MISSING_VERSION if stamp is None else '-'.join(map(str, stamp))
+
+
+def valid_key(key):
+    """Only data files under data/ are served, never lock or temp files"""
+    return (key.startswith('data/') and safe_join(storage.root, key) is not None
+            and not key.endswith(('.lock', '.tmp')))
+
+
+def record_change(key):
+    global last_seq
+    version = version_of(storage.stamp(key))
+    with changes_cond:
+        last_seq += 1
+        changes.append((last_seq, key, version))
+        changes_cond.notify_all()
+    return version
+
+
+def fenced(key):
+    """Whether a write to key must be refused
+
+    A write sent under a lock must carry the current, unexpired lease on
+    it; a holder whose lease lapsed is refused even if nobody took the
+    lock since. A write sent without a lock is refused while anyone holds it.
+    """
+    base = key[:-len('.journal')] if key.endswith('.journal') else key
+    token = request.headers.get('Storage-Lock')
+    with leases_cond:
+        expire_leases()
+        holder = holders.get(base)
+    return holder != token if token is not None else holder is not None
+
+
+def expire_leases():
+    now = time.monotonic()
+    for token, (key, expires_at, file_lock) in list(leases.items()):
+        if expires_at < now:
+            server.logger.warning('Lease on %s expired without being released', key)
+            del leases[token]
+            del holders[key]
+            file_lock.__exit__(None, None, None)
+            leases_cond.notify_all()
+
+
+@server.route('/kv/<path:key>', methods=['GET'])
+def read(key):
+    if not valid_key(key):
+        return jsonify({'error': 'Invalid key'}), 400
+    stamp, raw = storage.read_versioned(key)
+    if stamp is None:
+        return jsonify({'error': 'Not found'}), 404
+    version = version_of(stamp)
+    if request.headers.get('Storage-If-Version') == version:
+        return Response(status=304, headers={'Storage-Version': version})
+    return Response(raw, mimetype='application/octet-stream', headers={'Storage-Version': version})
+
+
+@server.route('/kv/<path:key>', methods=['PUT', 'POST', 'DELETE'])
+def write(key):
+    if not valid_key(key):
+        return jsonify({'error': 'Invalid key'}), 400
+    if fenced(key):
+        return jsonify({'error': 'Another client holds the lock on this key'}), 409
+    with write_lock:
+        previous = version_of(storage.stamp(key))
+        if request.method == 'PUT':
+            storage.write(key, request.get_data())
+        elif request.method == 'POST':
+            storage.append(key, request.get_data())
+        else:
+            storage.remove(key)
+        version = record_change(key)
+    return Response(status=204, headers={'Storage-Version': version, 'Storage-Previous-Version': previous})
+
+
+@server.route('/locks/<path:key>', methods=['POST'])
+def acquire(key):
+    if not valid_key(key):
+        return jsonify({'error': 'Invalid key'}), 400
+    deadline = time.monotonic() + request.args.get('wait', 30, type=float)
+    with leases_cond:
+        while True:
+            expire_leases()
+            if key not in holders:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return jsonify({'error': f'Timed out waiting for the lock on {key}'}), 423
+            leases_cond.wait(min(remaining, 1.0))
+        token = uuid.uuid4().hex
+        holders[key] = token
+    # The flock keeps backups taken on this machine consistent with our writes.
+    # It can wait on a local holder, so it is taken outside leases_cond, where
+    # it would stall every other lease request and renewal.
+    try:
+        file_lock = storage.lock(key).__enter__()
+    except BaseException:
+        with leases_cond:
+            del holders[key]
+            leases_cond.notify_all()
+        raise
+    with leases_cond:
+        leases[token] = (key, time.monotonic() + LEASE_SECONDS, file_lock)
+    versions = {name: version_of(storage.stamp(name)) for name in (key, journal_file(key))}
+    return jsonify({'token': token, 'versions': versions})
+
+
+@server.route('/locks/<token>/renew', methods=['POST'])
+def renew(token):
+    with leases_cond:
+        expire_leases()
+        lease = leases.get(token)
+        if lease is None:
+            return jsonify({'error': 'Lease expired before it was renewed'}), 409
+        key, _, file_lock = lease
+        leases[token] = (key, time.monotonic() + LEASE_SECONDS, file_lock)
+    return jsonify({'expires_in': LEASE_SECONDS})
+
+
+@server.route('/locks/<token>', methods=['DELETE'])
+def release(token):
+    with leases_cond:
+        lease = leases.pop(token, None)
+        if lease is None:
+            return jsonify({'error': 'Lease expired before it was released'}), 409
+        key, _, file_lock = lease
+        del holders[key]
+        file_lock.__exit__(None, None, None)
+        leases_cond.notify_all()
+    return Response(status=204)
+
+
+@server.route('/changes')
+def changes_since():
+    """Keys changed after seq `since`, waiting up to `wait` seconds for one"""
+    since = request.args.get('since', -1, type=int)
+    wait = min(request.args.get('wait', 20, type=float), 60)
+    with changes_cond:
+        if since == last_seq:
+            changes_cond.wait_for(lambda: last_seq != since, wait)
+        oldest = changes[0][0] if changes else last_seq + 1
+        reset = since < 0 or since > last_seq or since + 1 < oldest
+        pending = [] if reset else [{'key': key, 'version': version}
+                                    for seq, key, version in changes if seq > since]
+        return jsonify({'server': server_id, 'seq': last_seq, 'reset': reset, 'changes': pending})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--root', default=storage.root, help='Directory holding data/')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5100)
+    args = parser.parse_args()
+    if not STORAGE_SECRET:
+        parser.error('set STORAGE_SECRET to the secret the app nodes send')
+    storage.root = args.root
+    os.makedirs(os.path.join(storage.root, 'data'), exist_ok=True)
+    server.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()